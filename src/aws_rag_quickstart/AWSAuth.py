@@ -6,12 +6,12 @@ from aws_rag_quickstart.constants import REGION_NAME
 
 def get_aws_auth() -> AWS4Auth:
     service = "es"  # must set the service as 'es'
+    # refreshable credentials are re-read before they expire, so a
+    # long-lived client keeps signing with valid keys after rotation
     credentials = boto3.Session().get_credentials()
     awsauth = AWS4Auth(
-        credentials.access_key,
-        credentials.secret_key,
-        REGION_NAME,
-        service,
-        session_token=credentials.token,
+        refreshable_credentials=credentials,
+        region=REGION_NAME,
+        service=service,
     )
     return awsauth
@@ -1,16 +1,35 @@
+import asyncio
 import logging
 import os
-from typing import Any, Dict, List, Union
+import re
+import time
+from functools import lru_cache
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
 
 from botocore.config import Config
-from langchain import hub
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_core.tools import tool
 
-from aws_rag_quickstart.constants import OS_HOST, OS_INDEX_NAME, OS_PORT
-from aws_rag_quickstart.LLM import ChatLLM, Embeddings
-from aws_rag_quickstart.opensearch import get_opensearch_connection, list_docs_by_id
+from aws_rag_quickstart.answer_cache import get_answer_cache
+from aws_rag_quickstart.constants import (
+    RETRIEVAL_IDENTIFIER_PATTERN,
+    RETRIEVAL_MODE,
+)
+from aws_rag_quickstart.context import (
+    CONTEXT_MMR_CANDIDATES,
+    CONTEXT_MMR_LAMBDA,
+    build_context,
+)
+from aws_rag_quickstart.LLM import Embeddings, get_chat_llm
+from aws_rag_quickstart.metrics import TIME_TO_FIRST_TOKEN, LLMMetrics, span
+from aws_rag_quickstart.prompts import get_rag_prompt
+from aws_rag_quickstart.vector_store import (
+    LexicalVectorStore,
+    VectorStore,
+    get_vector_store,
+    has_docs,
+)
 
 logging.basicConfig(level=os.environ["LOG_LEVEL"])
 client_config = Config(max_pool_connections=50)
@@ -19,7 +38,7 @@ client_config = Config(max_pool_connections=50)
 @tool
 def os_similarity_search(context: Dict[str, Any]) -> Any:
     """
-    Perform a similarity search on OpenSearch.
+    Perform a similarity search on the vector store.
 
     Args:
         context
@@ -29,67 +48,278 @@ def os_similarity_search(context: Dict[str, Any]) -> Any:
 
     """
     unique_ids, question = context["unique_ids"], context["question"]
-    embeddings = Embeddings()
-    query_embedding = embeddings.embed_query(question)
-    should_queries = [{"term": {"unique_id": uid}} for uid in unique_ids]
-
-    query_body = {
-        "query": {
-            "knn": {
-                "embedding": {
-                    "vector": query_embedding,
-                    "k": 100,
-                    "filter": {
-                        "bool": {
-                            "should": should_queries,
-                            "minimum_should_match": 1,  # At least one of the conditions must match
-                        }
-                    },
-                }
-            }
-        },
-        "_source": {"exclude": ["embedding"]},
-    }
-    os_client = get_opensearch_connection(OS_HOST, OS_PORT)
-    response = os_client.search(index=OS_INDEX_NAME, body=query_body)
+    store = get_vector_store()
+    if isinstance(store, LexicalVectorStore) and lexical_question(question):
+        with span("search", mode="lexical"):
+            response = store.lexical_search(question, unique_ids)
+    else:
+        query_embedding = Embeddings().embed_query(question)
+        if (
+            isinstance(store, LexicalVectorStore)
+            and RETRIEVAL_MODE == "hybrid"
+        ):
+            with span("search", mode="hybrid"):
+                response = store.hybrid_search(
+                    question, query_embedding, unique_ids
+                )
+        else:
+            with span("search", mode="knn"):
+                response = store.knn_search(query_embedding, unique_ids)
+    return add_mmr_embeddings(store, response)
+
+
+def add_mmr_embeddings(
+    store: VectorStore,
+    response: Dict[str, Any],
+    candidates: int = CONTEXT_MMR_CANDIDATES,
+) -> Dict[str, Any]:
+    """
+    Fetch the stored embeddings of the top hits, which let the context
+    builder diversify them. Searches leave embeddings out, so only these
+    few vectors are transferred.
+
+    :param store: store the response comes from.
+    :param response: search response, updated in place.
+    :param candidates: top hits to fetch embeddings for.
+    :return: the response.
+    """
+    if CONTEXT_MMR_LAMBDA >= 1 or candidates <= 0:
+        return response
+    hits = list(response.get("hits", {}).get("hits", []))[:candidates]
+    if not hits:
+        return response
+    with span("mmr_embeddings", hits=len(hits)):
+        embeddings = store.embeddings([hit["_id"] for hit in hits])
+    for hit in hits:
+        if hit["_id"] in embeddings:
+            hit.setdefault("_source", {})["embedding"] = embeddings[hit["_id"]]
     return response
 
 
+def looks_like_identifier(question: str) -> bool:
+    """
+    Whether the question is a bare identifier such as a part number, which
+    an exact lexical match answers better than its embedding.
+    """
+    if not RETRIEVAL_IDENTIFIER_PATTERN:
+        return False
+    return bool(
+        re.fullmatch(RETRIEVAL_IDENTIFIER_PATTERN, question.strip(" \t\n?\"'"))
+    )
+
+
+def lexical_question(question: str) -> bool:
+    """
+    Whether the question is searched lexically only, which needs no
+    question embedding, on stores that support it.
+    """
+    return RETRIEVAL_MODE == "lexical" or looks_like_identifier(question)
+
+
+def embed_question(question: str) -> Optional[List[float]]:
+    """
+    Embedding of the question for the answer cache, None when it is
+    searched lexically only: the cache is then skipped rather than paying
+    the embedding call the lexical fast path saves.
+    """
+    if lexical_question(question) and isinstance(
+        get_vector_store(), LexicalVectorStore
+    ):
+        return None
+    return Embeddings().embed_query(question)
+
+
+def cached_answer(
+    unique_ids: Any, question_embedding: Optional[List[float]]
+) -> Optional[str]:
+    if question_embedding is None:
+        return None
+    return get_answer_cache().lookup(unique_ids, question_embedding)
+
+
+def cache_answer(
+    unique_ids: Any,
+    question_embedding: Optional[List[float]],
+    answer: str,
+    started: float,
+) -> None:
+    if question_embedding is not None:
+        get_answer_cache().store(
+            unique_ids, question_embedding, answer, started
+        )
+
+
+SUMMARY_QUESTION = (
+    "Describe each of these webpages from the website. What is happening "
+    "on each page?"
+)
+
+
 def summarize_documents(
     event: Dict[str, Union[str, List[str]]], *args: Any, **kwargs: Any
 ) -> str:
-    question = (
-        "Describe each of these webpages from the website. What is happening "
-        "on each page?"
-    )
     return main(
         {
             "unique_ids": event.get("unique_ids"),
-            "question": question,
+            "question": SUMMARY_QUESTION,
         }
     )
 
 
-def main(
+async def asummarize_documents(
     event: Dict[str, Union[str, List[str]]], *args: Any, **kwargs: Any
 ) -> str:
-    currently_indexed_ids_dict = list_docs_by_id(event.get("unique_ids"))
+    return await amain(
+        {
+            "unique_ids": event.get("unique_ids"),
+            "question": SUMMARY_QUESTION,
+        }
+    )
 
-    if not currently_indexed_ids_dict.get("num_pages"):
-        return f"There is no data for unique ids {event.get('unique_ids')} in OpenSearch"
 
-    logging.info(
-        f"Currently indexed unique ids are {currently_indexed_ids_dict}"
-    )
+def build_prompt_context(response: Dict[str, Any]) -> str:
+    with span("prompt"):
+        return build_context(response)
 
-    llm = ChatLLM().llm
-    prompt = hub.pull("rlm/rag-prompt")
-    rag_chain = (
-        {"context": os_similarity_search, "question": RunnablePassthrough()}
-        | prompt
-        | llm
+
+@lru_cache(maxsize=1)
+def rag_chain() -> Any:
+    """
+    RAG chain, compiled once per process and reused across requests.
+
+    Retrieved pages are deduplicated, diversified and packed into the
+    context token budget before they reach the prompt. Model calls are
+    recorded as the ``generation`` stage.
+    """
+    return (
+        {
+            "context": os_similarity_search
+            | RunnableLambda(build_prompt_context),
+            "question": RunnablePassthrough(),
+        }
+        | get_rag_prompt()
+        | get_chat_llm().with_config(callbacks=[LLMMetrics("generation")])
         | StrOutputParser()
     )
-    event = {"context": event, "question": event["question"]}
 
-    return rag_chain.invoke(input=event)
+
+def no_data_message(has_data: bool, unique_ids: Any) -> str:
+    if not has_data:
+        return f"There is no data for unique ids {unique_ids} in OpenSearch"
+    return ""
+
+
+def main(
+    event: Dict[str, Union[str, List[str]]], *args: Any, **kwargs: Any
+) -> str:
+    """
+    Answer a question over the documents of the given unique ids.
+
+    Answers to the same or a near-identical question over the same unique
+    ids are served from the semantic answer cache, except for questions
+    searched lexically only, which are never embedded.
+    """
+    with span("chat"):
+        started = time.time()
+        unique_ids = event.get("unique_ids")
+        question_embedding = embed_question(event["question"])
+        answer = cached_answer(unique_ids, question_embedding)
+        if answer is not None:
+            return answer
+
+        message = no_data_message(has_docs(unique_ids), unique_ids)
+        if message:
+            return message
+
+        answer = rag_chain().invoke(
+            input={"context": event, "question": event["question"]}
+        )
+        cache_answer(unique_ids, question_embedding, answer, started)
+        return answer
+
+
+async def amain(
+    event: Dict[str, Union[str, List[str]]], *args: Any, **kwargs: Any
+) -> str:
+    """
+    Async variant of main for the web API.
+
+    Blocking OpenSearch and client setup work runs in worker threads and
+    the chain is awaited with ``ainvoke``, so the event loop stays free to
+    serve other requests while the model generates.
+    """
+    with span("chat"):
+        started = time.time()
+        unique_ids = event.get("unique_ids")
+        question_embedding = await asyncio.to_thread(
+            embed_question, event["question"]
+        )
+        answer = cached_answer(unique_ids, question_embedding)
+        if answer is not None:
+            return answer
+
+        has_data = await asyncio.to_thread(has_docs, unique_ids)
+        message = no_data_message(has_data, unique_ids)
+        if message:
+            return message
+
+        chain = await asyncio.to_thread(rag_chain)
+        answer = await chain.ainvoke(
+            input={"context": event, "question": event["question"]}
+        )
+        cache_answer(unique_ids, question_embedding, answer, started)
+        return answer
+
+
+async def astream_main(
+    event: Dict[str, Union[str, List[str]]],
+    metrics: Optional[Dict[str, float]] = None,
+) -> AsyncIterator[str]:
+    """
+    Streaming variant of main, yielding the answer as it is generated.
+    The ``chat`` span stays open until the last chunk is yielded.
+
+    :param event: unique_ids and question.
+    :param metrics: filled with ``ttft_ms`` (time to first token) and
+        ``total_ms`` once the answer is complete.
+    :return: iterator of answer chunks.
+    """
+    metrics = {} if metrics is None else metrics
+    with span("chat"):
+        started = time.time()
+        unique_ids = event.get("unique_ids")
+        question_embedding = await asyncio.to_thread(
+            embed_question, event["question"]
+        )
+        answer = cached_answer(unique_ids, question_embedding)
+        source = "cache" if answer is not None else "no_data"
+        if answer is None:
+            has_data = await asyncio.to_thread(has_docs, unique_ids)
+            answer = no_data_message(has_data, unique_ids)
+        if answer:
+            metrics["ttft_ms"] = metrics["total_ms"] = elapsed_ms(started)
+            TIME_TO_FIRST_TOKEN.observe(
+                metrics["ttft_ms"] / 1000, source=source
+            )
+            yield answer
+            return
+
+        chain = await asyncio.to_thread(rag_chain)
+        chunks: List[str] = []
+        async for chunk in chain.astream(
+            input={"context": event, "question": event["question"]}
+        ):
+            if not chunks:
+                metrics["ttft_ms"] = elapsed_ms(started)
+                TIME_TO_FIRST_TOKEN.observe(
+                    metrics["ttft_ms"] / 1000, source="model"
+                )
+                logging.info(f"Time to first token {metrics['ttft_ms']:.0f}ms")
+            chunks.append(chunk)
+            yield chunk
+        metrics["total_ms"] = elapsed_ms(started)
+        cache_answer(unique_ids, question_embedding, "".join(chunks), started)
+
+
+def elapsed_ms(started: float) -> float:
+    return (time.time() - started) * 1000
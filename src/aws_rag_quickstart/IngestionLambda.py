@@ -1,112 +1,527 @@
 import base64
+import contextvars
+import hashlib
 import logging
 import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from io import BytesIO
-from typing import Any, Dict
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Set, Tuple
 
-import boto3
 import dotenv
+import numpy as np
 from langchain.schema import HumanMessage
-from opensearchpy import OpenSearch
-from pdf2image import convert_from_bytes
-
-from aws_rag_quickstart.constants import OS_HOST, OS_INDEX_NAME, OS_PORT
-from aws_rag_quickstart.LLM import ChatLLM, Embeddings
-from aws_rag_quickstart.opensearch import (
-    create_index_opensearch,
-    get_opensearch_connection,
-    insert_document_opensearch,
+from PIL.Image import Image
+
+from aws_rag_quickstart.answer_cache import get_answer_cache
+from aws_rag_quickstart.LLM import (
+    ChatLLM,
+    Embeddings,
+    get_chat_llm,
+    get_text_llm,
+)
+from aws_rag_quickstart.metrics import (
+    PAGE_IMAGE_BYTES,
+    PAGES,
+    record_tokens,
+    span,
+)
+from aws_rag_quickstart.opensearch import BulkIndexer, page_document_id
+from aws_rag_quickstart.rasterize import (
+    iter_pdf_pages,
+    pdf_page_count,
+    pdf_page_texts,
 )
+from aws_rag_quickstart.s3 import download_object, get_s3_client
+from aws_rag_quickstart.vector_store import VectorStore, get_vector_store
 
 logging.basicConfig(level=os.environ["LOG_LEVEL"])
 if int(os.getenv("LOCAL", "0")):
     dotenv.load_dotenv()
+# pages described by the vision LLM concurrently for one file
+INGEST_MAX_WORKERS = int(os.getenv("INGEST_MAX_WORKERS", "8"))
+# page image format sent to the vision LLM: "png", "jpeg" or "webp"
+PAGE_IMAGE_FORMAT = os.getenv("PAGE_IMAGE_FORMAT", "png").lower()
+# JPEG and WebP quality, from 1 to 100
+PAGE_IMAGE_QUALITY = int(os.getenv("PAGE_IMAGE_QUALITY", "85"))
+# longest page side in pixels, larger pages are downscaled, 0 keeps the
+# rendered size. Claude models resize anything above 1568 themselves
+PAGE_IMAGE_MAX_DIMENSION = int(os.getenv("PAGE_IMAGE_MAX_DIMENSION", "1568"))
+# send pages as grayscale: "auto" (pages without colour), "always", "never"
+PAGE_IMAGE_GRAYSCALE = os.getenv("PAGE_IMAGE_GRAYSCALE", "auto")
+# largest channel spread of a pixel that still counts as gray
+GRAYSCALE_TOLERANCE = 24
+# non-space characters of embedded text above which a page is taken from
+# its text layer instead of being rendered for the vision LLM, 0 renders
+# every page
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "200"))
+# text layer pages: "index" their text as is, or "llm" to have
+# TEXT_CHAT_MODEL describe them from the text
+TEXT_LAYER_MODE = os.getenv("TEXT_LAYER_MODE", "index")
+# Pillow format and MIME type of each PAGE_IMAGE_FORMAT
+IMAGE_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "jpg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+
+def image_format(name: str) -> Tuple[str, str]:
+    """
+    Pillow format and MIME type of a page image format.
+    """
+    try:
+        return IMAGE_FORMATS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown page image format {name}, "
+            f"expected one of {sorted(IMAGE_FORMATS)}"
+        ) from None
+
+
+def metadata_prompt(general_metadata: Dict[str, Any]) -> str:
+    return (
+        "Add to the metadata of a PDF file based on this page of the file. "
+        " The metadata you generate will"
+        " be indexed into an opensearch instance. Put all descriptive data into the values"
+        f" section of the metadata. The existing metadata is {general_metadata}."
+        "\n Only return a JSON object with the additional keys and values."
+    )
 
 
 def augment_metadata(
-    llm: ChatLLM, image_string: bytes, general_metadata: Dict[str, Any]
+    llm: ChatLLM,
+    image_string: str,
+    general_metadata: Dict[str, Any],
+    mime_type: Optional[str] = None,
 ) -> Dict[str, Any]:
+    mime_type = mime_type or image_format(PAGE_IMAGE_FORMAT)[1]
     message = HumanMessage(
         content=[
-            {
-                "type": "text",
-                "text": "Add to the metadata of a PDF file based on this page of the file. "
-                " The metadata you generate will"
-                " be indexed into an opensearch instance. Put all descriptive data into the values"
-                f" section of the metadata. The existing metadata is {general_metadata}."
-                "\n Only return a JSON object with the additional keys and values.",
-            },
+            {"type": "text", "text": metadata_prompt(general_metadata)},
             {
                 "type": "image_url",
-                "image_url": {"url": f"data:image/png;base64,{image_string}"},
+                "image_url": {
+                    "url": f"data:{mime_type};base64,{image_string}"
+                },
             },
         ],
     )
-    response = llm.invoke([message])
+    with span("vision_llm"):
+        response = llm.invoke([message])
+    record_tokens("vision_llm", response)
+    result = general_metadata.copy()
+    result["llm_generated"] = str(response.content)
+    return result
+
+
+def augment_text_metadata(
+    llm: ChatLLM, text: str, general_metadata: Dict[str, Any]
+) -> Dict[str, Any]:
+    message = HumanMessage(
+        content=f"{metadata_prompt(general_metadata)}\n The page text is:\n"
+        f"{text}"
+    )
+    with span("text_llm"):
+        response = llm.invoke([message])
+    record_tokens("text_llm", response)
     result = general_metadata.copy()
     result["llm_generated"] = str(response.content)
     return result
 
 
+def is_grayscale(image: Image, tolerance: int = GRAYSCALE_TOLERANCE) -> bool:
+    """
+    Whether a page has no colour, judged on a downsampled copy.
+    """
+    if image.mode in ("1", "L", "LA", "I", "F"):
+        return True
+    sample = image.reduce(max(1, max(image.size) // 256))
+    pixels = np.asarray(sample.convert("RGB"), dtype=np.int16)
+    sample.close()
+    spread = pixels.max(axis=2) - pixels.min(axis=2)
+    return int(spread.max()) <= tolerance
+
+
+def prepare_page_image(
+    image: Image,
+    max_dimension: int = PAGE_IMAGE_MAX_DIMENSION,
+    grayscale: str = PAGE_IMAGE_GRAYSCALE,
+) -> Image:
+    """
+    Downscale a page to the largest size the model uses and drop its
+    colour channels when they carry nothing.
+
+    :param image: rendered page, resized in place or closed if replaced.
+    :param max_dimension: longest side in pixels, 0 to keep the size.
+    :param grayscale: "auto", "always" or "never".
+    :return: the image to encode.
+    """
+    if max_dimension and max(image.size) > max_dimension:
+        image.thumbnail((max_dimension, max_dimension))
+    if image.mode != "L" and (
+        grayscale == "always" or (grayscale == "auto" and is_grayscale(image))
+    ):
+        gray = image.convert("L")
+        image.close()
+        image = gray
+    return image
+
+
+def encode_page(
+    image: Image,
+    image_format_name: str = PAGE_IMAGE_FORMAT,
+    quality: int = PAGE_IMAGE_QUALITY,
+    max_dimension: int = PAGE_IMAGE_MAX_DIMENSION,
+    grayscale: str = PAGE_IMAGE_GRAYSCALE,
+) -> str:
+    """
+    Prepare, encode and base64 encode a page image, then release its
+    pixels. The encoded bytes are base64 encoded straight from the
+    buffer, without an intermediate copy.
+
+    :param image: rendered page.
+    :param image_format_name: "png", "jpeg" or "webp".
+    :param quality: JPEG and WebP quality.
+    :param max_dimension: longest side in pixels, 0 to keep the size.
+    :param grayscale: "auto", "always" or "never".
+    :return: base64 encoded image.
+    """
+    save_format = image_format(image_format_name)[0]
+    with span("encode", format=save_format) as attributes:
+        image = prepare_page_image(image, max_dimension, grayscale)
+        attributes.update(size=image.size, mode=image.mode)
+        options = {} if save_format == "PNG" else {"quality": quality}
+        buffer = BytesIO()
+        image.save(buffer, format=save_format, **options)
+        image.close()
+        with buffer.getbuffer() as payload:
+            attributes["bytes"] = payload.nbytes
+            PAGE_IMAGE_BYTES.observe(payload.nbytes, format=save_format)
+            return base64.b64encode(payload).decode("ascii")
+
+
+def describe_page(
+    llm: ChatLLM,
+    page_number: int,
+    image: Any,
+    general_metadata: Dict[str, Any],
+    indexed_hash: Optional[str] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Encode one page and have the LLM generate its metadata.
+
+    :param llm: llm used to generate metadata.
+    :param page_number: 1-based page number.
+    :param image: rendered page, closed once encoded.
+    :param general_metadata: metadata shared by every page of the file.
+    :param indexed_hash: image hash of the page as currently indexed.
+    :return: the page document to index, None if the page is unchanged.
+    """
+    page_hash = hashlib.sha256(image.tobytes()).hexdigest()
+    if page_hash == indexed_hash:
+        logging.info(f"Page {page_number} is unchanged")
+        image.close()
+        return None
+    logging.info(f"Processing page {page_number}..")
+    encoded_string = encode_page(image)
+    metadata = augment_metadata(llm, encoded_string, general_metadata)
+    metadata["page_number"] = f"page_{page_number}"
+    metadata["page_hash"] = page_hash
+    return metadata
+
+
+def text_layer_pages(
+    pdf_path: str, page_count: int, min_chars: int = TEXT_LAYER_MIN_CHARS
+) -> Dict[int, str]:
+    """
+    Pages whose embedded text is long enough to index without rendering.
+
+    :param pdf_path: path of the PDF.
+    :param page_count: pages in the PDF.
+    :param min_chars: non-space characters a page needs, 0 for none.
+    :return: page text keyed by 1-based page number.
+    """
+    if min_chars <= 0:
+        return {}
+    texts = pdf_page_texts(pdf_path, page_count)
+    return {
+        page_number: text
+        for page_number, text in enumerate(texts, start=1)
+        if len("".join(text.split())) >= min_chars
+    }
+
+
+def describe_text_page(
+    page_number: int,
+    text: str,
+    general_metadata: Dict[str, Any],
+    indexed_hash: Optional[str] = None,
+    mode: str = TEXT_LAYER_MODE,
+) -> Optional[Dict[str, Any]]:
+    """
+    Build the document of a page from its text layer.
+
+    :param page_number: 1-based page number.
+    :param text: embedded text of the page.
+    :param general_metadata: metadata shared by every page of the file.
+    :param indexed_hash: hash of the page as currently indexed.
+    :param mode: "index" the text as is or have the "llm" describe it.
+    :return: the page document to index, None if the page is unchanged.
+    """
+    page_hash = "text:" + hashlib.sha256(text.encode()).hexdigest()
+    if page_hash == indexed_hash:
+        logging.info(f"Page {page_number} is unchanged")
+        return None
+    logging.info(f"Processing page {page_number} from its text layer..")
+    if mode == "llm":
+        metadata = augment_text_metadata(
+            get_text_llm(), text, general_metadata
+        )
+    else:
+        metadata = general_metadata.copy()
+        metadata["llm_generated"] = text
+    metadata["page_number"] = f"page_{page_number}"
+    metadata["page_hash"] = page_hash
+    return metadata
+
+
+def next_page(
+    rendered: Iterator[Tuple[int, Image]], page_number: int
+) -> Image:
+    """
+    Next rendered page, checked to be the expected one so that a page the
+    rasterizer skipped never shifts the following pages onto the wrong
+    document.
+    """
+    page, image = next(rendered, (None, None))
+    if page != page_number or image is None:
+        raise RuntimeError(
+            f"Expected page {page_number} from the rasterizer, got {page}"
+        )
+    return image
+
+
+class PageWriter:
+    """
+    Write described pages in order on one background thread, so the
+    thread rendering pages keeps going while a batch is embedded or
+    flushed.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[str, "Future[Optional[Dict[str, Any]]]"], None],
+        max_pending: int,
+    ) -> None:
+        self.write = write
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._writes: Deque["Future[None]"] = deque()
+
+    def __enter__(self) -> "PageWriter":
+        return self
+
+    def __exit__(self, exc_type: Any, *exc_info: Any) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(cancel_futures=True)
+
+    def submit(
+        self, doc_id: str, future: "Future[Optional[Dict[str, Any]]]"
+    ) -> None:
+        """
+        Queue a page, waiting for older writes once ``max_pending`` are
+        queued, which also raises their errors.
+        """
+        # writes run in a copy of this context, under the file's spans
+        self._writes.append(
+            self._executor.submit(
+                contextvars.copy_context().run, self.write, doc_id, future
+            )
+        )
+        while len(self._writes) > self.max_pending:
+            self._writes.popleft().result()
+
+    def close(self) -> None:
+        """Wait for every queued write."""
+        try:
+            while self._writes:
+                self._writes.popleft().result()
+        finally:
+            self._executor.shutdown()
+
+
+def file_unchanged(indexed: Dict[str, Dict[str, Any]], etag: str) -> bool:
+    """
+    Whether every page of a file is indexed from the given S3 version.
+
+    :param indexed: indexed pages of the file, keyed by document id.
+    :param etag: ETag of the S3 object.
+    """
+    pages = list(indexed.values())
+    return bool(pages) and all(
+        page.get("source_etag") == etag
+        and page.get("page_count") == len(pages)
+        for page in pages
+    )
+
+
 def process_file(
     input_dict: Dict[str, Any],
     metadata_llm: ChatLLM,
-    os_client: OpenSearch,
-    os_index_name: str,
+    store: VectorStore,
     os_embeddings: Any,
+    max_workers: int = INGEST_MAX_WORKERS,
 ) -> int:
     """
     Process a file using the metadata. ONLY SUPPORTS PDF FILES FOR NOW
     We will examine each page of the pdf and build up metadata for each page.
-    The metadata will be written to an opensearch instance
+    Pages with an embedded text layer of at least TEXT_LAYER_MIN_CHARS
+    characters are taken from their text; the others are rendered a few
+    at a time and described by up to ``max_workers`` concurrent vision
+    LLM calls, while a writer thread embeds and indexes finished pages in
+    page order.
+    The metadata will be written to the vector store through the _bulk
+    API, with a single refresh once the whole file is indexed.
+
+    Ingestion is incremental: a file whose S3 ETag matches the indexed
+    pages is not downloaded, and pages whose rendered image is unchanged
+    keep their metadata and embedding. Pages have stable document ids, so
+    changed pages replace their old version and pages no longer in the
+    file are removed. Changed files are downloaded to a temporary file
+    with parallel ranged GETs, pinned to the version whose ETag was
+    checked, and rendered from disk.
 
     :param input_dict: input_dict.
     :param metadata_llm: llm used to generate metadata.
-    :param os_client: OpenSearchClient.
-    :param os_index_name: OpenSearch index name .
+    :param store: vector store to index into.
     :param os_embeddings: embeddings function.
+    :param max_workers: pages described concurrently.
     :return: number of pages processed
     """
     file_path = input_dict.get("file_path")
+    unique_id = input_dict.get("unique_id")
+    bucket = os.environ["S3_BUCKET"]
 
     logging.info(f"Processing file {file_path}")
-    session = boto3.session.Session()
-    s3 = session.client("s3")
-    pdf_file = s3.get_object(Bucket=os.environ["S3_BUCKET"], Key=file_path)[
-        "Body"
-    ].read()
-
-    images = convert_from_bytes(pdf_file)
-
-    i = 0
-    for image in images:
-        i += 1
-        logging.info(f"Processing page {i}..")
-        img_byte_arr = BytesIO()
-        image.save(img_byte_arr, format="PNG")
-        img_byte_arr = img_byte_arr.getvalue()
-        encoded_string = base64.b64encode(img_byte_arr).decode()
-        metadata = augment_metadata(metadata_llm, encoded_string, input_dict)
-        metadata["page_number"] = f"page_{i}"
-        insert_document_opensearch(
-            os_client, os_index_name, os_embeddings, metadata
+    s3 = get_s3_client()
+    head = s3.head_object(Bucket=bucket, Key=file_path)
+    etag = head["ETag"].strip('"')
+    indexed = store.indexed_pages(unique_id, file_path)
+    if file_unchanged(indexed, etag):
+        logging.info(f"{file_path} is unchanged, skipping")
+        return len(indexed)
+
+    with download_object(
+        s3, bucket, file_path, etag, head.get("VersionId")
+    ) as pdf_path:
+        page_count = pdf_page_count(pdf_path)
+        text_pages = text_layer_pages(pdf_path, page_count)
+        rendered = iter(
+            iter_pdf_pages(
+                pdf_path,
+                page_count=page_count,
+                pages=[
+                    n for n in range(1, page_count + 1) if n not in text_pages
+                ],
+            )
+        )
+        source = {"source_etag": etag, "page_count": page_count}
+        indexer = BulkIndexer(store, os_embeddings)
+        written: Set[str] = set()
+        unchanged: Set[str] = set()
+
+        def write(
+            doc_id: str, future: "Future[Optional[Dict[str, Any]]]"
+        ) -> None:
+            document = future.result()
+            if document is None:
+                indexer.update(doc_id, source)
+                unchanged.add(doc_id)
+            else:
+                document.update(source)
+                indexer.add(document, doc_id)
+            written.add(doc_id)
+
+        i = 0
+        # futures are consumed oldest first, which keeps page order; capping
+        # them bounds the rendered pages waiting for a worker
+        pending: Deque[Tuple[str, "Future[Optional[Dict[str, Any]]]"]] = (
+            deque()
+        )
+        with (
+            ThreadPoolExecutor(max_workers=max_workers) as executor,
+            PageWriter(write, 2 * max_workers) as writer,
+        ):
+            for i in range(1, page_count + 1):
+                doc_id = page_document_id(unique_id, file_path, f"page_{i}")
+                indexed_hash = indexed.get(doc_id, {}).get("page_hash")
+                if i in text_pages:
+                    task: Tuple[Any, ...] = (
+                        describe_text_page,
+                        i,
+                        text_pages[i],
+                    )
+                else:
+                    task = (
+                        describe_page,
+                        metadata_llm,
+                        i,
+                        next_page(rendered, i),
+                    )
+                # each page runs in its own copy of this context, which nests
+                # its spans under the file's ingest span
+                future = executor.submit(
+                    contextvars.copy_context().run,
+                    *task,
+                    input_dict,
+                    indexed_hash,
+                )
+                pending.append((doc_id, future))
+                while pending and (
+                    len(pending) > 2 * max_workers or pending[0][1].done()
+                ):
+                    wait([pending[0][1]])
+                    writer.submit(*pending.popleft())
+            while pending:
+                writer.submit(*pending.popleft())
+    for doc_id in indexed.keys() - written:
+        indexer.delete(doc_id)
+    result = indexer.close()
+    PAGES.inc(result["indexed"], result="indexed")
+    PAGES.inc(len(unchanged), result="unchanged")
+    PAGES.inc(len(result["failures"]), result="failed")
+    if result["failures"]:
+        logging.warning(
+            f"{len(result['failures'])} of {i} pages failed to index "
+            f"for {file_path}"
         )
-    logging.info(f"Indexed {i} pages.")
+    logging.info(
+        f"Indexed {result['indexed']} of {i} pages, "
+        f"{len(unchanged)} unchanged, {len(text_pages)} from the text layer."
+    )
     return i
 
 
 def main(event: Dict[str, Any], *args: Any, **kwargs: Any) -> int:
-    metadata_llm = ChatLLM().llm
+    metadata_llm = get_chat_llm()
     os_embeddings = Embeddings()
-    os_client = get_opensearch_connection(OS_HOST, OS_PORT)
+    store = get_vector_store()
 
     # create index if it does not exist
-    if not os_client.indices.exists(index=OS_INDEX_NAME):
-        create_index_opensearch(os_client, os_embeddings, OS_INDEX_NAME)
+    if not store.exists():
+        store.create(os_embeddings)
 
     # process input pdf
-    num_pages_processed = process_file(
-        event, metadata_llm, os_client, OS_INDEX_NAME, os_embeddings
-    )
+    with span("ingest", file_path=event.get("file_path")) as attributes:
+        num_pages_processed = process_file(
+            event, metadata_llm, store, os_embeddings
+        )
+        attributes["pages"] = num_pages_processed
+    unique_id = event.get("unique_id")
+    get_answer_cache().invalidate([unique_id] if unique_id else None)
 
     return num_pages_processed
@@ -1,14 +1,26 @@
 import logging
 import os
-from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, List, Optional
 
 import ollama
+from botocore.config import Config
 from langchain_aws import BedrockEmbeddings, ChatBedrock
 from langchain_ollama import ChatOllama
 
+from aws_rag_quickstart.embedding_cache import get_embedding_cache
+from aws_rag_quickstart.metrics import span
+
 IS_LOCAL = bool(int(os.getenv("LOCAL", "0")))
 TEMPERATURE = os.getenv("MODEL_TEMP", "0.7")
 REGION_NAME = os.getenv("AWS_REGION", "us-west-2")
+# texts sent per request by backends that accept a list of inputs
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+# concurrent requests for backends that embed one text per request
+EMBED_MAX_WORKERS = int(os.getenv("EMBED_MAX_WORKERS", "8"))
+# embedding dimension of EMBED_MODEL, probed from the model when unset
+EMBED_DIMENSION = int(os.getenv("EMBED_DIMENSION", "0"))
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARN"))
 
 
@@ -19,8 +31,8 @@ class LLM:
 
 
 class ChatLLM(LLM):
-    def __init__(self) -> None:
-        self.chat_model = os.getenv("CHAT_MODEL")
+    def __init__(self, chat_model: Optional[str] = None) -> None:
+        self.chat_model = chat_model or os.getenv("CHAT_MODEL")
         if self.is_local_llm:
             ollama.pull(self.chat_model)
             self.llm = ChatOllama(
@@ -38,22 +50,132 @@ class ChatLLM(LLM):
             )
 
 
+@lru_cache(maxsize=1)
+def get_chat_llm() -> Any:
+    """
+    Chat model shared by every request of the process.
+
+    Building it once avoids re-running ``ollama.pull`` and re-creating the
+    Bedrock client on each call.
+    """
+    return ChatLLM().llm
+
+
+@lru_cache(maxsize=1)
+def get_text_llm() -> Any:
+    """
+    Model describing pages from their text layer: TEXT_CHAT_MODEL, a
+    cheaper text-only model, or the chat model when it is not set.
+    """
+    text_model = os.getenv("TEXT_CHAT_MODEL")
+    return ChatLLM(text_model).llm if text_model else get_chat_llm()
+
+
 class Embeddings(LLM):
     def __init__(self) -> None:
         self.prompt = None
         self.embed_model = os.getenv("EMBED_MODEL")
+        self.cache = get_embedding_cache()
+        self._bedrock: Optional[BedrockEmbeddings] = None
+
+    @property
+    def cache_model(self) -> str:
+        """Backend and model the cached vectors belong to."""
+        backend = "ollama" if self.is_local_llm else "bedrock"
+        return f"{backend}:{self.embed_model}"
+
+    @property
+    def dimension(self) -> int:
+        """Length of the vectors, embedding a probe text if not set."""
+        if EMBED_DIMENSION:
+            return EMBED_DIMENSION
+        return len(self.embed_query("dimension"))
+
+    @property
+    def bedrock(self) -> BedrockEmbeddings:
+        """Bedrock client, built once and reused for every call."""
+        bedrock = self._bedrock
+        if bedrock is None:
+            bedrock = BedrockEmbeddings(
+                region_name=REGION_NAME,
+                endpoint_url=os.environ["BEDROCK_ENDPOINT"],
+                config=Config(max_pool_connections=EMBED_MAX_WORKERS),
+            )
+            self._bedrock = bedrock
+        return bedrock
 
     def embed_query(self, prompt: str) -> Any:
         self.prompt = prompt
-        if self.is_local_llm:
-            return ollama.embeddings(model=self.embed_model, prompt=self.prompt).get(
-                "embedding"
+        cached = self.cache.get(self.cache_model, prompt)
+        if cached is not None:
+            return cached
+        result = self._embed_query(prompt)
+        self.cache.put(self.cache_model, prompt, result)
+        return result
+
+    def embed_documents(self, texts: List[str]) -> List[Any]:
+        """
+        Embed many texts, returning the vectors in input order.
+
+        Cached texts are served from the embedding cache; the remaining
+        distinct texts are embedded in one batched call and cached.
+
+        :param texts: texts to embed.
+        :return: one embedding per text.
+        """
+        vectors = self.cache.get_many(self.cache_model, texts)
+        missing = list(
+            dict.fromkeys(
+                text for text, vector in zip(texts, vectors) if vector is None
             )
-        else:
+        )
+        if not missing:
+            return vectors
+        embedded = dict(zip(missing, self._embed_documents(missing)))
+        for text, vector in embedded.items():
+            self.cache.put(self.cache_model, text, vector)
+        return [
+            embedded[text] if vector is None else vector
+            for text, vector in zip(texts, vectors)
+        ]
+
+    def _embed_query(self, prompt: str) -> Any:
+        with span("embed", texts=1):
+            if self.is_local_llm:
+                return ollama.embeddings(
+                    model=self.embed_model, prompt=prompt
+                ).get("embedding")
             logging.info("using bedrock")
-            result = BedrockEmbeddings(
-                region_name=REGION_NAME,
-                endpoint_url=os.environ["BEDROCK_ENDPOINT"],
-            ).embed_query(self.prompt)
-            print("embed length: ", len(result))
-            return result
+            return self.bedrock.embed_query(prompt)
+
+    def _embed_documents(self, texts: List[str]) -> List[Any]:
+        """
+        Embed many texts, returning the vectors in input order.
+
+        Ollama accepts a list of inputs, so texts are sent in batches of
+        EMBED_BATCH_SIZE. Bedrock embeds one text per request, so those
+        calls are fanned out over at most EMBED_MAX_WORKERS threads.
+
+        :param texts: texts to embed.
+        :return: one embedding per text.
+        """
+        if not texts:
+            return []
+        with span("embed", texts=len(texts)):
+            return self._embed_batch(texts)
+
+    def _embed_batch(self, texts: List[str]) -> List[Any]:
+        if self.is_local_llm:
+            vectors: List[Any] = []
+            for start in range(0, len(texts), EMBED_BATCH_SIZE):
+                end = start + EMBED_BATCH_SIZE
+                vectors.extend(
+                    ollama.embed(
+                        model=self.embed_model, input=texts[start:end]
+                    ).get("embeddings")
+                )
+            return vectors
+        logging.info(f"using bedrock for {len(texts)} texts")
+        workers = min(EMBED_MAX_WORKERS, len(texts))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.bedrock.embed_query, texts))
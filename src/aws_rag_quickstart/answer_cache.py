@@ -0,0 +1,340 @@
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+from aws_rag_quickstart.metrics import CACHE_REQUESTS
+
+# answers kept before the least recently used are evicted, 0 disables
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+# cosine similarity above which a cached answer is reused
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+# SQLite file recording invalidations so every process on the host sees
+# them, empty to only invalidate within the current process
+ANSWER_CACHE_INVALIDATION_PATH = os.getenv(
+    "ANSWER_CACHE_INVALIDATION_PATH",
+    os.path.join(
+        tempfile.gettempdir(), "aws_rag_quickstart", "invalidations.db"
+    ),
+)
+# longest a hold keeps answers over its unique ids out of the cache when
+# it is never released, e.g. a delete whose completion is never seen
+ANSWER_CACHE_HOLD_SECONDS = float(
+    os.getenv("ANSWER_CACHE_HOLD_SECONDS", "600")
+)
+# invalidation key that covers every unique id
+ALL_IDS = "*"
+
+Entry = Tuple[FrozenSet[str], npt.NDArray[np.float32], str, float]
+
+
+class SemanticAnswerCache:
+    """
+    Answers keyed by a set of unique ids and the question embedding.
+
+    A lookup returns the stored answer of the most similar question asked
+    over the same unique ids, when its cosine similarity reaches the
+    threshold. Ingesting or deleting documents under a unique id
+    invalidates every answer that covers it, and a hold keeps answers
+    over unique ids whose documents are still changing out of the cache.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = ANSWER_CACHE_SIZE,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+        invalidation_path: str = ANSWER_CACHE_INVALIDATION_PATH,
+    ) -> None:
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[int, Entry]" = OrderedDict()
+        self._next_id = 0
+        self._invalidated: Dict[str, float] = {}
+        # end of each hold not recorded in the shared file, keyed by hold
+        # key and unique id
+        self._holds: Dict[Tuple[str, str], float] = {}
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if invalidation_path:
+            self._open(invalidation_path)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+        }
+
+    def lookup(
+        self, unique_ids: Iterable[str], embedding: Sequence[float]
+    ) -> Optional[str]:
+        """
+        Find the answer to a similar question over the same unique ids.
+
+        :param unique_ids: unique ids the question is asked over.
+        :param embedding: embedding of the question.
+        :return: the cached answer, or None on a miss.
+        """
+        scope = frozenset(unique_ids)
+        query = self._unit(embedding)
+        with self._lock:
+            ids = [
+                i for i, entry in self._entries.items() if entry[0] == scope
+            ]
+            if query is None or not ids:
+                return self._count(None)
+            matrix = np.stack([self._entries[i][1] for i in ids])
+            similarities = matrix @ query
+            best = int(np.argmax(similarities))
+            entry_id = ids[best]
+            if similarities[best] < self.threshold:
+                return self._count(None)
+            if self._stale(scope, self._entries[entry_id][3]):
+                del self._entries[entry_id]
+                return self._count(None)
+            self._entries.move_to_end(entry_id)
+            return self._count(self._entries[entry_id][2])
+
+    def _count(self, answer: Optional[str]) -> Optional[str]:
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        CACHE_REQUESTS.inc(
+            cache="answer", result="miss" if answer is None else "hit"
+        )
+        return answer
+
+    def store(
+        self,
+        unique_ids: Iterable[str],
+        embedding: Sequence[float],
+        answer: str,
+        created: Optional[float] = None,
+    ) -> None:
+        """
+        Cache an answer.
+
+        :param unique_ids: unique ids the question was asked over.
+        :param embedding: embedding of the question.
+        :param answer: generated answer.
+        :param created: when retrieval started, answers older than a later
+            invalidation are never served.
+        """
+        vector = self._unit(embedding)
+        if vector is None or self.max_entries <= 0:
+            return
+        scope = frozenset(unique_ids)
+        created = time.time() if created is None else created
+        with self._lock:
+            if self._stale(scope, created):
+                return
+            self._entries[self._next_id] = (scope, vector, answer, created)
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, unique_ids: Optional[Iterable[str]] = None) -> None:
+        """
+        Drop the answers covering any of the unique ids.
+
+        :param unique_ids: changed unique ids, None for all of them.
+        """
+        ids = {ALL_IDS} if unique_ids is None else set(unique_ids)
+        now = time.time()
+        with self._lock:
+            for uid in ids:
+                self._invalidated[uid] = now
+            for entry_id, entry in list(self._entries.items()):
+                if ALL_IDS in ids or entry[0] & ids:
+                    del self._entries[entry_id]
+            if self._db is not None:
+                try:
+                    with self._db:
+                        self._db.executemany(
+                            "INSERT OR REPLACE INTO invalidations "
+                            "VALUES (?, ?)",
+                            [(uid, now) for uid in ids],
+                        )
+                except sqlite3.Error as e:
+                    logging.warning(f"Could not record invalidation: {e}")
+
+    def hold(
+        self,
+        key: str,
+        unique_ids: Optional[Iterable[str]] = None,
+        seconds: float = ANSWER_CACHE_HOLD_SECONDS,
+    ) -> None:
+        """
+        Keep answers over the unique ids out of the cache until the hold is
+        released, or for ``seconds`` if it never is. Answers whose
+        retrieval started before either are never served.
+
+        :param key: hold key, e.g. the task changing the documents.
+        :param unique_ids: changing unique ids, None for all of them.
+        :param seconds: longest the hold lasts.
+        """
+        ids = {ALL_IDS} if unique_ids is None else set(unique_ids)
+        now = time.time()
+        with self._lock:
+            self._expire_holds(now)
+            if self._db is not None:
+                try:
+                    with self._db:
+                        self._db.executemany(
+                            "INSERT OR REPLACE INTO holds VALUES (?, ?, ?)",
+                            [(key, uid, now + seconds) for uid in ids],
+                        )
+                    return
+                except sqlite3.Error as e:
+                    logging.warning(f"Hold is process local: {e}")
+            for uid in ids:
+                self._holds[(key, uid)] = now + seconds
+
+    def release(self, key: str) -> None:
+        """
+        End a hold, dropping the answers started while it lasted. Releasing
+        an unknown or already released hold does nothing.
+
+        :param key: hold key.
+        """
+        with self._lock:
+            ids = {uid for k, uid in self._holds if k == key}
+            for uid in ids:
+                del self._holds[(key, uid)]
+            if self._db is not None:
+                try:
+                    with self._db:
+                        rows = self._db.execute(
+                            "SELECT unique_id FROM holds WHERE key = ?",
+                            (key,),
+                        ).fetchall()
+                        self._db.execute(
+                            "DELETE FROM holds WHERE key = ?", (key,)
+                        )
+                    ids.update(uid for (uid,) in rows)
+                except sqlite3.Error as e:
+                    logging.warning(f"Could not release hold: {e}")
+        if ids:
+            self.invalidate(None if ALL_IDS in ids else ids)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def _open(self, path: str) -> None:
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(
+                path, timeout=30, check_same_thread=False
+            )
+            with self._db:
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS invalidations ("
+                    "unique_id TEXT PRIMARY KEY, at REAL NOT NULL)"
+                )
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS holds ("
+                    "key TEXT NOT NULL, unique_id TEXT NOT NULL, "
+                    "until REAL NOT NULL, PRIMARY KEY (key, unique_id))"
+                )
+        except sqlite3.Error as e:
+            logging.warning(f"Answer cache invalidation is process local: {e}")
+            self._db = None
+
+    def _expire_holds(self, now: float) -> None:
+        """
+        Turn holds that ran out into invalidations at their end, which
+        keeps both tables bounded by the holds in progress.
+        """
+        for (key, uid), until in list(self._holds.items()):
+            if until < now:
+                del self._holds[(key, uid)]
+                self._invalidated[uid] = max(
+                    self._invalidated.get(uid, 0.0), until
+                )
+        if self._db is None:
+            return
+        try:
+            with self._db:
+                self._db.execute(
+                    "INSERT INTO invalidations "
+                    "SELECT unique_id, MAX(until) FROM holds WHERE until < ? "
+                    "GROUP BY unique_id ON CONFLICT (unique_id) "
+                    "DO UPDATE SET at = MAX(at, excluded.at)",
+                    (now,),
+                )
+                self._db.execute("DELETE FROM holds WHERE until < ?", (now,))
+        except sqlite3.Error as e:
+            logging.warning(f"Could not expire holds: {e}")
+
+    def _stale(self, scope: FrozenSet[str], created: float) -> bool:
+        """
+        Whether an answer started at ``created`` predates a change to its
+        unique ids; holds count as a change at their end.
+        """
+        ids = set(scope) | {ALL_IDS}
+        latest = max(
+            [self._invalidated.get(uid, 0.0) for uid in ids]
+            + [until for (_, uid), until in self._holds.items() if uid in ids]
+        )
+        if self._db is not None:
+            try:
+                placeholders = ", ".join("?" * len(ids))
+                (shared,) = self._db.execute(
+                    "SELECT MAX(at) FROM ("
+                    "SELECT at FROM invalidations "
+                    f"WHERE unique_id IN ({placeholders}) "
+                    "UNION ALL SELECT until FROM holds "
+                    f"WHERE unique_id IN ({placeholders}))",
+                    tuple(ids) * 2,
+                ).fetchone()
+                latest = max(latest, shared or 0.0)
+            except sqlite3.Error as e:
+                logging.warning(f"Could not read invalidations: {e}")
+                return True
+        return latest >= created
+
+    @staticmethod
+    def _unit(
+        embedding: Sequence[float],
+    ) -> Optional[npt.NDArray[np.float32]]:
+        try:
+            vector = np.asarray(embedding, dtype=np.float32)
+        except (TypeError, ValueError):
+            return None
+        norm = np.linalg.norm(vector) if vector.ndim == 1 else 0.0
+        if not norm:
+            return None
+        return vector / norm
+
+
+_cache: Optional[SemanticAnswerCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> SemanticAnswerCache:
+    """
+    Process-wide answer cache, created on first use.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = SemanticAnswerCache()
+        return _cache
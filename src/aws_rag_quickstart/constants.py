@@ -6,3 +6,44 @@ TEMPERATURE = 0
 OS_INDEX_NAME = os.environ["INDEX_NAME"]
 OS_HOST = os.environ["AOSS_URL"]
 OS_PORT = os.environ["AOSS_PORT"]
+# bulk indexing: flush after this many documents or (source) bytes
+OS_BULK_MAX_DOCS = int(os.getenv("OS_BULK_MAX_DOCS", "100"))
+OS_BULK_MAX_BYTES = int(os.getenv("OS_BULK_MAX_BYTES", str(5 * 1024 * 1024)))
+# refresh applied once, with the last flush of a file
+OS_BULK_REFRESH = os.getenv("OS_BULK_REFRESH", "wait_for")
+# keep-alive connections per shared OpenSearch client
+OS_POOL_MAXSIZE = int(os.getenv("OS_POOL_MAXSIZE", "20"))
+# upper bound on the pages of a single file
+OS_MAX_PAGES = int(os.getenv("OS_MAX_PAGES", "10000"))
+# distinct file paths returned by list_docs_by_id
+OS_MANIFEST_MAX_FILES = int(os.getenv("OS_MANIFEST_MAX_FILES", "10000"))
+# buckets fetched per composite aggregation request when listing files
+OS_LIST_PAGE_SIZE = int(os.getenv("OS_LIST_PAGE_SIZE", "1000"))
+# largest page size a client may ask for when listing files
+OS_LIST_MAX_PAGE_SIZE = int(os.getenv("OS_LIST_MAX_PAGE_SIZE", "10000"))
+# retrieval: "knn", "hybrid" (kNN and BM25 fused by reciprocal rank) or
+# "lexical"
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "knn")
+# hits requested from each retriever
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "100"))
+# reciprocal rank fusion: score = sum(weight / (RRF_K + rank))
+RRF_K = int(os.getenv("RRF_K", "60"))
+RRF_KNN_WEIGHT = float(os.getenv("RRF_KNN_WEIGHT", "1.0"))
+RRF_LEXICAL_WEIGHT = float(os.getenv("RRF_LEXICAL_WEIGHT", "1.0"))
+# questions matching this are looked up lexically only, skipping the
+# embedding call; empty to disable
+RETRIEVAL_IDENTIFIER_PATTERN = os.getenv(
+    "RETRIEVAL_IDENTIFIER_PATTERN", r"^[\w./:#-]*\d[\w./:#-]*$"
+)
+# kNN index profile: "float32", "fp16" (faiss scalar quantization, half the
+# memory), "int8" (lucene scalar quantization, a quarter) or "on_disk"
+# (binary quantized in memory, rescored from disk)
+INDEX_PROFILE = os.getenv("INDEX_PROFILE", "float32")
+# compression of the "on_disk" profile: 2x, 4x, 8x, 16x or 32x
+OS_COMPRESSION_LEVEL = os.getenv("OS_COMPRESSION_LEVEL", "32x")
+# HNSW graph parameters, set when the index is created
+OS_HNSW_M = int(os.getenv("OS_HNSW_M", "32"))
+OS_HNSW_EF_CONSTRUCTION = int(os.getenv("OS_HNSW_EF_CONSTRUCTION", "256"))
+OS_HNSW_EF_SEARCH = int(os.getenv("OS_HNSW_EF_SEARCH", "256"))
+# ef_search sent with each kNN query, 0 to use the index setting
+KNN_EF_SEARCH = int(os.getenv("KNN_EF_SEARCH", "0"))
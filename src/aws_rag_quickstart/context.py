@@ -0,0 +1,146 @@
+import hashlib
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+# estimated prompt tokens the retrieved context may use
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "3000"))
+# maximal marginal relevance trade-off, 1 ranks by relevance only and
+# lower values favour pages unlike the ones already picked
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+# top hits whose embeddings are fetched for the relevance trade-off, the
+# others keep their search order; 0 disables it
+CONTEXT_MMR_CANDIDATES = int(os.getenv("CONTEXT_MMR_CANDIDATES", "20"))
+# cosine similarity above which two pages count as duplicates
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.97"))
+# page fields passed to the model
+CONTEXT_FIELDS = [
+    field
+    for field in os.getenv(
+        "CONTEXT_FIELDS", "file_path,page_number,llm_generated"
+    ).split(",")
+    if field
+]
+# rough characters per token, used to estimate prompt size
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def format_page(source: Dict[str, Any], fields: List[str]) -> str:
+    return "\n".join(
+        f"{field}: {source[field]}" for field in fields if field in source
+    )
+
+
+def mmr_order(
+    relevance: npt.NDArray[np.float32],
+    vectors: npt.NDArray[np.float32],
+    mmr_lambda: float = CONTEXT_MMR_LAMBDA,
+    dedup_threshold: float = CONTEXT_DEDUP_THRESHOLD,
+) -> List[int]:
+    """
+    Order candidates by maximal marginal relevance, dropping duplicates.
+
+    Each step picks the candidate maximising
+    ``mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity`` to the
+    candidates already picked. Candidates at least ``dedup_threshold``
+    similar to a picked one are dropped.
+
+    :param relevance: relevance of each candidate, scaled to [0, 1].
+    :param vectors: unit-length embedding of each candidate, one per row.
+    :param mmr_lambda: relevance weight.
+    :param dedup_threshold: cosine similarity of near-identical pages.
+    :return: indices of the kept candidates, best first.
+    """
+    similarity = vectors @ vectors.T
+    # highest similarity of each candidate to the picked ones
+    redundancy = np.full(len(relevance), -np.inf)
+    remaining = np.ones(len(relevance), dtype=bool)
+    order: List[int] = []
+    while remaining.any():
+        penalty = np.where(np.isinf(redundancy), 0.0, redundancy)
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * penalty
+        scores[~remaining] = -np.inf
+        best = int(np.argmax(scores))
+        order.append(best)
+        remaining[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+        remaining &= redundancy < dedup_threshold
+    return order
+
+
+def build_context(
+    response: Dict[str, Any],
+    max_tokens: int = CONTEXT_MAX_TOKENS,
+    fields: Optional[List[str]] = None,
+    mmr_lambda: float = CONTEXT_MMR_LAMBDA,
+    dedup_threshold: float = CONTEXT_DEDUP_THRESHOLD,
+) -> str:
+    """
+    Turn a search response into the context section of the prompt.
+
+    Pages with identical text are collapsed. The leading hits that carry
+    their embedding are deduplicated against each other and ordered by
+    maximal marginal relevance; the other hits follow in search order.
+    Pages are then added, reduced to ``fields``, while they fit in
+    ``max_tokens``.
+
+    :param response: OpenSearch search response.
+    :param max_tokens: token budget of the context.
+    :param fields: page fields to keep, CONTEXT_FIELDS by default.
+    :param mmr_lambda: relevance weight of the ordering.
+    :param dedup_threshold: cosine similarity of near-identical pages.
+    :return: the packed context.
+    """
+    fields = CONTEXT_FIELDS if fields is None else fields
+    hits, seen = [], set()
+    for hit in response.get("hits", {}).get("hits", []):
+        source = hit.get("_source", {})
+        digest = hashlib.sha1(
+            " ".join(str(source.get("llm_generated", "")).split()).encode()
+        ).digest()
+        if digest not in seen:
+            seen.add(digest)
+            hits.append(hit)
+
+    vectors = [hit.get("_source", {}).get("embedding") for hit in hits]
+    ranked = next((i for i, v in enumerate(vectors) if not v), len(hits))
+    order = list(range(ranked, len(hits)))
+    if ranked:
+        hits_ranked = hits[:ranked]
+        matrix = np.asarray(vectors[:ranked], dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1, norms)
+        scores = np.asarray(
+            [hit.get("_score") or 0.0 for hit in hits_ranked],
+            dtype=np.float32,
+        )
+        spread = scores.max() - scores.min()
+        relevance = (
+            (scores - scores.min()) / spread
+            if spread
+            else np.ones_like(scores)
+        )
+        order = (
+            mmr_order(relevance, matrix, mmr_lambda, dedup_threshold) + order
+        )
+
+    pages, used = [], 0
+    for i in order:
+        page = format_page(hits[i].get("_source", {}), fields)
+        tokens = estimate_tokens(page)
+        if used + tokens > max_tokens:
+            continue
+        pages.append(page)
+        used += tokens
+    logging.info(
+        f"Packed {len(pages)} of {len(hits)} unique pages "
+        f"into ~{used} tokens"
+    )
+    return "\n\n".join(pages)
@@ -0,0 +1,216 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence
+
+from aws_rag_quickstart.metrics import CACHE_REQUESTS
+
+# entries kept in the in-process LRU tier
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "4096"))
+# SQLite file for the persistent tier, empty to keep the cache in memory
+EMBED_CACHE_PATH = os.getenv(
+    "EMBED_CACHE_PATH",
+    os.path.join(tempfile.gettempdir(), "aws_rag_quickstart", "embeds.db"),
+)
+# rows kept in the persistent tier before the least recently used go
+EMBED_CACHE_MAX_ROWS = int(os.getenv("EMBED_CACHE_MAX_ROWS", "200000"))
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache of embeddings keyed by (embed model, text hash).
+
+    Lookups hit an in-process LRU first, then a SQLite table holding
+    float32 vectors. Both tiers are size bounded and evict the least
+    recently used entries. Disk errors are logged and treated as misses
+    so the cache never breaks an embedding call.
+    """
+
+    def __init__(
+        self,
+        path: str = EMBED_CACHE_PATH,
+        memory_size: int = EMBED_CACHE_SIZE,
+        max_rows: int = EMBED_CACHE_MAX_ROWS,
+    ) -> None:
+        self.path = path
+        self.memory_size = memory_size
+        self.max_rows = max_rows
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._rows = 0
+        if path:
+            self._open(path)
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode()).hexdigest()
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_entries": len(self._memory),
+            "disk_entries": self._rows,
+        }
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        """
+        Look up the embedding of a text.
+
+        :param model: embedding model name.
+        :param text: embedded text.
+        :return: the cached vector, or None on a miss.
+        """
+        key = self.key(model, text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                CACHE_REQUESTS.inc(cache="embedding", result="memory_hit")
+                return vector
+            vector = self._disk_get(key)
+            if vector is None:
+                self.misses += 1
+                CACHE_REQUESTS.inc(cache="embedding", result="miss")
+                return None
+            self.disk_hits += 1
+            CACHE_REQUESTS.inc(cache="embedding", result="disk_hit")
+            self._memory_put(key, vector)
+            return vector
+
+    def get_many(
+        self, model: str, texts: Sequence[str]
+    ) -> List[Optional[List[float]]]:
+        return [self.get(model, text) for text in texts]
+
+    def put(self, model: str, text: str, vector: Sequence[float]) -> None:
+        """
+        Store the embedding of a text in both tiers.
+
+        :param model: embedding model name.
+        :param text: embedded text.
+        :param vector: embedding, skipped when it is not numeric.
+        """
+        try:
+            packed = array("f", vector)
+        except TypeError:
+            packed = array("f")
+        if not packed:
+            logging.debug("not caching empty or non numeric embedding")
+            return
+        key = self.key(model, text)
+        with self._lock:
+            self._memory_put(key, list(vector))
+            self._disk_put(key, packed)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self.memory_hits = self.disk_hits = self.misses = 0
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("DELETE FROM embeddings")
+                self._rows = 0
+
+    def _open(self, path: str) -> None:
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(
+                path, timeout=30, check_same_thread=False
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            with self._db:
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings ("
+                    "key TEXT PRIMARY KEY, vector BLOB NOT NULL, "
+                    "accessed REAL NOT NULL)"
+                )
+                self._db.execute(
+                    "CREATE INDEX IF NOT EXISTS embeddings_accessed "
+                    "ON embeddings (accessed)"
+                )
+            (self._rows,) = self._db.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Embedding cache disabled on disk: {e}")
+            self._db = None
+
+    def _memory_put(self, key: str, vector: List[float]) -> None:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _disk_get(self, key: str) -> Optional[List[float]]:
+        if self._db is None:
+            return None
+        try:
+            with self._db:
+                row = self._db.execute(
+                    "SELECT vector FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                self._db.execute(
+                    "UPDATE embeddings SET accessed = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+        except sqlite3.Error as e:
+            logging.warning(f"Embedding cache read failed: {e}")
+            return None
+        vector = array("f")
+        vector.frombytes(row[0])
+        return vector.tolist()
+
+    def _disk_put(self, key: str, vector: "array[float]") -> None:
+        if self._db is None:
+            return
+        try:
+            with self._db:
+                inserted = self._db.execute(
+                    "INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?)",
+                    (key, vector.tobytes(), time.time()),
+                ).rowcount
+                self._rows += inserted
+                if self._rows > self.max_rows:
+                    # evict a tenth at a time to amortise the delete
+                    excess = self._rows - int(self.max_rows * 0.9)
+                    self._db.execute(
+                        "DELETE FROM embeddings WHERE key IN (SELECT key "
+                        "FROM embeddings ORDER BY accessed, rowid LIMIT ?)",
+                        (excess,),
+                    )
+                    (self._rows,) = self._db.execute(
+                        "SELECT COUNT(*) FROM embeddings"
+                    ).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Embedding cache write failed: {e}")
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """
+    Process-wide embedding cache, created on first use.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+        return _cache
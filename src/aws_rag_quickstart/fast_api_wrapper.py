@@ -1,19 +1,71 @@
 import json
-from typing import Annotated, Any, Dict, List
-
-from fastapi import BackgroundTasks, Body, FastAPI, UploadFile
+import os
+from contextlib import asynccontextmanager
+from typing import (
+    Annotated,
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+)
+
+from fastapi import Body, FastAPI, HTTPException, Query, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
-from aws_rag_quickstart.AgentLambda import main, summarize_documents
+from aws_rag_quickstart.AgentLambda import (
+    amain,
+    astream_main,
+    asummarize_documents,
+)
+from aws_rag_quickstart.answer_cache import get_answer_cache
+from aws_rag_quickstart.constants import (
+    OS_LIST_MAX_PAGE_SIZE,
+    OS_LIST_PAGE_SIZE,
+)
+from aws_rag_quickstart.embedding_cache import get_embedding_cache
 from aws_rag_quickstart.IngestionLambda import main as vectorstore
-from aws_rag_quickstart.opensearch import delete_doc, list_docs_by_id
-
-app = FastAPI()
+from aws_rag_quickstart.jobs import JobQueue, JobWorkerPool
+from aws_rag_quickstart.metrics import render
+from aws_rag_quickstart.vector_store import (
+    delete_doc,
+    delete_files,
+    delete_status,
+    iter_indexed_files,
+    list_docs_by_id,
+)
+
+# run ingestion workers inside the API process, disable when running
+# ``python -m aws_rag_quickstart.jobs`` separately
+JOBS_IN_PROCESS = bool(int(os.getenv("JOBS_IN_PROCESS", "1")))
+job_queue = JobQueue()
+job_workers = JobWorkerPool(job_queue, {"ingest": vectorstore})
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    if JOBS_IN_PROCESS:
+        job_workers.start()
+    yield
+    job_workers.stop(timeout=5)
+
+
+app = FastAPI(lifespan=lifespan)
 BULK_API = "/bulk"
+CACHE_STATS_API = "/cache/stats"
 CHAT_API = "/chat"
+CHAT_STREAM_API = "/chat/stream"
+DELETE_TASKS_API = "/delete_tasks"
 DOC_API = "/pdf_file"
+FILES_API = "/files"
+JOBS_API = "/jobs"
 MANIFEST_API = "/manifest"
+METRICS_API = "/metrics"
 SUMMARY_API = "/summary"
+UNIQUE_ID_API = "/unique_id"
 
 
 class BaseEvent(BaseModel):
@@ -43,74 +95,152 @@ class SummaryEvent(BaseModel):
 
 @app.post(CHAT_API)
 async def post(event: Annotated[ChatEvent, Body(embed=True)]) -> str:
-    return main(event.model_dump())
+    return await amain(event.model_dump())
+
+
+async def sse_answer(event: Dict[str, Any]) -> AsyncIterator[str]:
+    """
+    Server-Sent Events: one ``data`` event per answer chunk, then a
+    ``metrics`` event with the time to first token and a ``done`` event.
+    """
+    metrics: Dict[str, float] = {}
+    async for chunk in astream_main(event, metrics):
+        yield f"data: {json.dumps(chunk)}\n\n"
+    yield f"event: metrics\ndata: {json.dumps(metrics)}\n\n"
+    yield "event: done\ndata: {}\n\n"
+
+
+@app.post(CHAT_STREAM_API)
+async def post_stream(
+    event: Annotated[ChatEvent, Body(embed=True)]
+) -> StreamingResponse:
+    return StreamingResponse(
+        sse_answer(event.model_dump()), media_type="text/event-stream"
+    )
 
 
 @app.delete(DOC_API)
 async def delete(event: Annotated[FileEvent, Body(embed=True)]) -> Any:
-    return delete_doc(event.model_dump())
+    return await run_in_threadpool(delete_doc, event.model_dump())
 
 
 @app.put(DOC_API)
 async def put(event: Annotated[FileEvent, Body(embed=True)]) -> int:
-    return vectorstore(event.model_dump())
+    return await run_in_threadpool(vectorstore, event.model_dump())
 
 
 @app.post(DOC_API)
 async def get_docs(
     event: Annotated[ListDocsEvent, Body(embed=True)]
 ) -> Dict[str, Any]:
-    return list_docs_by_id(event.model_dump().get("unique_ids"))
+    return await run_in_threadpool(
+        list_docs_by_id, event.model_dump().get("unique_ids")
+    )
+
+
+def ndjson_files(
+    unique_ids: Optional[List[str]], page_size: int
+) -> Iterator[str]:
+    for row in iter_indexed_files(unique_ids, page_size):
+        yield json.dumps(row) + "\n"
+
+
+@app.get(FILES_API)
+async def list_files(
+    unique_id: Annotated[Optional[List[str]], Query()] = None,
+    page_size: Annotated[
+        int, Query(ge=1, le=OS_LIST_MAX_PAGE_SIZE)
+    ] = OS_LIST_PAGE_SIZE,
+) -> StreamingResponse:
+    """
+    Every indexed file as newline-delimited JSON, streamed ``page_size``
+    files at a time.
+    """
+    return StreamingResponse(
+        ndjson_files(unique_id, page_size),
+        media_type="application/x-ndjson",
+    )
 
 
 @app.get(SUMMARY_API)
 async def summarize(event: Annotated[SummaryEvent, Body(embed=True)]) -> str:
-    return summarize_documents(event.model_dump())
+    return await asummarize_documents(event.model_dump())
 
 
 @app.put(BULK_API)
 async def bulk_put(
     event: Annotated[BulkEvent, Body(embed=True)],
-    background_tasks: BackgroundTasks,
 ) -> Dict[str, Any]:
-    event = event.model_dump()
-    for file_id in event.get("file_paths"):
-        this = FileEvent(file_path=file_id, unique_id=event.get("unique_id"))
-        background_tasks.add_task(vectorstore, this.model_dump())
-    return {"message": "Processing in the background"}
+    job_id = await run_in_threadpool(
+        job_queue.submit, "ingest", event.file_paths, event.unique_id
+    )
+    return {"message": "Processing in the background", "job_id": job_id}
 
 
 @app.delete(BULK_API)
 async def bulk_delete(
     event: Annotated[BulkEvent, Body(embed=True)],
-    background_tasks: BackgroundTasks,
 ) -> Dict[str, Any]:
-    event = event.model_dump()
-    for file_id in event.get("file_paths"):
-        this = FileEvent(file_path=file_id, unique_id=event.get("unique_id"))
-        background_tasks.add_task(delete_doc, this.model_dump())
-    return {"message": "Processing in the background"}
+    task = await run_in_threadpool(
+        delete_files, event.file_paths, event.unique_id
+    )
+    return {"message": "Deleting in the background", **task}
 
 
-@app.put(MANIFEST_API)
-async def put_manifest(
-    file: UploadFile, background_tasks: BackgroundTasks
+@app.delete(UNIQUE_ID_API)
+async def delete_unique_id(
+    event: Annotated[BaseEvent, Body(embed=True)],
 ) -> Dict[str, Any]:
-    data = json.load(file.file)
+    task = await run_in_threadpool(delete_files, None, event.unique_id)
+    return {"message": "Deleting in the background", **task}
+
+
+@app.put(MANIFEST_API)
+async def put_manifest(file: UploadFile) -> Dict[str, Any]:
+    data = json.loads(await file.read())
     files = [row["name"] for row in data]
-    for file_id in files:
-        this = FileEvent(file_path=file_id, unique_id=file.filename)
-        background_tasks.add_task(vectorstore, this.model_dump())
-    return {"unique_id": file.filename}
+    job_id = await run_in_threadpool(
+        job_queue.submit, "ingest", files, file.filename
+    )
+    return {"unique_id": file.filename, "job_id": job_id}
 
 
 @app.delete(MANIFEST_API)
-async def delete_manifest(
-    file: UploadFile, background_tasks: BackgroundTasks
-) -> Dict[str, Any]:
-    data = json.load(file.file)
+async def delete_manifest(file: UploadFile) -> Dict[str, Any]:
+    data = json.loads(await file.read())
     files = [row["name"] for row in data]
-    for file_id in files:
-        this = FileEvent(file_path=file_id)
-        background_tasks.add_task(delete_doc, this.model_dump())
-    return {"unique_id": file.filename}
+    task = await run_in_threadpool(delete_files, files, file.filename)
+    return {"unique_id": file.filename, **task}
+
+
+@app.get(DELETE_TASKS_API + "/{task_id}")
+async def delete_task_status(task_id: str) -> Dict[str, Any]:
+    status = await run_in_threadpool(delete_status, task_id)
+    if status is None:
+        raise HTTPException(
+            status_code=404, detail=f"Unknown delete task {task_id}"
+        )
+    return status
+
+
+@app.get(JOBS_API + "/{job_id}")
+async def job_status(job_id: str) -> Dict[str, Any]:
+    status = await run_in_threadpool(job_queue.status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return status
+
+
+@app.get(CACHE_STATS_API)
+async def cache_stats() -> Dict[str, Any]:
+    return {
+        "answers": get_answer_cache().stats,
+        "embeddings": get_embedding_cache().stats,
+    }
+
+
+@app.get(METRICS_API)
+async def metrics() -> PlainTextResponse:
+    return PlainTextResponse(
+        render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
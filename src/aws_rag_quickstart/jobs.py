@@ -0,0 +1,334 @@
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# SQLite file holding queued jobs, shared by every API and worker process
+JOBS_DB_PATH = os.getenv(
+    "JOBS_DB_PATH",
+    os.path.join(tempfile.gettempdir(), "aws_rag_quickstart", "jobs.db"),
+)
+# worker threads per process
+JOBS_MAX_WORKERS = int(os.getenv("JOBS_MAX_WORKERS", "4"))
+# attempts per file before it is marked failed
+JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "3"))
+# base delay in seconds before a failed file is retried, doubled per attempt
+JOBS_RETRY_DELAY = float(os.getenv("JOBS_RETRY_DELAY", "5"))
+# seconds after which a running file is assumed lost and handed out again
+JOBS_LEASE_SECONDS = float(os.getenv("JOBS_LEASE_SECONDS", "3600"))
+# seconds an idle worker waits before polling the queue again
+JOBS_POLL_INTERVAL = float(os.getenv("JOBS_POLL_INTERVAL", "1"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    action TEXT NOT NULL,
+    unique_id TEXT,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL REFERENCES jobs (id),
+    file_path TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL DEFAULT 0,
+    claimed_at REAL,
+    result INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, available_at);
+CREATE INDEX IF NOT EXISTS tasks_job ON tasks (job_id, status);
+"""
+
+
+class JobQueue:
+    """
+    Persistent queue of per-file ingestion tasks grouped into jobs.
+
+    Tasks live in SQLite, so they survive restarts and can be shared by
+    several processes. A claimed task is leased to its worker; if the
+    worker dies the lease expires and the task is handed out again.
+    """
+
+    def __init__(
+        self,
+        path: str = JOBS_DB_PATH,
+        max_attempts: int = JOBS_MAX_ATTEMPTS,
+        retry_delay: float = JOBS_RETRY_DELAY,
+        lease_seconds: float = JOBS_LEASE_SECONDS,
+    ) -> None:
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease_seconds = lease_seconds
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        db = sqlite3.connect(path, timeout=30)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaction(
+        self, immediate: bool = True
+    ) -> Iterator[sqlite3.Connection]:
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            # writers take the lock up front so two processes can never
+            # claim the same task
+            db.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            yield db
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def submit(
+        self, action: str, file_paths: List[str], unique_id: Optional[str]
+    ) -> str:
+        """
+        Queue one task per file.
+
+        :param action: name of the handler that processes each file.
+        :param file_paths: files to process.
+        :param unique_id: unique id the files are indexed under.
+        :return: the job id.
+        """
+        job_id = uuid.uuid4().hex
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO jobs VALUES (?, ?, ?, ?)",
+                (job_id, action, unique_id, time.time()),
+            )
+            db.executemany(
+                "INSERT INTO tasks (job_id, file_path) VALUES (?, ?)",
+                [(job_id, file_path) for file_path in file_paths],
+            )
+        logging.info(f"Queued job {job_id} with {len(file_paths)} files")
+        return job_id
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """
+        Lease the oldest task that is ready to run.
+
+        :return: the task, or None when the queue is empty.
+        """
+        while True:
+            now = time.time()
+            with self._transaction() as db:
+                row = db.execute(
+                    "SELECT t.id, t.job_id, t.file_path, t.attempts, "
+                    "t.status, j.action, j.unique_id FROM tasks t "
+                    "JOIN jobs j ON j.id = t.job_id "
+                    "WHERE (t.status = 'pending' AND t.available_at <= ?) "
+                    "OR (t.status = 'running' AND t.claimed_at < ?) "
+                    "ORDER BY t.id LIMIT 1",
+                    (now, now - self.lease_seconds),
+                ).fetchone()
+                if row is None:
+                    return None
+                if row["attempts"] >= self.max_attempts:
+                    # lease expired on the last attempt
+                    db.execute(
+                        "UPDATE tasks SET status = 'failed', "
+                        "error = 'worker lease expired' WHERE id = ?",
+                        (row["id"],),
+                    )
+                    continue
+                db.execute(
+                    "UPDATE tasks SET status = 'running', claimed_at = ?, "
+                    "attempts = attempts + 1 WHERE id = ?",
+                    (now, row["id"]),
+                )
+            task = dict(row)
+            task["attempts"] += 1
+            return task
+
+    def complete(self, task_id: int, result: Any = None) -> None:
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE tasks SET status = 'done', result = ?, error = NULL "
+                "WHERE id = ?",
+                (result if isinstance(result, int) else None, task_id),
+            )
+
+    def fail(self, task_id: int, error: str) -> None:
+        """
+        Record a failed attempt, scheduling a retry while attempts remain.
+
+        :param task_id: the failed task.
+        :param error: description of the failure.
+        """
+        with self._transaction() as db:
+            (attempts,) = db.execute(
+                "SELECT attempts FROM tasks WHERE id = ?", (task_id,)
+            ).fetchone()
+            if attempts < self.max_attempts:
+                delay = self.retry_delay * 2 ** (attempts - 1)
+                db.execute(
+                    "UPDATE tasks SET status = 'pending', error = ?, "
+                    "available_at = ? WHERE id = ?",
+                    (error, time.time() + delay, task_id),
+                )
+            else:
+                db.execute(
+                    "UPDATE tasks SET status = 'failed', error = ? "
+                    "WHERE id = ?",
+                    (error, task_id),
+                )
+
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Progress of a job.
+
+        :param job_id: the job id.
+        :return: file counts per status, pages indexed and failed files,
+            or None for an unknown job.
+        """
+        with self._transaction(immediate=False) as db:
+            job = db.execute(
+                "SELECT * FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if job is None:
+                return None
+            counts = {
+                row["status"]: row["files"]
+                for row in db.execute(
+                    "SELECT status, COUNT(*) AS files FROM tasks "
+                    "WHERE job_id = ? GROUP BY status",
+                    (job_id,),
+                )
+            }
+            (pages,) = db.execute(
+                "SELECT COALESCE(SUM(result), 0) FROM tasks WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+            failures = [
+                dict(row)
+                for row in db.execute(
+                    "SELECT file_path, attempts, error FROM tasks "
+                    "WHERE job_id = ? AND status = 'failed'",
+                    (job_id,),
+                )
+            ]
+        files = {
+            status: counts.get(status, 0)
+            for status in ("pending", "running", "done", "failed")
+        }
+        if files["pending"] or files["running"]:
+            state = (
+                "running" if files["running"] or files["done"] else "queued"
+            )
+        else:
+            state = "failed" if files["failed"] else "done"
+        return {
+            "job_id": job_id,
+            "action": job["action"],
+            "unique_id": job["unique_id"],
+            "status": state,
+            "total_files": sum(files.values()),
+            "files": files,
+            "pages_indexed": pages,
+            "failures": failures,
+        }
+
+
+class JobWorkerPool:
+    """
+    Threads that claim queued tasks and run the handler for their action.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        handlers: Dict[str, Callable[[Dict[str, Any]], Any]],
+        workers: int = JOBS_MAX_WORKERS,
+        poll_interval: float = JOBS_POLL_INTERVAL,
+    ) -> None:
+        self.queue = queue
+        self.handlers = handlers
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, name=f"ingest-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop claiming tasks and wait for the running ones to finish.
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def run_once(self) -> bool:
+        """
+        Process a single task.
+
+        :return: False when there was nothing to do.
+        """
+        task = self.queue.claim()
+        if task is None:
+            return False
+        event = {
+            "file_path": task["file_path"],
+            "unique_id": task["unique_id"],
+        }
+        try:
+            result = self.handlers[task["action"]](event)
+        except Exception as e:
+            logging.exception(
+                f"Attempt {task['attempts']} failed for {task['file_path']}"
+            )
+            self.queue.fail(task["id"], repr(e))
+        else:
+            self.queue.complete(task["id"], result)
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                busy = self.run_once()
+            except sqlite3.Error:
+                logging.exception("Job queue unavailable")
+                busy = False
+            if not busy:
+                self._stop.wait(self.poll_interval)
+
+
+def main() -> None:
+    """
+    Run a standalone worker pool, for ingesting outside the API process.
+    """
+    from aws_rag_quickstart.IngestionLambda import main as vectorstore
+
+    pool = JobWorkerPool(JobQueue(), {"ingest": vectorstore})
+    pool.start()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pool.stop()
+
+
+if __name__ == "__main__":
+    main()
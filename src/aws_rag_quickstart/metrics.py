@@ -0,0 +1,290 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# log finished spans, as JSON lines on the aws_rag_quickstart.trace logger
+TRACE_SPANS = bool(int(os.getenv("TRACE_SPANS", "1")))
+# histogram buckets in seconds, from a cache hit to a long generation
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+Labels = Tuple[Tuple[str, str], ...]
+trace_logger = logging.getLogger("aws_rag_quickstart.trace")
+# (trace id, span id) of the span the current code runs in
+_current_span: contextvars.ContextVar[Optional[Tuple[str, str]]] = (
+    contextvars.ContextVar("current_span", default=None)
+)
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_bound(bound: float) -> str:
+    """Bucket bound as an ``le`` label, the same for ints and floats."""
+    return repr(float(bound))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f'{key}="{value}"'.replace("\n", " ") for key, value in labels
+    )
+    return f"{{{pairs}}}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(_labels(labels), 0)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # per label set: bucket counts, sum, count
+        self._values: Dict[Labels, Tuple[List[int], float, int]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def count(self, **labels: Any) -> int:
+        return self._values.get(_labels(labels), ([], 0.0, 0))[2]
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket in zip(self.buckets, counts):
+                    bucket_labels = _format_labels(
+                        labels + (("le", _format_bound(bound)),)
+                    )
+                    lines.append(f"{self.name}_bucket{bucket_labels} {bucket}")
+                inf_labels = _format_labels(labels + (("le", "+Inf"),))
+                lines.append(f"{self.name}_bucket{inf_labels} {count}")
+                lines.append(
+                    f"{self.name}_sum{_format_labels(labels)} {total}"
+                )
+                lines.append(
+                    f"{self.name}_count{_format_labels(labels)} {count}"
+                )
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "rag_stage_seconds", "Time spent in each stage of ingestion and chat."
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "rag_time_to_first_token_seconds",
+    "Time from receiving a question to the first answer token.",
+)
+PAGE_IMAGE_BYTES = Histogram(
+    "rag_page_image_bytes",
+    "Encoded size of the page images sent to the vision model.",
+    buckets=(2**14, 2**16, 2**17, 2**18, 2**19, 2**20, 2**21, 2**22),
+)
+LLM_TOKENS = Counter(
+    "rag_llm_tokens_total", "Tokens sent to and generated by the models."
+)
+PAGES = Counter("rag_pages_total", "Ingested pages by outcome.")
+CACHE_REQUESTS = Counter("rag_cache_requests_total", "Cache lookups.")
+METRICS = (
+    STAGE_SECONDS,
+    TIME_TO_FIRST_TOKEN,
+    PAGE_IMAGE_BYTES,
+    LLM_TOKENS,
+    PAGES,
+    CACHE_REQUESTS,
+)
+
+
+def render() -> str:
+    """
+    Every metric in the Prometheus text exposition format.
+    """
+    lines = [line for metric in METRICS for line in metric.render()]
+    return "\n".join(lines) + "\n"
+
+
+def _emit(
+    stage: str,
+    trace_id: str,
+    span_id: str,
+    parent_id: Optional[str],
+    started: float,
+    duration: float,
+    attributes: Dict[str, Any],
+) -> None:
+    STAGE_SECONDS.observe(duration, stage=stage)
+    if TRACE_SPANS and trace_logger.isEnabledFor(logging.DEBUG):
+        trace_logger.debug(
+            json.dumps(
+                {
+                    "trace_id": trace_id,
+                    "span_id": span_id,
+                    "parent_id": parent_id,
+                    "name": stage,
+                    "start": started,
+                    "duration_ms": round(duration * 1000, 3),
+                    "attributes": attributes,
+                },
+                default=str,
+            )
+        )
+
+
+@contextmanager
+def span(stage: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Time a stage, recording it in ``rag_stage_seconds`` and as a span.
+
+    Spans opened inside the block, including in threads started with a
+    copy of the context, become its children.
+
+    :param stage: stage name.
+    :param attributes: span attributes, more can be added to the yielded
+        dict.
+    """
+    parent = _current_span.get()
+    trace_id = parent[0] if parent else uuid.uuid4().hex
+    span_id = uuid.uuid4().hex[:16]
+    token = _current_span.set((trace_id, span_id))
+    started = time.time()
+    clock = time.perf_counter()
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes["error"] = repr(e)
+        raise
+    finally:
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # an async generator closed from another task's context
+            pass
+        _emit(
+            stage,
+            trace_id,
+            span_id,
+            parent[1] if parent else None,
+            started,
+            time.perf_counter() - clock,
+            attributes,
+        )
+
+
+def record_tokens(stage: str, message: Any) -> None:
+    """
+    Count the tokens reported in a model response's usage metadata.
+    """
+    usage = getattr(message, "usage_metadata", None)
+    if not isinstance(usage, dict):
+        return
+    for kind in ("input", "output"):
+        tokens = usage.get(f"{kind}_tokens")
+        if tokens:
+            LLM_TOKENS.inc(tokens, stage=stage, kind=kind)
+
+
+class LLMMetrics(BaseCallbackHandler):
+    """
+    Times model calls of a chain as spans of the given stage and counts
+    their tokens.
+    """
+
+    def __init__(self, stage: str) -> None:
+        self.stage = stage
+        self._runs: Dict[
+            Any, Tuple[float, float, Optional[Tuple[str, str]]]
+        ] = {}
+
+    def on_chat_model_start(
+        self, serialized: Any, messages: Any, *, run_id: Any, **kwargs: Any
+    ) -> None:
+        self._runs[run_id] = (
+            time.time(),
+            time.perf_counter(),
+            _current_span.get(),
+        )
+
+    def on_llm_end(self, response: Any, *, run_id: Any, **kwargs: Any) -> None:
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        started, clock, parent = run
+        for generations in response.generations:
+            for generation in generations:
+                record_tokens(self.stage, getattr(generation, "message", None))
+        _emit(
+            self.stage,
+            parent[0] if parent else uuid.uuid4().hex,
+            uuid.uuid4().hex[:16],
+            parent[1] if parent else None,
+            started,
+            time.perf_counter() - clock,
+            {},
+        )
+
+    def on_llm_error(self, error: Any, *, run_id: Any, **kwargs: Any) -> None:
+        self._runs.pop(run_id, None)
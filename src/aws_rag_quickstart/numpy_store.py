@@ -0,0 +1,626 @@
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+from aws_rag_quickstart.constants import (
+    OS_INDEX_NAME,
+    OS_LIST_PAGE_SIZE,
+    RETRIEVAL_K,
+)
+from aws_rag_quickstart.vector_store import VectorStore
+
+# directory of the in-process store, one vector and one metadata file per
+# index
+VECTOR_STORE_PATH = os.getenv(
+    "VECTOR_STORE_PATH",
+    os.path.join(tempfile.gettempdir(), "aws_rag_quickstart", "vectors"),
+)
+# inverted file lists searched instead of every vector, 0 for brute force
+NUMPY_IVF_LISTS = int(os.getenv("NUMPY_IVF_LISTS", "0"))
+# lists probed per query
+NUMPY_IVF_PROBES = int(os.getenv("NUMPY_IVF_PROBES", "8"))
+# fewest vectors per list before the inverted file is used
+IVF_MIN_PER_LIST = 39
+# relative change in the number of vectors after which the lists are
+# retrained; until then new vectors join their nearest list
+NUMPY_IVF_RETRAIN_DRIFT = float(os.getenv("NUMPY_IVF_RETRAIN_DRIFT", "0.5"))
+# rows the vector file grows by at least
+MIN_CAPACITY = 1024
+# source fields used to detect changed pages
+INDEXED_PAGE_FIELDS = ("page_number", "page_hash", "source_etag", "page_count")
+# file paths per DELETE statement, under SQLite's bound parameter limit
+DELETE_BATCH = 500
+# finished deletes kept for delete_status
+DELETE_TASKS_KEPT = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO settings VALUES ('generation', 0);
+CREATE TABLE IF NOT EXISTS docs (
+    id TEXT PRIMARY KEY,
+    row INTEGER NOT NULL UNIQUE,
+    unique_id TEXT,
+    file_path TEXT,
+    source TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS docs_file ON docs (file_path, unique_id);
+CREATE INDEX IF NOT EXISTS docs_unique_id ON docs (unique_id);
+CREATE TABLE IF NOT EXISTS delete_tasks (
+    id TEXT PRIMARY KEY,
+    deleted INTEGER NOT NULL
+);
+"""
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    In-process vector store, for local runs, tests and small tenants.
+
+    Vectors live in a memory-mapped float32 matrix, one row per page, and
+    are searched by inner product with NumPy, either exhaustively or
+    through an inverted file of NUMPY_IVF_LISTS k-means lists. Page
+    metadata lives in a SQLite file next to the matrix. Every write bumps
+    a generation counter, so other processes sharing the files reload
+    their view before their next read.
+    """
+
+    def __init__(
+        self,
+        index_name: str = OS_INDEX_NAME,
+        path: str = VECTOR_STORE_PATH,
+        ivf_lists: int = NUMPY_IVF_LISTS,
+        ivf_probes: int = NUMPY_IVF_PROBES,
+    ) -> None:
+        self.index_name = index_name
+        self.ivf_lists = ivf_lists
+        self.ivf_probes = ivf_probes
+        os.makedirs(path, exist_ok=True)
+        self._db_path = os.path.join(path, f"{index_name}.db")
+        self._vectors_path = os.path.join(path, f"{index_name}.f32")
+        self._lock = threading.RLock()
+        self._generation = -1
+        self._dimension = 0
+        self._matrix: Optional["np.memmap[Any, np.dtype[np.float32]]"] = None
+        self._ids: List[Optional[str]] = []
+        # unique id of each row as an integer code, for vectorised filters
+        self._uid_codes = np.empty(0, dtype=np.int32)
+        self._codes: Dict[Optional[str], int] = {}
+        self._live = np.zeros(0, dtype=bool)
+        self._centroids: Optional[npt.NDArray[np.float32]] = None
+        self._lists = np.empty(0, dtype=np.int32)
+        # live vectors the centroids were trained on
+        self._trained_size = 0
+        # whether rows may have changed without joining their list
+        self._lists_stale = True
+        db = sqlite3.connect(self._db_path, timeout=30)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaction(
+        self, immediate: bool = True
+    ) -> Iterator[sqlite3.Connection]:
+        db = sqlite3.connect(self._db_path, timeout=30, isolation_level=None)
+        try:
+            # writers hold the lock while they touch the vector file
+            db.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            self._sync(db)
+            yield db
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            self._generation = -1
+            raise
+        finally:
+            db.close()
+
+    def _setting(self, db: sqlite3.Connection, key: str) -> int:
+        row = db.execute(
+            "SELECT value FROM settings WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _sync(self, db: sqlite3.Connection) -> None:
+        generation = self._setting(db, "generation")
+        if generation == self._generation:
+            return
+        self._dimension = self._setting(db, "dimension")
+        rows = db.execute("SELECT id, row, unique_id FROM docs").fetchall()
+        self._matrix = None
+        capacity = 0
+        if self._dimension and os.path.exists(self._vectors_path):
+            capacity = os.path.getsize(self._vectors_path) // (
+                4 * self._dimension
+            )
+        size = max([capacity] + [row + 1 for _, row, _ in rows])
+        self._ids = [None] * size
+        self._uid_codes = np.full(size, -1, dtype=np.int32)
+        self._live = np.zeros(size, dtype=bool)
+        for doc_id, row, unique_id in rows:
+            self._ids[row] = doc_id
+            self._uid_codes[row] = self._code(unique_id)
+            self._live[row] = True
+        if capacity:
+            self._matrix = np.memmap(
+                self._vectors_path,
+                dtype=np.float32,
+                mode="r+",
+                shape=(capacity, self._dimension),
+            )
+        # another process may have changed any row: keep the centroids but
+        # reassign the rows to them before the next search
+        self._lists_stale = True
+        if (
+            self._centroids is not None
+            and self._centroids.shape[1] != self._dimension
+        ):
+            self._centroids = None
+        self._generation = generation
+
+    def _bump(self, db: sqlite3.Connection) -> None:
+        db.execute(
+            "UPDATE settings SET value = value + 1 WHERE key = 'generation'"
+        )
+        self._generation = self._setting(db, "generation")
+
+    def _grow(self, rows: int) -> None:
+        capacity = 0 if self._matrix is None else self._matrix.shape[0]
+        if rows <= capacity:
+            return
+        capacity = max(rows, 2 * capacity, MIN_CAPACITY)
+        if self._matrix is not None:
+            self._matrix.flush()
+            self._matrix = None
+        with open(self._vectors_path, "ab") as f:
+            f.truncate(capacity * self._dimension * 4)
+        self._matrix = np.memmap(
+            self._vectors_path,
+            dtype=np.float32,
+            mode="r+",
+            shape=(capacity, self._dimension),
+        )
+        grown = capacity - len(self._ids)
+        self._ids += [None] * grown
+        self._uid_codes = np.concatenate(
+            [self._uid_codes, np.full(grown, -1, dtype=np.int32)]
+        )
+        self._live = np.concatenate([self._live, np.zeros(grown, bool)])
+        if not self._lists_stale:
+            self._lists = np.concatenate(
+                [self._lists, np.full(grown, -1, dtype=np.int32)]
+            )
+
+    def _code(self, unique_id: Optional[str]) -> int:
+        return self._codes.setdefault(unique_id, len(self._codes))
+
+    def _free_row(self) -> int:
+        free = np.flatnonzero(~self._live)
+        if len(free):
+            return int(free[0])
+        self._grow(len(self._ids) + 1)
+        return int(np.flatnonzero(~self._live)[0])
+
+    def exists(self) -> bool:
+        with self._lock, self._transaction(immediate=False):
+            return bool(self._dimension)
+
+    def create(self, embeddings: Any) -> Any:
+        dimension = int(embeddings.dimension)
+        with self._lock, self._transaction() as db:
+            if self._dimension:
+                raise ValueError(f"Index {self.index_name} already exists")
+            db.execute(
+                "INSERT OR REPLACE INTO settings VALUES ('dimension', ?)",
+                (dimension,),
+            )
+            self._bump(db)
+            self._dimension = dimension
+        return {"acknowledged": True, "index": self.index_name}
+
+    def bulk(
+        self, body: List[Dict[str, Any]], refresh: Optional[str] = None
+    ) -> Dict[str, Any]:
+        items = []
+        with self._lock, self._transaction() as db:
+            i = 0
+            while i < len(body):
+                op, meta = next(iter(body[i].items()))
+                source = body[i + 1] if op in ("index", "update") else None
+                i += 2 if source is not None else 1
+                doc_id = meta.get("_id") or uuid.uuid4().hex
+                result = getattr(self, f"_{op}")(db, doc_id, source)
+                items.append({op: dict(result, _id=doc_id)})
+            if self._matrix is not None:
+                self._matrix.flush()
+            self._bump(db)
+        errors = any("error" in next(iter(item.values())) for item in items)
+        return {"errors": errors, "items": items}
+
+    def _index(
+        self, db: sqlite3.Connection, doc_id: str, source: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        document = dict(source)
+        vector = document.pop("embedding", None)
+        if vector is None or len(vector) != self._dimension:
+            return {
+                "status": 400,
+                "error": {
+                    "type": "mapper_parsing_exception",
+                    "reason": f"embedding must have {self._dimension} values",
+                },
+            }
+        found = db.execute(
+            "SELECT row FROM docs WHERE id = ?", (doc_id,)
+        ).fetchone()
+        row = found[0] if found else self._free_row()
+        matrix, centroids = self._matrix, self._centroids
+        assert matrix is not None
+        matrix[row] = np.asarray(vector, dtype=np.float32)
+        if centroids is not None and not self._lists_stale:
+            self._lists[row] = np.argmax(centroids @ matrix[row])
+        db.execute(
+            "INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?)",
+            (
+                doc_id,
+                row,
+                document.get("unique_id"),
+                document.get("file_path"),
+                json.dumps(document, default=str),
+            ),
+        )
+        self._ids[row] = doc_id
+        self._uid_codes[row] = self._code(document.get("unique_id"))
+        self._live[row] = True
+        return {"status": 200 if found else 201}
+
+    def _update(
+        self, db: sqlite3.Connection, doc_id: str, source: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        found = db.execute(
+            "SELECT row, source FROM docs WHERE id = ?", (doc_id,)
+        ).fetchone()
+        if found is None:
+            return {
+                "status": 404,
+                "error": {"type": "document_missing_exception"},
+            }
+        document = json.loads(found[1])
+        document.update(source["doc"])
+        document.pop("embedding", None)
+        db.execute(
+            "UPDATE docs SET unique_id = ?, file_path = ?, source = ? "
+            "WHERE id = ?",
+            (
+                document.get("unique_id"),
+                document.get("file_path"),
+                json.dumps(document, default=str),
+                doc_id,
+            ),
+        )
+        self._uid_codes[found[0]] = self._code(document.get("unique_id"))
+        return {"status": 200}
+
+    def _delete(
+        self, db: sqlite3.Connection, doc_id: str, source: None
+    ) -> Dict[str, Any]:
+        found = db.execute(
+            "SELECT row FROM docs WHERE id = ?", (doc_id,)
+        ).fetchone()
+        if found is None:
+            return {"status": 404, "result": "not_found"}
+        db.execute("DELETE FROM docs WHERE id = ?", (doc_id,))
+        self._ids[found[0]] = None
+        self._live[found[0]] = False
+        return {"status": 200, "result": "deleted"}
+
+    def refresh(self) -> None:
+        """Writes are visible once committed, nothing to do."""
+
+    def indexed_pages(
+        self, unique_id: Optional[str], file_path: str
+    ) -> Dict[str, Dict[str, Any]]:
+        # the same file indexed under another unique_id is another document
+        query = "SELECT id, source FROM docs WHERE file_path = ?"
+        args: List[Any] = [file_path]
+        if unique_id is None:
+            query += " AND unique_id IS NULL"
+        else:
+            query += " AND unique_id = ?"
+            args.append(unique_id)
+        with self._lock, self._transaction(immediate=False) as db:
+            rows = db.execute(query, args).fetchall()
+        pages = {}
+        for doc_id, source in rows:
+            document = json.loads(source)
+            pages[doc_id] = {
+                field: document[field]
+                for field in INDEXED_PAGE_FIELDS
+                if field in document
+            }
+        return pages
+
+    def delete_files(
+        self,
+        file_paths: Optional[List[str]] = None,
+        unique_id: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Delete synchronously, recording the result under a task id so
+        callers poll the same way as with OpenSearch.
+        """
+        if file_paths is None and unique_id is None:
+            raise ValueError("Deleting needs file paths or a unique id")
+        batches: List[Optional[List[str]]] = [None]
+        if file_paths is not None:
+            batches = []
+            for start in range(0, len(file_paths), DELETE_BATCH):
+                end = start + DELETE_BATCH
+                batches.append(list(file_paths[start:end]))
+        task_id = uuid.uuid4().hex
+        deleted = 0
+        with self._lock, self._transaction() as db:
+            for batch in batches:
+                where, params = self._delete_filter(batch, unique_id)
+                rows = db.execute(
+                    f"SELECT row FROM docs WHERE {where}", params
+                ).fetchall()
+                db.execute(f"DELETE FROM docs WHERE {where}", params)
+                for (row,) in rows:
+                    self._ids[row] = None
+                    self._live[row] = False
+                deleted += len(rows)
+            db.execute(
+                "INSERT INTO delete_tasks (id, deleted) VALUES (?, ?)",
+                (task_id, deleted),
+            )
+            db.execute(
+                "DELETE FROM delete_tasks WHERE rowid <= "
+                "(SELECT MAX(rowid) FROM delete_tasks) - ?",
+                (DELETE_TASKS_KEPT,),
+            )
+            self._bump(db)
+        return {"task_id": task_id}
+
+    @staticmethod
+    def _delete_filter(
+        file_paths: Optional[List[str]], unique_id: Optional[str]
+    ) -> Tuple[str, Tuple[Any, ...]]:
+        conditions, params = [], []
+        if file_paths is not None:
+            conditions.append(
+                f"file_path IN ({', '.join('?' * len(file_paths))})"
+            )
+            params.extend(file_paths)
+        if unique_id is not None:
+            conditions.append("unique_id = ?")
+            params.append(unique_id)
+        return " AND ".join(conditions), tuple(params)
+
+    def delete_status(self, task_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock, self._transaction(immediate=False) as db:
+            row = db.execute(
+                "SELECT deleted FROM delete_tasks WHERE id = ?", (task_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "task_id": task_id,
+            "completed": True,
+            "deleted": row[0],
+            "total": row[0],
+            "failures": [],
+        }
+
+    def iter_files(
+        self,
+        unique_ids: Optional[List[str]] = None,
+        page_size: int = OS_LIST_PAGE_SIZE,
+    ) -> Iterator[Dict[str, Any]]:
+        scope: Tuple[str, ...] = tuple(unique_ids or ())
+        where = "unique_id IS NOT NULL AND file_path IS NOT NULL"
+        if scope:
+            where += f" AND unique_id IN ({', '.join('?' * len(scope))})"
+        last: Tuple[str, ...] = ()
+        while True:
+            # keyset pagination, the lock is not held between pages
+            after = " AND (unique_id, file_path) > (?, ?)" if last else ""
+            with self._lock, self._transaction(immediate=False) as db:
+                rows = db.execute(
+                    f"SELECT unique_id, file_path, COUNT(*) FROM docs "
+                    f"WHERE {where}{after} GROUP BY unique_id, file_path "
+                    f"ORDER BY unique_id, file_path LIMIT ?",
+                    scope + last + (page_size,),
+                ).fetchall()
+            for unique_id, file_path, pages in rows:
+                yield {
+                    "unique_id": unique_id,
+                    "file_path": file_path,
+                    "pages": pages,
+                }
+            if len(rows) < page_size:
+                return
+            last = tuple(rows[-1][:2])
+
+    def docs_by_id(self, unique_ids: List[str]) -> Dict[str, Any]:
+        if not unique_ids:
+            return {"num_pages": 0, "num_files": 0, "docs_list": []}
+        placeholders = ", ".join("?" * len(unique_ids))
+        with self._lock, self._transaction(immediate=False) as db:
+            (num_pages,) = db.execute(
+                f"SELECT COUNT(*) FROM docs "
+                f"WHERE unique_id IN ({placeholders})",
+                tuple(unique_ids),
+            ).fetchone()
+            files = db.execute(
+                f"SELECT DISTINCT file_path FROM docs "
+                f"WHERE unique_id IN ({placeholders}) ORDER BY file_path",
+                tuple(unique_ids),
+            ).fetchall()
+        return {
+            "num_pages": num_pages,
+            "num_files": len(files),
+            "docs_list": [file_path for (file_path,) in files],
+        }
+
+    def has_docs(self, unique_ids: List[str]) -> bool:
+        if not unique_ids:
+            return False
+        placeholders = ", ".join("?" * len(unique_ids))
+        with self._lock, self._transaction(immediate=False) as db:
+            row = db.execute(
+                f"SELECT 1 FROM docs WHERE unique_id IN ({placeholders}) "
+                f"LIMIT 1",
+                tuple(unique_ids),
+            ).fetchone()
+        return row is not None
+
+    def embeddings(self, doc_ids: List[str]) -> Dict[str, List[float]]:
+        if not doc_ids:
+            return {}
+        placeholders = ", ".join("?" * len(doc_ids))
+        with self._lock, self._transaction(immediate=False) as db:
+            matrix = self._matrix
+            if matrix is None:
+                return {}
+            rows = db.execute(
+                f"SELECT id, row FROM docs WHERE id IN ({placeholders})",
+                tuple(doc_ids),
+            ).fetchall()
+            return {doc_id: matrix[row].tolist() for doc_id, row in rows}
+
+    def knn_search(
+        self,
+        vector: List[float],
+        unique_ids: List[str],
+        k: int = RETRIEVAL_K,
+        include_embedding: bool = False,
+    ) -> Dict[str, Any]:
+        query = np.asarray(vector, dtype=np.float32)
+        with self._lock, self._transaction(immediate=False) as db:
+            hits: List[Dict[str, Any]] = []
+            matrix = self._matrix
+            if matrix is not None:
+                wanted = [
+                    self._codes[uid]
+                    for uid in unique_ids
+                    if uid in self._codes
+                ]
+                in_scope = np.isin(self._uid_codes, wanted)
+                rows = np.flatnonzero(self._live & in_scope)
+                rows = self._probe(rows, query)
+                scores = matrix[rows] @ query
+                if len(rows) > k:
+                    top = np.argpartition(-scores, k - 1)[:k]
+                    rows, scores = rows[top], scores[top]
+                order = np.argsort(-scores, kind="stable")
+                hits = self._hits(db, rows[order], scores[order])
+                for hit in hits:
+                    row = hit.pop("_row")
+                    if include_embedding:
+                        hit["_source"]["embedding"] = matrix[row].tolist()
+        return {
+            "hits": {
+                "total": {"value": len(hits), "relation": "eq"},
+                "max_score": hits[0]["_score"] if hits else None,
+                "hits": hits,
+            }
+        }
+
+    def _hits(
+        self,
+        db: sqlite3.Connection,
+        rows: npt.NDArray[np.intp],
+        scores: npt.NDArray[np.float32],
+    ) -> List[Dict[str, Any]]:
+        if not len(rows):
+            return []
+        placeholders = ", ".join("?" * len(rows))
+        sources = dict(
+            db.execute(
+                f"SELECT row, source FROM docs WHERE row IN ({placeholders})",
+                tuple(int(row) for row in rows),
+            ).fetchall()
+        )
+        return [
+            {
+                "_index": self.index_name,
+                "_id": self._ids[row],
+                "_score": float(score),
+                "_source": json.loads(sources[int(row)]),
+                "_row": int(row),
+            }
+            for row, score in zip(rows, scores)
+        ]
+
+    def _probe(
+        self, rows: npt.NDArray[np.intp], query: npt.NDArray[np.float32]
+    ) -> npt.NDArray[np.intp]:
+        """
+        Restrict candidate rows to the inverted lists nearest the query.
+        """
+        if self.ivf_lists <= 0:
+            return rows
+        live = np.flatnonzero(self._live)
+        if len(live) < max(self.ivf_lists, 1) * IVF_MIN_PER_LIST:
+            return rows
+        drift = abs(len(live) - self._trained_size) / max(
+            self._trained_size, 1
+        )
+        if self._centroids is None or drift > NUMPY_IVF_RETRAIN_DRIFT:
+            self._train(live)
+        elif self._lists_stale:
+            self._assign(live)
+        centroids = self._centroids
+        assert centroids is not None
+        nearest = np.argsort(-(centroids @ query))[: self.ivf_probes]
+        return rows[np.isin(self._lists[rows], nearest)]
+
+    def _train(self, live: npt.NDArray[np.intp], iterations: int = 10) -> None:
+        """
+        Cluster the live vectors into ivf_lists lists with k-means.
+        """
+        assert self._matrix is not None
+        vectors = np.asarray(self._matrix[live])
+        rng = np.random.default_rng(0)
+        centroids = vectors[
+            rng.choice(len(vectors), self.ivf_lists, replace=False)
+        ]
+        for _ in range(iterations):
+            assigned = np.argmax(vectors @ centroids.T, axis=1)
+            for i in range(self.ivf_lists):
+                members = vectors[assigned == i]
+                if len(members):
+                    centroids[i] = members.mean(axis=0)
+        self._centroids = centroids
+        self._trained_size = len(live)
+        self._assign(live)
+        logging.info(
+            f"Trained {self.ivf_lists} inverted lists on {len(live)} vectors"
+        )
+
+    def _assign(self, live: npt.NDArray[np.intp]) -> None:
+        """
+        Put every live vector in the list of its nearest centroid.
+        """
+        matrix, centroids = self._matrix, self._centroids
+        assert matrix is not None and centroids is not None
+        self._lists = np.full(len(self._ids), -1, dtype=np.int32)
+        self._lists[live] = np.argmax(
+            np.asarray(matrix[live]) @ centroids.T, axis=1
+        )
+        self._lists_stale = False
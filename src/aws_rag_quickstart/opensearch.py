@@ -1,11 +1,40 @@
+import hashlib
+import json
 import logging
 import os
-from typing import Any, Dict, List
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
-from opensearchpy import OpenSearch, RequestsHttpConnection
+from opensearchpy import NotFoundError, OpenSearch, RequestsHttpConnection
 
 from aws_rag_quickstart.AWSAuth import get_aws_auth
-from aws_rag_quickstart.constants import OS_HOST, OS_INDEX_NAME, OS_PORT
+from aws_rag_quickstart.constants import (
+    INDEX_PROFILE,
+    KNN_EF_SEARCH,
+    OS_BULK_MAX_BYTES,
+    OS_BULK_MAX_DOCS,
+    OS_BULK_REFRESH,
+    OS_COMPRESSION_LEVEL,
+    OS_HNSW_EF_CONSTRUCTION,
+    OS_HNSW_EF_SEARCH,
+    OS_HNSW_M,
+    OS_HOST,
+    OS_INDEX_NAME,
+    OS_LIST_PAGE_SIZE,
+    OS_MANIFEST_MAX_FILES,
+    OS_MAX_PAGES,
+    OS_POOL_MAXSIZE,
+    OS_PORT,
+    RETRIEVAL_K,
+    RRF_K,
+    RRF_KNN_WEIGHT,
+    RRF_LEXICAL_WEIGHT,
+)
+from aws_rag_quickstart.metrics import span
+from aws_rag_quickstart.vector_store import LexicalVectorStore, VectorStore
+
+_clients: Dict[Tuple[str, str, bool], OpenSearch] = {}
+_clients_lock = threading.Lock()
 
 
 def get_opensearch_connection(os_host: str, os_port: str) -> OpenSearch:
@@ -25,10 +54,32 @@ def get_opensearch_connection(os_host: str, os_port: str) -> OpenSearch:
         use_ssl=use_ssl,
         verify_certs=verify_certs,
         connection_class=RequestsHttpConnection,
-        pool_maxsize=20,
+        pool_maxsize=OS_POOL_MAXSIZE,
     )
 
 
+def get_opensearch_client(
+    os_host: str = OS_HOST, os_port: str = OS_PORT
+) -> OpenSearch:
+    """
+    Shared, thread-safe client per (host, port, auth mode).
+
+    The client and its keep-alive connection pool are built once per
+    process and reused by every request.
+
+    :param os_host: OpenSearch host.
+    :param os_port: OpenSearch port.
+    :return: The OpenSearch client.
+    """
+    key = (os_host, str(os_port), bool(int(os.getenv("LOCAL", "0"))))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = get_opensearch_connection(os_host, os_port)
+            _clients[key] = client
+    return client
+
+
 def is_opensearch_connected(client: OpenSearch) -> bool:
     """
     Connectivity test
@@ -39,19 +90,64 @@ def is_opensearch_connected(client: OpenSearch) -> bool:
         return False
 
 
+def knn_vector_mapping(
+    dimension: int,
+    profile: str = INDEX_PROFILE,
+    m: int = OS_HNSW_M,
+    ef_construction: int = OS_HNSW_EF_CONSTRUCTION,
+    ef_search: int = OS_HNSW_EF_SEARCH,
+) -> Dict[str, Any]:
+    """
+    Mapping of the embedding field for an index profile.
+
+    :param dimension: embedding dimension.
+    :param profile: float32, fp16, int8 or on_disk.
+    :param m: HNSW links per node.
+    :param ef_construction: HNSW candidate list size while indexing.
+    :param ef_search: HNSW candidate list size while searching.
+    :return: the knn_vector mapping.
+    """
+    parameters: Dict[str, Any] = {
+        "ef_construction": ef_construction,
+        "ef_search": ef_search,
+        "m": m,
+    }
+    method = {
+        "name": "hnsw",
+        "space_type": "innerproduct",
+        "engine": "faiss",
+        "parameters": parameters,
+    }
+    mapping = {"type": "knn_vector", "dimension": dimension, "method": method}
+    if profile == "fp16":
+        parameters["encoder"] = {"name": "sq", "parameters": {"type": "fp16"}}
+    elif profile == "int8":
+        # lucene does not take ef_search at index level
+        del parameters["ef_search"]
+        method["engine"] = "lucene"
+        parameters["encoder"] = {"name": "sq"}
+    elif profile == "on_disk":
+        mapping.update(mode="on_disk", compression_level=OS_COMPRESSION_LEVEL)
+    elif profile != "float32":
+        raise ValueError(f"Unknown index profile {profile}")
+    return mapping
+
+
 def create_index_opensearch(
     client: OpenSearch, embeddings: Any, index_name: str
 ) -> Any:
     """
     Create Vector index .
 
+    The embedding dimension comes from the embedding model and the vector
+    encoding and HNSW parameters from INDEX_PROFILE and the OS_HNSW_*
+    settings.
+
     :param client: OS client.
     :param embeddings: Embedding function.
     :return: The response of the query.
     :param index_name: Index name.
     """
-    embedding_dim = 1536
-
     index_body = {
         "settings": {
             "index": {
@@ -61,20 +157,15 @@ def create_index_opensearch(
         "mappings": {
             "properties": {
                 "unique_id": {"type": "keyword"},
-                "embedding": {
-                    "type": "knn_vector",
-                    "dimension": embedding_dim,
-                    "method": {
-                        "name": "hnsw",
-                        "space_type": "innerproduct",
-                        "engine": "faiss",
-                        "parameters": {
-                            "ef_construction": 256,
-                            "ef_search": 256,
-                            "m": 32,
-                        },
+                "file_path": {
+                    "type": "text",
+                    "fields": {
+                        "keyword": {"type": "keyword", "ignore_above": 1024}
                     },
                 },
+                "page_hash": {"type": "keyword"},
+                "source_etag": {"type": "keyword"},
+                "embedding": knn_vector_mapping(embeddings.dimension),
             }
         },
     }
@@ -99,80 +190,687 @@ def insert_document_opensearch(
     return response
 
 
-def delete_doc(event: Dict[str, Any], *args: Any, **kwargs: Any) -> None:
-    os_index_name = os.environ["INDEX_NAME"]
-    os_host = os.environ["AOSS_URL"]
-    os_port = os.environ["AOSS_PORT"]
-    os_client = get_opensearch_connection(os_host, os_port)
+class BulkIndexer:
+    """
+    Buffer documents and write them to a vector store through _bulk.
 
-    file_path = event.get("file_path")
-    delete_documents_opensearch(os_client, os_index_name, file_path)
+    Documents are embedded with one ``embed_documents`` call per flush,
+    which happens once ``max_docs`` documents or ``max_bytes`` of source
+    (excluding embeddings) are buffered. Partial updates and deletes of
+    already indexed pages travel in the same requests.
+    Intermediate flushes never refresh the index; ``close`` flushes the
+    remainder with a single ``refresh`` for the whole file.
+    """
 
+    def __init__(
+        self,
+        store: VectorStore,
+        embeddings: Any,
+        max_docs: int = OS_BULK_MAX_DOCS,
+        max_bytes: int = OS_BULK_MAX_BYTES,
+        refresh: str = OS_BULK_REFRESH,
+    ) -> None:
+        self.store = store
+        self.index_name = store.index_name
+        self.embeddings = embeddings
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self.indexed = 0
+        self.failures: List[Dict[str, Any]] = []
+        self._buffer: List[Tuple[Dict[str, Any], Any]] = []
+        self._buffer_bytes = 0
+        self._flushed = False
 
-def delete_documents_opensearch(
-    client: OpenSearch, index_name: str, file_path: Any
-) -> Any:
+    def __enter__(self) -> "BulkIndexer":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def add(
+        self, document: Dict[str, Any], doc_id: Optional[str] = None
+    ) -> None:
+        """
+        Queue a document, flushing the buffer when it is full.
+
+        :param document: record to insert, must contain ``llm_generated``.
+        :param doc_id: document id, replacing any document with that id.
+        """
+        self._queue({"index": {"_id": doc_id}}, document)
+
+    def update(self, doc_id: str, fields: Dict[str, Any]) -> None:
+        """
+        Queue a partial update of an indexed document, without embedding.
+
+        :param doc_id: document id.
+        :param fields: fields to overwrite.
+        """
+        self._queue({"update": {"_id": doc_id}}, {"doc": fields})
+
+    def delete(self, doc_id: str) -> None:
+        """
+        Queue the removal of an indexed document.
+
+        :param doc_id: document id.
+        """
+        self._queue({"delete": {"_id": doc_id}}, None)
+
+    def _queue(
+        self, action: Dict[str, Dict[str, Any]], source: Optional[Any]
+    ) -> None:
+        meta = next(iter(action.values()))
+        meta["_index"] = self.index_name
+        if meta["_id"] is None:
+            del meta["_id"]
+        self._buffer.append((action, source))
+        self._buffer_bytes += len(json.dumps(source, default=str))
+        if (
+            len(self._buffer) >= self.max_docs
+            or self._buffer_bytes >= self.max_bytes
+        ):
+            self.flush()
+
+    def flush(self, refresh: Optional[str] = None) -> None:
+        """
+        Embed and send the buffered documents in one _bulk request.
+
+        :param refresh: refresh policy for this request, none by default.
+        """
+        if not self._buffer:
+            return
+        actions, self._buffer, self._buffer_bytes = self._buffer, [], 0
+        documents = [source for action, source in actions if "index" in action]
+        vectors = self.embeddings.embed_documents(
+            [document["llm_generated"] for document in documents]
+        )
+        for document, vector in zip(documents, vectors):
+            document["embedding"] = vector
+        body: List[Dict[str, Any]] = []
+        for action, source in actions:
+            body.append(action)
+            if source is not None:
+                body.append(source)
+        with span("index", actions=len(actions)):
+            response = self.store.bulk(body, refresh)
+        self._flushed = True
+        self._collect_failures(actions, response)
+
+    def close(self) -> Dict[str, Any]:
+        """
+        Flush what is left and make the file visible to search once.
+
+        :return: count of indexed documents and the per-item failures.
+        """
+        if self._buffer:
+            self.flush(refresh=self.refresh)
+        elif self._flushed and self.refresh not in ("false", ""):
+            self.store.refresh()
+        self._flushed = False
+        return {"indexed": self.indexed, "failures": self.failures}
+
+    def _collect_failures(
+        self, actions: List[Tuple[Dict[str, Any], Any]], response: Any
+    ) -> None:
+        items = response.get("items", [])
+        for (action, source), item in zip(actions, items):
+            op, result = next(iter(item.items()))
+            if result.get("error"):
+                document = source if op == "index" else {}
+                failure = {
+                    "file_path": document.get("file_path"),
+                    "page_number": document.get("page_number"),
+                    "status": result.get("status"),
+                    "error": result["error"],
+                }
+                if op != "index":
+                    failure.update(op=op, _id=result.get("_id"))
+                logging.error(f"Failed to index document: {failure}")
+                self.failures.append(failure)
+            elif op == "index":
+                self.indexed += 1
+
+
+def page_document_id(
+    unique_id: Optional[str], file_path: str, page_number: str
+) -> str:
+    """
+    Stable document id of a page, so re-ingesting a file overwrites it.
     """
-    Delete documents from the OpenSearch instance related to the specific file.
+    key = f"{unique_id}\0{file_path}\0{page_number}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def get_indexed_pages(
+    client: OpenSearch,
+    index_name: str,
+    unique_id: Optional[str],
+    file_path: str,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Change-detection fields of the pages already indexed for a file.
 
     :param client: The OpenSearch client.
     :param index_name: The name of the index to query.
-    :param file_path: The name of pdf file to filter on.
-    :return: The results of the query.
+    :param unique_id: unique id the file is indexed under.
+    :param file_path: the file to look up.
+    :return: page sources keyed by document id.
     """
-    query_body = {"query": {"match": {"file_path": file_path}}}
+    query: Dict[str, Any] = {
+        "filter": [{"term": {"file_path.keyword": file_path}}]
+    }
+    # the same file indexed under another unique_id is another document
+    if unique_id is None:
+        query["must_not"] = [{"exists": {"field": "unique_id"}}]
+    else:
+        query["filter"].append({"term": {"unique_id": unique_id}})
+    query_body = {
+        "size": OS_MAX_PAGES,
+        "query": {"bool": query},
+        "_source": ["page_number", "page_hash", "source_etag", "page_count"],
+    }
+    response = client.search(index=index_name, body=query_body)
+    return {hit["_id"]: hit["_source"] for hit in response["hits"]["hits"]}
 
-    response = client.delete_by_query(index=index_name, body=query_body)
-    return response
+
+def delete_files_query(
+    file_paths: Optional[List[str]] = None, unique_id: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Exact match on a set of files, a unique id, or the files of a unique id.
+    """
+    filters: List[Dict[str, Any]] = []
+    if file_paths is not None:
+        filters.append({"terms": {"file_path.keyword": list(file_paths)}})
+    if unique_id is not None:
+        filters.append({"term": {"unique_id": unique_id}})
+    if not filters:
+        raise ValueError("Deleting needs file paths or a unique id")
+    return {"bool": {"filter": filters}}
 
 
-def get_all_indexed_files_opensearch(index_name: str) -> Dict[str, Any]:
+def delete_documents_opensearch(
+    client: OpenSearch,
+    index_name: str,
+    file_paths: Optional[List[str]] = None,
+    unique_id: Optional[str] = None,
+) -> Dict[str, Any]:
     """
-    Get all indexed files from the OpenSearch instance.
+    Delete the pages of a set of files as one asynchronous, sliced
+    delete by query task.
+
+    :param client: The OpenSearch client.
+    :param index_name: The name of the index to delete from.
+    :param file_paths: files to delete, every file of the unique id if None.
+    :param unique_id: only delete pages indexed under this unique id.
+    :return: the ``task_id`` to poll with get_delete_task.
+    """
+    response = client.delete_by_query(
+        index=index_name,
+        body={"query": delete_files_query(file_paths, unique_id)},
+        conflicts="proceed",
+        refresh=True,
+        slices="auto",
+        wait_for_completion=False,
+    )
+    return {"task_id": response["task"]}
+
+
+def get_delete_task(client: OpenSearch, task_id: str) -> Dict[str, Any]:
+    """
+    Progress of a delete by query task.
+
+    :param client: The OpenSearch client.
+    :param task_id: task returned by delete_documents_opensearch.
+    :return: whether the task ``completed``, the documents ``deleted`` out
+        of ``total`` and the ``failures``.
+    """
+    response = client.tasks.get(task_id=task_id)
+    status = response.get("task", {}).get("status", {})
+    result = response.get("response", {})
+    failures = list(result.get("failures", []))
+    if response.get("error"):
+        failures.append(response["error"])
+    return {
+        "task_id": task_id,
+        "completed": bool(response.get("completed")),
+        "deleted": result.get("deleted", status.get("deleted", 0)),
+        "total": result.get("total", status.get("total", 0)),
+        "failures": failures,
+    }
+
+
+def iter_composite_buckets(
+    client: OpenSearch,
+    index_name: str,
+    sources: List[Dict[str, Any]],
+    query: Optional[Dict[str, Any]] = None,
+    page_size: int = OS_LIST_PAGE_SIZE,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Every bucket of a composite aggregation, one page of ``page_size``
+    buckets in memory at a time.
+
+    :param client: The OpenSearch client.
+    :param index_name: The name of the index to query.
+    :param sources: composite aggregation sources.
+    :param query: restricts the documents aggregated.
+    :param page_size: buckets per request.
+    :return: iterator of buckets, in key order.
+    """
+    composite: Dict[str, Any] = {"size": page_size, "sources": sources}
+    query_body: Dict[str, Any] = {
+        "size": 0,
+        "aggs": {"ids": {"composite": composite}},
+    }
+    if query is not None:
+        query_body["query"] = query
+    while True:
+        response = client.search(index=index_name, body=query_body)
+        aggregation = response.get("aggregations").get("ids")
+        buckets = aggregation.get("buckets", [])
+        yield from buckets
+        after_key = aggregation.get("after_key")
+        # a short page is the last one, no need to ask for an empty page
+        if len(buckets) < page_size or after_key is None:
+            return
+        composite["after"] = after_key
+
+
+def get_all_indexed_files_opensearch(
+    index_name: str, page_size: int = OS_LIST_PAGE_SIZE
+) -> List[Dict[str, Any]]:
+    """
+    Get all indexed unique ids from the OpenSearch instance.
 
     :param index_name: The name of the index to query
-    :return: The results of the query
+    :param page_size: buckets per request.
+    :return: one bucket per unique id, with its page count
     """
-    query_body = {
+    os_client = get_opensearch_client(OS_HOST, OS_PORT)
+    return list(
+        iter_composite_buckets(
+            os_client,
+            index_name,
+            [{"ids": {"terms": {"field": "unique_id"}}}],
+            page_size=page_size,
+        )
+    )
+
+
+def iter_indexed_files(
+    client: OpenSearch,
+    index_name: str,
+    unique_ids: Optional[List[str]] = None,
+    page_size: int = OS_LIST_PAGE_SIZE,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Stream every indexed file with its page count.
+
+    :param client: The OpenSearch client.
+    :param index_name: The name of the index to query.
+    :param unique_ids: only list files of these unique ids.
+    :param page_size: buckets per request.
+    :return: iterator of ``unique_id``, ``file_path`` and ``pages``.
+    """
+    sources = [
+        {"unique_id": {"terms": {"field": "unique_id"}}},
+        {"file_path": {"terms": {"field": "file_path.keyword"}}},
+    ]
+    query = unique_id_filter(unique_ids) if unique_ids else None
+    for bucket in iter_composite_buckets(
+        client, index_name, sources, query, page_size
+    ):
+        yield {**bucket["key"], "pages": bucket["doc_count"]}
+
+
+def manifest_query(
+    unique_ids: List[str], max_files: int = OS_MANIFEST_MAX_FILES
+) -> Dict[str, Any]:
+    """
+    Page count and file paths of the unique ids, answered from the index
+    structures alone: no hit is returned, so no ``_source`` is fetched.
+    """
+    return {
         "size": 0,
+        "track_total_hits": True,
+        "query": {"bool": {"filter": [{"terms": {"unique_id": unique_ids}}]}},
         "aggs": {
-            "ids": {
-                "composite": {
-                    "sources": [
-                        {"ids": {"terms": {"field": "unique_id.keyword"}}}
-                    ]
+            "files": {
+                "terms": {
+                    "field": "file_path.keyword",
+                    "size": max_files,
+                    "order": {"_key": "asc"},
                 }
-            }
+            },
+            "num_files": {"cardinality": {"field": "file_path.keyword"}},
         },
     }
-    os_client = get_opensearch_connection(OS_HOST, OS_PORT)
-    response = os_client.search(index=index_name, body=query_body)
 
-    return response.get("aggregations").get("ids").get("buckets")
 
+def docs_manifest(
+    client: OpenSearch, index_name: str, unique_ids: List[str]
+) -> Dict[str, Any]:
+    """
+    Pages and files indexed under the unique ids.
 
-def list_docs_by_id(unique_ids: List[str]) -> Dict[str, Any]:
-    os_client = get_opensearch_connection(OS_HOST, OS_PORT)
-    should_queries = [{"term": {"unique_id": uid}} for uid in unique_ids]
-    query_body = {
-        "size": 1000,
+    :param client: The OpenSearch client.
+    :param index_name: The name of the index to query.
+    :param unique_ids: unique ids to look up.
+    :return: ``num_pages``, ``num_files`` (approximate beyond 3000) and
+        the sorted ``docs_list`` of file paths.
+    """
+    search_response = client.search(
+        index=index_name, body=manifest_query(list(unique_ids))
+    )
+    aggregations = search_response["aggregations"]
+    docs_list = [bucket["key"] for bucket in aggregations["files"]["buckets"]]
+    num_files = aggregations["num_files"]["value"]
+    if num_files > len(docs_list):
+        logging.warning(
+            f"Listing {len(docs_list)} of ~{num_files} files for "
+            f"{unique_ids}, raise OS_MANIFEST_MAX_FILES to list them all"
+        )
+    return {
+        "num_pages": search_response["hits"]["total"]["value"],
+        "num_files": num_files,
+        "docs_list": docs_list,
+    }
+
+
+def has_docs(
+    client: OpenSearch, index_name: str, unique_ids: List[str]
+) -> bool:
+    """
+    Whether any page is indexed under the unique ids, stopping at the
+    first match on each shard.
+    """
+    response = client.search(
+        index=index_name,
+        body={
+            "size": 0,
+            "track_total_hits": 1,
+            "terminate_after": 1,
+            "query": {
+                "bool": {"filter": [{"terms": {"unique_id": unique_ids}}]}
+            },
+        },
+    )
+    return response["hits"]["total"]["value"] > 0
+
+
+def unique_id_filter(unique_ids: List[str]) -> Dict[str, Any]:
+    return {
+        "bool": {
+            "should": [{"term": {"unique_id": uid}} for uid in unique_ids],
+            "minimum_should_match": 1,
+        }
+    }
+
+
+def get_embeddings(
+    client: OpenSearch, index_name: str, doc_ids: List[str]
+) -> Dict[str, List[float]]:
+    """
+    Stored embeddings of the given pages, in one multi-get.
+
+    :param client: The OpenSearch client.
+    :param index_name: The name of the index to read.
+    :param doc_ids: document ids to look up.
+    :return: embeddings keyed by document id, missing pages left out.
+    """
+    response = client.mget(
+        index=index_name,
+        body={"docs": [{"_id": i, "_source": ["embedding"]} for i in doc_ids]},
+    )
+    return {
+        doc["_id"]: doc["_source"]["embedding"]
+        for doc in response["docs"]
+        if doc.get("found") and "embedding" in doc.get("_source", {})
+    }
+
+
+def source_filter(include_embedding: bool) -> Dict[str, Any]:
+    return {"exclude": [] if include_embedding else ["embedding"]}
+
+
+def knn_query(
+    vector: List[float],
+    unique_ids: List[str],
+    k: int = RETRIEVAL_K,
+    include_embedding: bool = False,
+    ef_search: int = KNN_EF_SEARCH,
+) -> Dict[str, Any]:
+    """
+    Nearest pages to the question embedding within the unique ids.
+
+    A positive ``ef_search`` overrides the index setting for this query.
+    """
+    knn: Dict[str, Any] = {
+        "vector": vector,
+        "k": k,
+        "filter": unique_id_filter(unique_ids),
+    }
+    if ef_search > 0:
+        knn["method_parameters"] = {"ef_search": ef_search}
+    return {
+        "size": k,
+        "query": {"knn": {"embedding": knn}},
+        "_source": source_filter(include_embedding),
+    }
+
+
+def lexical_query(
+    question: str,
+    unique_ids: List[str],
+    k: int = RETRIEVAL_K,
+    include_embedding: bool = False,
+) -> Dict[str, Any]:
+    """
+    BM25 match of the question on the page descriptions.
+    """
+    return {
+        "size": k,
         "query": {
             "bool": {
-                "should": should_queries,
-                "minimum_should_match": 1,  # At least one of the conditions must match
+                "must": [{"match": {"llm_generated": question}}],
+                "filter": [unique_id_filter(unique_ids)],
             }
         },
+        "_source": source_filter(include_embedding),
     }
-    search_response = os_client.search(
-        index=OS_INDEX_NAME,
-        body=query_body,
-    )
+
+
+def reciprocal_rank_fusion(
+    responses: List[Dict[str, Any]],
+    weights: List[float],
+    k: int = RRF_K,
+    size: int = RETRIEVAL_K,
+) -> Dict[str, Any]:
+    """
+    Merge ranked search responses with weighted reciprocal rank fusion.
+
+    A hit scores ``sum(weight / (k + rank))`` over the responses it
+    appears in, ranks starting at 1.
+
+    :param responses: search responses, best hit first.
+    :param weights: weight of each response.
+    :param k: rank offset, larger values flatten the head of each ranking.
+    :param size: hits kept.
+    :return: a search response holding the fused hits, ``_score`` being
+        the fused score.
+    """
+    scores: Dict[str, float] = {}
+    hits: Dict[str, Dict[str, Any]] = {}
+    for response, weight in zip(responses, weights):
+        for rank, hit in enumerate(response["hits"]["hits"], start=1):
+            scores[hit["_id"]] = scores.get(hit["_id"], 0.0) + weight / (
+                k + rank
+            )
+            hits.setdefault(hit["_id"], hit)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:size]
     return {
-        "num_pages": len(search_response["hits"]["hits"]),
-        "docs_list": list(
-            {
-                hit["_source"]["file_path"]
-                for hit in search_response["hits"]["hits"]
-            }
-        ),
+        "hits": {
+            "total": {"value": len(scores), "relation": "eq"},
+            "max_score": scores[ranked[0]] if ranked else None,
+            "hits": [dict(hits[i], _score=scores[i]) for i in ranked],
+        }
     }
+
+
+def hybrid_search(
+    client: OpenSearch,
+    index_name: str,
+    question: str,
+    vector: List[float],
+    unique_ids: List[str],
+    k: int = RETRIEVAL_K,
+    weights: Tuple[float, float] = (RRF_KNN_WEIGHT, RRF_LEXICAL_WEIGHT),
+    rrf_k: int = RRF_K,
+    include_embedding: bool = False,
+) -> Dict[str, Any]:
+    """
+    Run the kNN and BM25 queries in one _msearch and fuse their rankings.
+
+    A retriever that fails is logged and left out of the fusion.
+
+    :param client: The OpenSearch client.
+    :param index_name: The name of the index to query.
+    :param question: question text, for the lexical query.
+    :param vector: question embedding, for the kNN query.
+    :param unique_ids: unique ids to search within.
+    :param k: hits per retriever and in the fused result.
+    :param weights: kNN and lexical weights.
+    :param rrf_k: reciprocal rank fusion offset.
+    :param include_embedding: return the stored page embeddings.
+    :return: a search response of the fused hits.
+    """
+    queries = [
+        knn_query(vector, unique_ids, k, include_embedding),
+        lexical_query(question, unique_ids, k, include_embedding),
+    ]
+    body: List[Dict[str, Any]] = []
+    for query in queries:
+        body += [{"index": index_name}, query]
+    responses = client.msearch(body=body)["responses"]
+    ranked, ranked_weights = [], []
+    for response, weight in zip(responses, weights):
+        if "error" in response:
+            logging.error(f"Retriever failed: {response['error']}")
+            continue
+        ranked.append(response)
+        ranked_weights.append(weight)
+    return reciprocal_rank_fusion(ranked, ranked_weights, rrf_k, k)
+
+
+class OpenSearchStore(LexicalVectorStore):
+    """
+    Vector store backed by an OpenSearch index.
+    """
+
+    def __init__(self, client: OpenSearch, index_name: str = OS_INDEX_NAME):
+        self.client = client
+        self.index_name = index_name
+
+    def exists(self) -> bool:
+        return self.client.indices.exists(index=self.index_name)
+
+    def create(self, embeddings: Any) -> Any:
+        return create_index_opensearch(
+            self.client, embeddings, self.index_name
+        )
+
+    def bulk(
+        self, body: List[Dict[str, Any]], refresh: Optional[str] = None
+    ) -> Dict[str, Any]:
+        kwargs = {"refresh": refresh} if refresh else {}
+        return self.client.bulk(body=body, **kwargs)
+
+    def refresh(self) -> None:
+        self.client.indices.refresh(index=self.index_name)
+
+    def indexed_pages(
+        self, unique_id: Optional[str], file_path: str
+    ) -> Dict[str, Dict[str, Any]]:
+        return get_indexed_pages(
+            self.client, self.index_name, unique_id, file_path
+        )
+
+    def delete_files(
+        self,
+        file_paths: Optional[List[str]] = None,
+        unique_id: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        return delete_documents_opensearch(
+            self.client, self.index_name, file_paths, unique_id
+        )
+
+    def delete_status(self, task_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            return get_delete_task(self.client, task_id)
+        except NotFoundError:
+            return None
+
+    def iter_files(
+        self,
+        unique_ids: Optional[List[str]] = None,
+        page_size: int = OS_LIST_PAGE_SIZE,
+    ) -> Iterator[Dict[str, Any]]:
+        return iter_indexed_files(
+            self.client, self.index_name, unique_ids, page_size
+        )
+
+    def docs_by_id(self, unique_ids: List[str]) -> Dict[str, Any]:
+        return docs_manifest(self.client, self.index_name, unique_ids)
+
+    def has_docs(self, unique_ids: List[str]) -> bool:
+        if not unique_ids:
+            return False
+        return has_docs(self.client, self.index_name, list(unique_ids))
+
+    def embeddings(self, doc_ids: List[str]) -> Dict[str, List[float]]:
+        if not doc_ids:
+            return {}
+        return get_embeddings(self.client, self.index_name, doc_ids)
+
+    def knn_search(
+        self,
+        vector: List[float],
+        unique_ids: List[str],
+        k: int = RETRIEVAL_K,
+        include_embedding: bool = False,
+    ) -> Dict[str, Any]:
+        return self.client.search(
+            index=self.index_name,
+            body=knn_query(vector, unique_ids, k, include_embedding),
+        )
+
+    def lexical_search(
+        self,
+        question: str,
+        unique_ids: List[str],
+        k: int = RETRIEVAL_K,
+        include_embedding: bool = False,
+    ) -> Dict[str, Any]:
+        return self.client.search(
+            index=self.index_name,
+            body=lexical_query(question, unique_ids, k, include_embedding),
+        )
+
+    def hybrid_search(
+        self,
+        question: str,
+        vector: List[float],
+        unique_ids: List[str],
+        k: int = RETRIEVAL_K,
+        include_embedding: bool = False,
+    ) -> Dict[str, Any]:
+        return hybrid_search(
+            self.client,
+            self.index_name,
+            question,
+            vector,
+            unique_ids,
+            k,
+            include_embedding=include_embedding,
+        )
@@ -0,0 +1,39 @@
+import logging
+import os
+from functools import lru_cache
+
+from langchain_core.prompts import ChatPromptTemplate
+
+# optional LangChain Hub prompt to use instead of the vendored one
+RAG_PROMPT_HUB = os.getenv("RAG_PROMPT_HUB", "")
+
+# vendored copy of the "rlm/rag-prompt" hub prompt
+RAG_PROMPT_TEMPLATE = (
+    "You are an assistant for question-answering tasks. Use the following "
+    "pieces of retrieved context to answer the question. If you don't know "
+    "the answer, just say that you don't know. Use three sentences maximum "
+    "and keep the answer concise.\n"
+    "Question: {question} \n"
+    "Context: {context} \n"
+    "Answer:"
+)
+
+
+@lru_cache(maxsize=1)
+def get_rag_prompt() -> ChatPromptTemplate:
+    """
+    RAG prompt, loaded once per process.
+
+    The vendored prompt is used unless RAG_PROMPT_HUB names a hub prompt;
+    if pulling it fails the vendored prompt is used as a fallback.
+    """
+    if RAG_PROMPT_HUB:
+        try:
+            from langchain import hub
+
+            return hub.pull(RAG_PROMPT_HUB)
+        except Exception as e:
+            logging.warning(
+                f"Could not pull {RAG_PROMPT_HUB}, using vendored prompt: {e}"
+            )
+    return ChatPromptTemplate.from_messages([("human", RAG_PROMPT_TEMPLATE)])
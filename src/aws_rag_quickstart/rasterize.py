@@ -0,0 +1,184 @@
+import contextvars
+import logging
+import os
+import subprocess
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Iterable, Iterator, List, Optional, Tuple
+
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL.Image import Image
+
+from aws_rag_quickstart.metrics import span
+
+# pages rendered per pdftoppm call, bounds the images held in memory
+PDF_PAGE_WINDOW = int(os.getenv("PDF_PAGE_WINDOW", "4"))
+# rendering resolution, pixels grow with its square; 200 is pdftoppm's
+# default through pdf2image
+PDF_DPI = int(os.getenv("PDF_DPI", "200"))
+# pdftoppm processes rendering windows of one file concurrently. Every
+# file ingested at the same time runs its own, so raise it only when
+# cores are left over
+RASTER_THREADS = int(os.getenv("RASTER_THREADS", "2"))
+# windows rendered ahead of the one being consumed; with the current
+# window, bounds the pages held by the rasterizer to
+# (RASTER_PREFETCH_WINDOWS + 1) * PDF_PAGE_WINDOW. Only the windows ahead
+# can render while the current one is consumed, so values below
+# RASTER_THREADS leave threads idle; it follows RASTER_THREADS by default
+RASTER_PREFETCH_WINDOWS = int(
+    os.getenv("RASTER_PREFETCH_WINDOWS", str(RASTER_THREADS))
+)
+# seconds allowed for extracting the text layer of one file
+PDF_TEXT_TIMEOUT = int(os.getenv("PDF_TEXT_TIMEOUT", "120"))
+
+
+def pdf_page_count(pdf_path: str) -> int:
+    return int(pdfinfo_from_path(pdf_path)["Pages"])
+
+
+def pdf_page_texts(
+    pdf_path: str, page_count: int, timeout: int = PDF_TEXT_TIMEOUT
+) -> List[str]:
+    """
+    Embedded text of every page, extracted with poppler's pdftotext in a
+    single call.
+
+    Extraction errors are logged and give empty pages, which are then
+    rendered like scanned ones.
+
+    :param pdf_path: path of the PDF.
+    :param page_count: pages in the PDF.
+    :param timeout: seconds allowed for pdftotext.
+    :return: one text per page, in page order.
+    """
+    with span("text_extract", pages=page_count):
+        try:
+            result = subprocess.run(
+                ["pdftotext", "-q", "-enc", "UTF-8", pdf_path, "-"],
+                capture_output=True,
+                check=True,
+                timeout=timeout,
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            logging.warning(f"Could not extract the text layer: {e}")
+            return [""] * page_count
+    # pdftotext ends every page with a form feed
+    texts = result.stdout.decode("utf-8", errors="replace").split("\f")
+    return (texts + [""] * page_count)[:page_count]
+
+
+def page_windows(
+    pages: Iterable[int], window: int
+) -> Iterator[Tuple[int, int]]:
+    """
+    Group ascending page numbers into runs of at most ``window``
+    consecutive pages.
+
+    :return: iterator of (first page, last page).
+    """
+    first = last = 0
+    for page in pages:
+        if first and page == last + 1 and page - first < window:
+            last = page
+            continue
+        if first:
+            yield first, last
+        first = last = page
+    if first:
+        yield first, last
+
+
+def render_window(
+    pdf_path: str, dpi: int, first_page: int, last_page: int
+) -> List[Image]:
+    with span("rasterize", first_page=first_page, last_page=last_page):
+        images = convert_from_path(
+            pdf_path, dpi=dpi, first_page=first_page, last_page=last_page
+        )
+    # pages are numbered by position, a missing image would shift them
+    if len(images) != last_page - first_page + 1:
+        for image in images:
+            image.close()
+        raise RuntimeError(
+            f"Rendered {len(images)} images for pages {first_page} to "
+            f"{last_page}"
+        )
+    return images
+
+
+def iter_pdf_pages(
+    pdf_path: str,
+    window: int = PDF_PAGE_WINDOW,
+    page_count: Optional[int] = None,
+    dpi: int = PDF_DPI,
+    pages: Optional[Iterable[int]] = None,
+    threads: int = RASTER_THREADS,
+    prefetch: int = RASTER_PREFETCH_WINDOWS,
+) -> Iterator[Tuple[int, Image]]:
+    """
+    Render a PDF lazily, ``window`` pages at a time.
+
+    With several ``threads``, up to ``prefetch`` following windows are
+    rendered by up to ``threads`` concurrent pdftoppm processes while the
+    consumer handles the current one; pages are still yielded in order.
+    ``threads`` caps the processes and ``prefetch`` the memory, so
+    ``min(threads, prefetch)`` windows render while the consumer works.
+
+    The consumer owns each yielded image and should close it once it is
+    encoded, so peak memory is bounded by the window size times
+    ``prefetch + 1`` windows, plus the pages the consumer holds, rather
+    than the page count.
+
+    :param pdf_path: path of the PDF, read by pdftoppm for each window.
+    :param window: number of pages rendered per call.
+    :param page_count: pages in the PDF, read with pdfinfo when omitted.
+    :param dpi: rendering resolution.
+    :param pages: ascending 1-based page numbers to render, all by default.
+    :param threads: pdftoppm processes rendering windows concurrently.
+    :param prefetch: windows rendered ahead of the consumer, at least
+        ``threads`` to keep every thread busy.
+    :return: iterator of (1-based page number, page image).
+    """
+    if pages is None:
+        if page_count is None:
+            page_count = pdf_page_count(pdf_path)
+        pages = range(1, page_count + 1)
+    pages = list(pages)
+    logging.info(
+        f"Rendering {len(pages)} pages, {window} at a time "
+        f"on {threads} threads"
+    )
+    windows = page_windows(pages, window)
+    if threads <= 1 or prefetch <= 0:
+        for first_page, last_page in windows:
+            images = render_window(pdf_path, dpi, first_page, last_page)
+            yield from enumerate(images, start=first_page)
+            # drop this window before the next one is rendered
+            del images
+        return
+
+    in_flight: Deque[Tuple[int, "Future[List[Image]]"]] = deque()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        try:
+            for first_page, last_page in windows:
+                future = executor.submit(
+                    contextvars.copy_context().run,
+                    render_window,
+                    pdf_path,
+                    dpi,
+                    first_page,
+                    last_page,
+                )
+                in_flight.append((first_page, future))
+                # the following windows keep rendering while the oldest
+                # is consumed
+                if len(in_flight) > prefetch:
+                    first, done = in_flight.popleft()
+                    yield from enumerate(done.result(), start=first)
+            while in_flight:
+                first, done = in_flight.popleft()
+                yield from enumerate(done.result(), start=first)
+        finally:
+            # the consumer stopped early: drop the windows not yet needed
+            for _, future in in_flight:
+                future.cancel()
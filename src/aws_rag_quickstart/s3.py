@@ -0,0 +1,97 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Iterator, Optional
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+from aws_rag_quickstart.metrics import span
+
+MB = 1024**2
+# connections kept open to S3, shared by every download of the process
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "32"))
+# objects larger than this are fetched as parallel ranged GETs
+S3_MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD", str(8 * MB)))
+# bytes fetched by each ranged GET
+S3_MULTIPART_CHUNKSIZE = int(os.getenv("S3_MULTIPART_CHUNKSIZE", str(8 * MB)))
+# ranged GETs in flight for one object
+S3_MAX_CONCURRENCY = int(os.getenv("S3_MAX_CONCURRENCY", "10"))
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+    max_concurrency=S3_MAX_CONCURRENCY,
+)
+
+
+@lru_cache(maxsize=1)
+def get_s3_client() -> Any:
+    """
+    S3 client shared by every file of the process.
+
+    Reusing it keeps its connection pool warm instead of paying a new
+    session, credential lookup and TLS handshake for each file.
+    """
+    return boto3.session.Session().client(
+        "s3",
+        config=Config(
+            max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+            retries={"mode": "adaptive"},
+        ),
+    )
+
+
+@contextmanager
+def download_object(
+    s3: Any,
+    bucket: str,
+    key: str,
+    etag: Optional[str] = None,
+    version_id: Optional[str] = None,
+    transfer_config: TransferConfig = TRANSFER_CONFIG,
+) -> Iterator[str]:
+    """
+    Download an S3 object to a temporary file, removed on exit.
+
+    Large objects are fetched as parallel ranged GETs and written straight
+    to disk, so the object is never held in memory.
+
+    The download is tied to the object the caller looked at: a version id
+    is fetched as that exact version, otherwise the object is checked to
+    still have ``etag`` once downloaded, since the transfer manager does
+    not accept conditional GETs.
+
+    :param s3: S3 client.
+    :param bucket: bucket of the object.
+    :param key: key of the object.
+    :param etag: ETag the object is expected to have.
+    :param version_id: version of the object to download.
+    :param transfer_config: multipart download settings.
+    :return: path of the downloaded file.
+    """
+    extra_args = {"VersionId": version_id} if version_id else None
+    fh, path = tempfile.mkstemp(suffix=os.path.splitext(key)[1])
+    try:
+        with span("s3_download", file_path=key) as attributes:
+            with open(fh, "wb") as f:
+                s3.download_fileobj(
+                    Bucket=bucket,
+                    Key=key,
+                    Fileobj=f,
+                    ExtraArgs=extra_args,
+                    Config=transfer_config,
+                )
+            attributes["bytes"] = os.path.getsize(path)
+        if etag is not None and not version_id:
+            current = s3.head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+            if current != etag:
+                raise RuntimeError(
+                    f"{key} changed while downloading, expected ETag "
+                    f"{etag}, got {current}"
+                )
+        yield path
+    finally:
+        os.remove(path)
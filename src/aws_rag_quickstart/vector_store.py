@@ -0,0 +1,322 @@
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterator, List, Optional
+
+from aws_rag_quickstart.answer_cache import (
+    ANSWER_CACHE_HOLD_SECONDS,
+    SemanticAnswerCache,
+    get_answer_cache,
+)
+from aws_rag_quickstart.constants import (
+    OS_INDEX_NAME,
+    OS_LIST_PAGE_SIZE,
+    RETRIEVAL_K,
+)
+from aws_rag_quickstart.metrics import span
+
+# backend holding the page vectors: "opensearch" or "numpy" (in process)
+VECTOR_STORE = os.getenv("VECTOR_STORE", "opensearch")
+# seconds between checks of a running delete, to release its answer cache
+# hold as soon as it completes
+DELETE_POLL_SECONDS = float(os.getenv("DELETE_POLL_SECONDS", "2"))
+
+
+class VectorStore(ABC):
+    """
+    Storage and retrieval of page documents and their embeddings.
+
+    Writes use the OpenSearch _bulk format (``index``, ``update`` and
+    ``delete`` actions, each followed by its source when it has one) and
+    searches return OpenSearch shaped responses, so callers do not depend
+    on the backend.
+    """
+
+    index_name: str
+
+    @abstractmethod
+    def exists(self) -> bool:
+        """Whether the index has been created."""
+
+    @abstractmethod
+    def create(self, embeddings: Any) -> Any:
+        """
+        Create the index.
+
+        :param embeddings: embedding function, giving the vector dimension.
+        """
+
+    @abstractmethod
+    def bulk(
+        self, body: List[Dict[str, Any]], refresh: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Apply a batch of writes.
+
+        :param body: _bulk actions and sources.
+        :param refresh: refresh policy of the request.
+        :return: _bulk response, with one item per action.
+        """
+
+    @abstractmethod
+    def refresh(self) -> None:
+        """Make the writes so far visible to searches."""
+
+    @abstractmethod
+    def indexed_pages(
+        self, unique_id: Optional[str], file_path: str
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Change-detection fields of the pages indexed for a file.
+
+        :param unique_id: unique id the file is indexed under.
+        :param file_path: the file to look up.
+        :return: page sources keyed by document id.
+        """
+
+    @abstractmethod
+    def delete_files(
+        self,
+        file_paths: Optional[List[str]] = None,
+        unique_id: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Delete the pages of a set of files as one operation.
+
+        :param file_paths: files to delete, every file of the unique id if
+            None.
+        :param unique_id: only delete pages indexed under this unique id.
+        :return: the ``task_id`` to poll with delete_status.
+        """
+
+    @abstractmethod
+    def delete_status(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Progress of a delete.
+
+        :param task_id: task returned by delete_files.
+        :return: ``completed``, ``deleted``, ``total`` and ``failures``, or
+            None for an unknown task.
+        """
+
+    @abstractmethod
+    def iter_files(
+        self,
+        unique_ids: Optional[List[str]] = None,
+        page_size: int = OS_LIST_PAGE_SIZE,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Stream every indexed file, ordered by unique id then file path,
+        without holding the whole listing in memory.
+
+        :param unique_ids: only list files of these unique ids.
+        :param page_size: files fetched from the backend at a time.
+        :return: iterator of ``unique_id``, ``file_path`` and ``pages``.
+        """
+
+    @abstractmethod
+    def docs_by_id(self, unique_ids: List[str]) -> Dict[str, Any]:
+        """
+        Pages and files indexed under the unique ids.
+
+        :param unique_ids: unique ids to look up.
+        :return: ``num_pages``, ``num_files`` and the sorted
+            ``docs_list`` of file paths.
+        """
+
+    @abstractmethod
+    def has_docs(self, unique_ids: List[str]) -> bool:
+        """
+        Whether any page is indexed under the unique ids, cheaper than
+        docs_by_id.
+        """
+
+    @abstractmethod
+    def embeddings(self, doc_ids: List[str]) -> Dict[str, List[float]]:
+        """
+        Stored embeddings of a few pages, for the hits a search returned
+        without them.
+
+        :param doc_ids: document ids to look up.
+        :return: embeddings keyed by document id, missing pages left out.
+        """
+
+    @abstractmethod
+    def knn_search(
+        self,
+        vector: List[float],
+        unique_ids: List[str],
+        k: int = RETRIEVAL_K,
+        include_embedding: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Pages nearest to a vector, by inner product.
+
+        :param vector: query embedding.
+        :param unique_ids: unique ids to search within.
+        :param k: hits returned.
+        :param include_embedding: return the stored page embeddings.
+        :return: search response.
+        """
+
+
+class LexicalVectorStore(VectorStore):
+    """
+    Vector store that also ranks pages by their text, which callers check
+    for with isinstance before using lexical or hybrid retrieval.
+    """
+
+    @abstractmethod
+    def lexical_search(
+        self,
+        question: str,
+        unique_ids: List[str],
+        k: int = RETRIEVAL_K,
+        include_embedding: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Pages best matching the question text.
+
+        :param question: the question.
+        :param unique_ids: unique ids to search within.
+        :param k: hits returned.
+        :param include_embedding: return the stored page embeddings.
+        :return: search response.
+        """
+
+    @abstractmethod
+    def hybrid_search(
+        self,
+        question: str,
+        vector: List[float],
+        unique_ids: List[str],
+        k: int = RETRIEVAL_K,
+        include_embedding: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Lexical and vector hits merged into one ranking.
+
+        :param question: the question.
+        :param vector: question embedding.
+        :param unique_ids: unique ids to search within.
+        :param k: hits returned.
+        :param include_embedding: return the stored page embeddings.
+        :return: search response.
+        """
+
+
+_stores: Dict[str, VectorStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_vector_store(index_name: str = OS_INDEX_NAME) -> VectorStore:
+    """
+    Vector store of the configured backend.
+
+    :param index_name: index the store reads and writes.
+    :return: the store, shared by the whole process.
+    """
+    if VECTOR_STORE == "numpy":
+        from aws_rag_quickstart.numpy_store import NumpyVectorStore
+
+        with _stores_lock:
+            store = _stores.get(index_name)
+            if store is None:
+                store = NumpyVectorStore(index_name)
+                _stores[index_name] = store
+        return store
+    if VECTOR_STORE != "opensearch":
+        raise ValueError(f"Unknown vector store {VECTOR_STORE}")
+    from aws_rag_quickstart.opensearch import (
+        OpenSearchStore,
+        get_opensearch_client,
+    )
+
+    # the OpenSearch client is already shared, the wrapper is cheap
+    return OpenSearchStore(get_opensearch_client(), index_name)
+
+
+def list_docs_by_id(unique_ids: List[str]) -> Dict[str, Any]:
+    with span("list_docs", unique_ids=len(unique_ids or [])):
+        return get_vector_store().docs_by_id(unique_ids)
+
+
+def has_docs(unique_ids: List[str]) -> bool:
+    with span("has_docs", unique_ids=len(unique_ids or [])):
+        return get_vector_store().has_docs(unique_ids)
+
+
+def delete_files(
+    file_paths: Optional[List[str]] = None, unique_id: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Start deleting a set of files, or a whole unique id, and drop the
+    cached answers that may cite them.
+
+    Chats answered while the delete runs can still retrieve its pages, so
+    the answer cache holds the unique id, in every process sharing it,
+    until a background thread sees the delete complete.
+
+    :param file_paths: files to delete, every file of the unique id if None.
+    :param unique_id: only delete pages indexed under this unique id.
+    :return: the ``task_id`` to poll with delete_status.
+    """
+    store = get_vector_store()
+    result = store.delete_files(file_paths, unique_id)
+    scope = [unique_id] if unique_id else None
+    cache = get_answer_cache()
+    cache.invalidate(scope)
+    cache.hold(result["task_id"], scope)
+    threading.Thread(
+        target=release_when_deleted,
+        args=(store, cache, result["task_id"]),
+        daemon=True,
+    ).start()
+    return result
+
+
+def release_when_deleted(
+    store: VectorStore,
+    cache: SemanticAnswerCache,
+    task_id: str,
+    interval: float = DELETE_POLL_SECONDS,
+    timeout: float = ANSWER_CACHE_HOLD_SECONDS,
+) -> None:
+    """
+    Release the answer cache hold of a delete once it completes, whether
+    or not a client polls it. Past ``timeout`` the hold expires by itself.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            status = store.delete_status(task_id)
+        except Exception as e:
+            logging.warning(f"Could not check delete {task_id}: {e}")
+        else:
+            if status is None or status["completed"]:
+                cache.release(task_id)
+                return
+        time.sleep(interval)
+
+
+def iter_indexed_files(
+    unique_ids: Optional[List[str]] = None,
+    page_size: int = OS_LIST_PAGE_SIZE,
+) -> Iterator[Dict[str, Any]]:
+    return get_vector_store().iter_files(unique_ids, page_size)
+
+
+def delete_status(task_id: str) -> Optional[Dict[str, Any]]:
+    status = get_vector_store().delete_status(task_id)
+    if status and status["completed"]:
+        get_answer_cache().release(task_id)
+    return status
+
+
+def delete_doc(event: Dict[str, Any], *args: Any, **kwargs: Any) -> Any:
+    file_path = event.get("file_path")
+    if not isinstance(file_path, str):
+        raise ValueError("Deleting a document needs its file_path")
+    return delete_files([file_path], event.get("unique_id"))
@@ -1,23 +1,479 @@
+"""
+Offline benchmark of the API.
+
+The FastAPI app runs in process with stand-ins for the chat and vision
+model, the embedding model, S3, PDF rendering and the vector store, each
+with a configurable latency. Every scenario is driven at a fixed
+concurrency (closed loop) or arrival rate (open loop) and reported as
+p50/p95/p99 latency, throughput and error rate.
+
+Raw latencies depend on the machine, so each scenario is also timed one
+request at a time first. The loaded p95 is reported as a multiple of
+that unloaded latency (``p95_x``) and throughput as a fraction of what
+the clients could reach without contention (``efficiency``). With
+``--baseline`` the run fails when either ratio, or the error rate,
+regresses past the tolerance band.
+
+    python tests/perf_test.py --concurrency 8 --requests 200
+    python tests/perf_test.py --rate 20 --baseline tests/perf_baseline.json
+    python tests/perf_test.py --save-baseline tests/perf_baseline.json
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import tempfile
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from unittest import mock
 
-import requests
+import numpy as np
 
-limit = 6
-host = "localhost"
+BENCH_ID = "bench"
+# error rate a scenario may gain over its baseline
+ERROR_SLACK = 0.01
+# sequential requests timing a scenario's unloaded latency
+CALIBRATION_REQUESTS = 5
 
+Request = Tuple[str, str, Callable[[int], Dict[str, Any]]]
+SCENARIOS: Dict[str, Request] = {
+    "chat": (
+        "POST",
+        "/chat",
+        lambda i: {
+            "event": {"unique_ids": [BENCH_ID], "question": f"question {i}"}
+        },
+    ),
+    "summary": (
+        "GET",
+        "/summary",
+        lambda i: {"event": {"unique_ids": [BENCH_ID]}},
+    ),
+    "list_docs": (
+        "POST",
+        "/pdf_file",
+        lambda i: {"event": {"unique_ids": [BENCH_ID]}},
+    ),
+    "ingest": (
+        "PUT",
+        "/pdf_file",
+        lambda i: {
+            "event": {
+                "unique_id": f"{BENCH_ID}-ingest",
+                "file_path": f"{i}.pdf",
+            }
+        },
+    ),
+}
 
-def make_request():
-    start = time.time()
-    response = requests.get(f"http://{host}/summary?unique_id=JohnDeere")
-    end = time.time()
-    return response.status_code, end - start
 
+def configure_environment(args: argparse.Namespace, workdir: str) -> None:
+    """
+    Point every backend at local stand-ins, before the app is imported.
+    """
+    os.environ.update(
+        {
+            "INDEX_NAME": "bench",
+            "AOSS_URL": "localhost",
+            "AOSS_PORT": "9200",
+            "LOG_LEVEL": "WARNING",
+            "LOCAL": "1",
+            "CHAT_MODEL": "bench-chat",
+            "EMBED_MODEL": "bench-embed",
+            "EMBED_DIMENSION": str(args.dimension),
+            "S3_BUCKET": "bench",
+            "VECTOR_STORE": "numpy",
+            "VECTOR_STORE_PATH": os.path.join(workdir, "vectors"),
+            "JOBS_DB_PATH": os.path.join(workdir, "jobs.db"),
+            "JOBS_IN_PROCESS": "0",
+            "RETRIEVAL_MODE": "knn",
+            # measure the uncached path
+            "ANSWER_CACHE_SIZE": "0",
+            "ANSWER_CACHE_INVALIDATION_PATH": "",
+            "EMBED_CACHE_SIZE": "0",
+            "EMBED_CACHE_PATH": "",
+        }
+    )
 
-if __name__ == "__main__":
-    with ThreadPoolExecutor(max_workers=limit) as executor:
-        futures = [executor.submit(make_request) for _ in range(limit)]
 
-        for future in as_completed(futures):
-            status, text = future.result()
-            print(f"Status: {status}, Response: {text}")
+def fake_vector(text: str, dimension: int) -> List[float]:
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "big")
+    vector = np.random.default_rng(seed).normal(size=dimension)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class FakeS3:
+    """
+    S3 client serving a tiny object whose ETag is its key.
+    """
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+
+    def head_object(self, Bucket: str, Key: str) -> Dict[str, Any]:
+        time.sleep(self.latency)
+        return {"ETag": f'"{Key}"'}
+
+    def download_fileobj(
+        self, Bucket: str, Key: str, Fileobj: Any, **kwargs: Any
+    ) -> None:
+        time.sleep(self.latency)
+        Fileobj.write(b"%PDF")
+
+
+def slow_chat_model(latency: float) -> Any:
+    from langchain_core.language_models import FakeListChatModel
+
+    class SlowChatModel(FakeListChatModel):
+        def _call(self, *args: Any, **kwargs: Any) -> str:
+            time.sleep(latency)
+            return super()._call(*args, **kwargs)
+
+    return SlowChatModel(responses=["A benchmark answer about the pages."])
+
+
+def slow_vector_store(args: argparse.Namespace) -> Any:
+    from aws_rag_quickstart.numpy_store import NumpyVectorStore
+
+    def slow(method: Callable, latency: float) -> Callable:
+        def wrapper(self: Any, *call_args: Any, **kwargs: Any) -> Any:
+            time.sleep(latency)
+            return method(self, *call_args, **kwargs)
+
+        return wrapper
+
+    return type(
+        "SlowVectorStore",
+        (NumpyVectorStore,),
+        {
+            "knn_search": slow(
+                NumpyVectorStore.knn_search, args.search_latency
+            ),
+            "docs_by_id": slow(
+                NumpyVectorStore.docs_by_id, args.search_latency
+            ),
+            "has_docs": slow(NumpyVectorStore.has_docs, args.search_latency),
+            "indexed_pages": slow(
+                NumpyVectorStore.indexed_pages, args.search_latency
+            ),
+            "bulk": slow(NumpyVectorStore.bulk, args.index_latency),
+        },
+    )
+
+
+def install_fakes(args: argparse.Namespace, stack: ExitStack) -> None:
+    """
+    Replace the external services with in-process stand-ins.
+    """
+    from PIL import Image
+
+    def embed_query(self: Any, prompt: str) -> List[float]:
+        time.sleep(args.embed_latency)
+        return fake_vector(prompt, args.dimension)
+
+    def embed_documents(self: Any, texts: List[str]) -> List[List[float]]:
+        time.sleep(args.embed_latency)
+        return [fake_vector(text, args.dimension) for text in texts]
+
+    def pages(pdf_path: str, *page_args: Any, **kwargs: Any) -> Any:
+        selected = kwargs.get("pages")
+        if selected is None:
+            selected = range(1, args.pages + 1)
+        for page in selected:
+            time.sleep(args.raster_latency)
+            yield page, Image.effect_noise((425, 550), 32).convert("RGB")
+
+    def page_texts(pdf_path: str, page_count: int) -> List[str]:
+        with_text = round(args.text_pages * page_count)
+        text = "Embedded text of a born-digital page. " * 40
+        return [text] * with_text + [""] * (page_count - with_text)
+
+    chat = mock.Mock(llm=slow_chat_model(args.llm_latency))
+    fakes = {
+        "aws_rag_quickstart.LLM.ChatLLM": mock.Mock(return_value=chat),
+        "aws_rag_quickstart.LLM.Embeddings._embed_query": embed_query,
+        "aws_rag_quickstart.LLM.Embeddings._embed_documents": embed_documents,
+        "aws_rag_quickstart.numpy_store.NumpyVectorStore": slow_vector_store(
+            args
+        ),
+        "aws_rag_quickstart.IngestionLambda.get_s3_client": mock.Mock(
+            return_value=FakeS3(args.s3_latency)
+        ),
+        "aws_rag_quickstart.IngestionLambda.pdf_page_count": mock.Mock(
+            return_value=args.pages
+        ),
+        "aws_rag_quickstart.IngestionLambda.iter_pdf_pages": pages,
+        "aws_rag_quickstart.IngestionLambda.pdf_page_texts": page_texts,
+    }
+    for target, fake in fakes.items():
+        stack.enter_context(mock.patch(target, fake))
+
+
+def seed_store(args: argparse.Namespace) -> None:
+    """
+    Index the pages the chat and listing scenarios search.
+    """
+    from aws_rag_quickstart.vector_store import get_vector_store
+
+    store = get_vector_store()
+    if not store.exists():
+        store.create(mock.Mock(dimension=args.dimension))
+    body: List[Dict[str, Any]] = []
+    for i in range(args.seed_pages):
+        text = f"Page {i} of the benchmark corpus. " * 20
+        body += [
+            {"index": {"_id": f"seed-{i}"}},
+            {
+                "unique_id": BENCH_ID,
+                "file_path": f"seed-{i // 10}.pdf",
+                "page_number": f"page_{i % 10 + 1}",
+                "llm_generated": text,
+                "embedding": fake_vector(text, args.dimension),
+            },
+        ]
+    store.bulk(body)
+
+
+async def timed(client: Any, request: Request, i: int) -> Tuple[float, bool]:
+    method, url, event = request
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, url, json=event(i))
+        ok = response.status_code < 400
+    except Exception:
+        ok = False
+    return time.perf_counter() - started, ok
+
+
+async def closed_loop(
+    client: Any, request: Request, requests: int, concurrency: int
+) -> Tuple[List[Tuple[float, bool]], float]:
+    """
+    ``concurrency`` clients each sending their next request as soon as
+    the previous one completes.
+    """
+    results: List[Tuple[float, bool]] = []
+    counter = iter(range(requests))
+
+    async def worker() -> None:
+        for i in counter:
+            results.append(await timed(client, request, i))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results, time.perf_counter() - started
+
+
+async def open_loop(
+    client: Any, request: Request, requests: int, rate: float
+) -> Tuple[List[Tuple[float, bool]], float]:
+    """
+    Requests arriving at a fixed rate whether or not earlier ones are
+    done. Latency counts from the scheduled arrival, so queueing shows.
+    """
+    started = time.perf_counter()
+
+    async def arrival(i: int) -> Tuple[float, bool]:
+        scheduled = started + i / rate
+        await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+        _, ok = await timed(client, request, i)
+        return time.perf_counter() - scheduled, ok
+
+    results = await asyncio.gather(*(arrival(i) for i in range(requests)))
+    return list(results), time.perf_counter() - started
+
+
+def summarize(
+    results: List[Tuple[float, bool]],
+    elapsed: float,
+    unloaded_ms: float,
+    ideal_rps: float,
+) -> Dict[str, float]:
+    """
+    Latency and throughput of a run, absolute and relative to the
+    scenario's unloaded latency.
+
+    :param results: latency in seconds and success of each request.
+    :param elapsed: wall time of the run in seconds.
+    :param unloaded_ms: median latency of sequential requests.
+    :param ideal_rps: throughput without any contention.
+    """
+    latencies = np.asarray([latency for latency, _ in results]) * 1000
+    errors = sum(not ok for _, ok in results)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    throughput = len(results) / elapsed
+    return {
+        "requests": len(results),
+        "error_rate": errors / len(results),
+        "p50_ms": round(float(p50), 2),
+        "p95_ms": round(float(p95), 2),
+        "p99_ms": round(float(p99), 2),
+        "throughput_rps": round(throughput, 2),
+        "unloaded_ms": round(unloaded_ms, 2),
+        "p95_x": round(float(p95) / unloaded_ms, 3),
+        "efficiency": round(throughput / ideal_rps, 3),
+    }
+
+
+def compare(
+    report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    """
+    Regressions of a report against a baseline.
+
+    :param report: results of this run.
+    :param baseline: stored results of a reference run.
+    :param tolerance: allowed relative growth of ``p95_x`` and loss of
+        ``efficiency``.
+    :return: one message per regression.
+    """
+    regressions = []
+    settings = {
+        key: value
+        for key, value in baseline.get("config", {}).items()
+        if key != "requests"
+    }
+    if settings.items() - report["config"].items():
+        print("warning: baseline was recorded with different settings")
+    for name, base in baseline["scenarios"].items():
+        current = report["scenarios"].get(name)
+        if current is None:
+            continue
+        if current["p95_x"] > base["p95_x"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p95 {current['p95_x']}x unloaded latency > "
+                f"{base['p95_x']}x"
+            )
+        if current["efficiency"] < base["efficiency"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: efficiency {current['efficiency']:.1%} < "
+                f"{base['efficiency']:.1%}"
+            )
+        if current["error_rate"] > base["error_rate"] + ERROR_SLACK:
+            regressions.append(
+                f"{name}: error rate {current['error_rate']:.2%} > "
+                f"{base['error_rate']:.2%}"
+            )
+    return regressions
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    import httpx
+
+    from aws_rag_quickstart.fast_api_wrapper import app
+
+    seed_store(args)
+    transport = httpx.ASGITransport(app=app)
+    scenarios = {}
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", timeout=None
+    ) as client:
+        for name in args.scenarios:
+            request = SCENARIOS[name]
+            # one untimed request warms up the lazily built clients
+            await timed(client, request, -1)
+            unloaded = [
+                (await timed(client, request, -2 - i))[0]
+                for i in range(CALIBRATION_REQUESTS)
+            ]
+            unloaded_ms = float(np.median(unloaded)) * 1000
+            if args.rate:
+                results, elapsed = await open_loop(
+                    client, request, args.requests, args.rate
+                )
+                ideal_rps = args.rate
+            else:
+                results, elapsed = await closed_loop(
+                    client, request, args.requests, args.concurrency
+                )
+                ideal_rps = args.concurrency * 1000 / unloaded_ms
+            scenarios[name] = summarize(
+                results, elapsed, unloaded_ms, ideal_rps
+            )
+    config = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("baseline", "save_baseline", "tolerance", "scenarios")
+    }
+    return {"config": config, "scenarios": scenarios}
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    columns = [
+        "requests",
+        "error_rate",
+        "p50_ms",
+        "p95_ms",
+        "p99_ms",
+        "throughput_rps",
+        "p95_x",
+        "efficiency",
+    ]
+    print(f"{'scenario':<12}" + "".join(f"{c:>16}" for c in columns))
+    for name, stats in report["scenarios"].items():
+        print(f"{name:<12}" + "".join(f"{stats[c]:>16}" for c in columns))
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS)
+    )
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--rate", type=float, default=0, help="arrivals per second"
+    )
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--embed-latency", type=float, default=0.01)
+    parser.add_argument("--search-latency", type=float, default=0.005)
+    parser.add_argument("--index-latency", type=float, default=0.01)
+    parser.add_argument("--s3-latency", type=float, default=0.01)
+    parser.add_argument("--raster-latency", type=float, default=0.01)
+    parser.add_argument("--pages", type=int, default=4)
+    parser.add_argument(
+        "--text-pages",
+        type=float,
+        default=0.0,
+        help="fraction of ingested pages with a text layer",
+    )
+    parser.add_argument("--seed-pages", type=int, default=500)
+    parser.add_argument("--dimension", type=int, default=256)
+    parser.add_argument("--baseline", help="fail on regressions from this")
+    parser.add_argument("--save-baseline", help="write the report here")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed relative growth of p95_x and loss of efficiency",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as workdir, ExitStack() as stack:
+        configure_environment(args, workdir)
+        install_fakes(args, stack)
+        report = asyncio.run(run(args))
+    print_report(report)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
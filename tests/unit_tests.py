@@ -1,7 +1,23 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from io import BytesIO
 from unittest import mock
-from unittest.mock import Mock, patch
+from unittest.mock import AsyncMock, Mock, patch
 
+import numpy as np
 import pytest
+from fastapi.testclient import TestClient
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+from opensearchpy import NotFoundError
+from PIL import Image
 
 with patch(
     "os.environ",
@@ -13,27 +29,104 @@ with patch(
         "LOCAL": "1",
     },
 ):
+    from aws_rag_quickstart.AgentLambda import amain as agent_amain
+    from aws_rag_quickstart.AgentLambda import astream_main
     from aws_rag_quickstart.AgentLambda import main as agent_main
-    from aws_rag_quickstart.AgentLambda import os_similarity_search, summarize_documents
+    from aws_rag_quickstart.AgentLambda import (
+        os_similarity_search,
+        rag_chain,
+        summarize_documents,
+    )
+    from aws_rag_quickstart.answer_cache import SemanticAnswerCache
     from aws_rag_quickstart.AWSAuth import get_aws_auth
+    from aws_rag_quickstart.context import build_context
+    from aws_rag_quickstart.embedding_cache import EmbeddingCache
+    from aws_rag_quickstart.fast_api_wrapper import app
     from aws_rag_quickstart.IngestionLambda import (
         augment_metadata,
-        create_index_opensearch,
-        insert_document_opensearch,
+        encode_page,
     )
     from aws_rag_quickstart.IngestionLambda import main as ingest_main
     from aws_rag_quickstart.IngestionLambda import process_file
-    from aws_rag_quickstart.LLM import ChatLLM, Embeddings
+    from aws_rag_quickstart.jobs import JobQueue, JobWorkerPool
+    from aws_rag_quickstart.LLM import ChatLLM, Embeddings, get_chat_llm
+    from aws_rag_quickstart.metrics import (
+        LLM_TOKENS,
+        STAGE_SECONDS,
+        Histogram,
+        LLMMetrics,
+        render,
+        span,
+    )
+    from aws_rag_quickstart.numpy_store import NumpyVectorStore
     from aws_rag_quickstart.opensearch import (
-        delete_doc,
+        BulkIndexer,
+        OpenSearchStore,
+        create_index_opensearch,
         delete_documents_opensearch,
         get_all_indexed_files_opensearch,
+        get_indexed_pages,
+        get_opensearch_client,
         get_opensearch_connection,
+        hybrid_search,
+        insert_document_opensearch,
         is_opensearch_connected,
+        iter_indexed_files,
+        knn_query,
+        knn_vector_mapping,
+        page_document_id,
+        reciprocal_rank_fusion,
+        unique_id_filter,
+    )
+    from aws_rag_quickstart.prompts import RAG_PROMPT_TEMPLATE, get_rag_prompt
+    from aws_rag_quickstart.rasterize import iter_pdf_pages, pdf_page_texts
+    from aws_rag_quickstart.s3 import (
+        TRANSFER_CONFIG,
+        download_object,
+        get_s3_client,
+    )
+    from aws_rag_quickstart.vector_store import (
+        VectorStore,
+        delete_doc,
+        delete_files,
+        delete_status,
         list_docs_by_id,
+        release_when_deleted,
     )
 
 
+@pytest.fixture(autouse=True)
+def embedding_cache():
+    cache = EmbeddingCache(path="")
+    with patch(
+        "aws_rag_quickstart.LLM.get_embedding_cache", return_value=cache
+    ):
+        yield cache
+
+
+@pytest.fixture(autouse=True)
+def answer_cache():
+    cache = SemanticAnswerCache(invalidation_path="")
+    with patch(
+        "aws_rag_quickstart.AgentLambda.get_answer_cache", return_value=cache
+    ), patch(
+        "aws_rag_quickstart.IngestionLambda.get_answer_cache",
+        return_value=cache,
+    ), patch(
+        "aws_rag_quickstart.vector_store.get_answer_cache", return_value=cache
+    ):
+        yield cache
+
+
+@pytest.fixture(autouse=True)
+def compiled_chain():
+    for cached in (rag_chain, get_chat_llm, get_rag_prompt):
+        cached.cache_clear()
+    yield
+    for cached in (rag_chain, get_chat_llm, get_rag_prompt):
+        cached.cache_clear()
+
+
 # Mock response from LLM
 class MockResponse:
     def __init__(self, content):
@@ -53,23 +146,43 @@ def test_get_open_search_connection(local):
         get_opensearch_connection("foo", 999)
 
 
+def test_get_opensearch_client_is_shared(mocker):
+    mocker.patch.dict("os.environ", {"LOCAL": "1"})
+    mocker.patch.dict("aws_rag_quickstart.opensearch._clients", clear=True)
+    mock_connection = mocker.patch(
+        "aws_rag_quickstart.opensearch.get_opensearch_connection",
+        side_effect=lambda host, port: Mock(host=host),
+    )
+
+    first = get_opensearch_client("foo", "9200")
+    assert get_opensearch_client("foo", 9200) is first
+    assert get_opensearch_client("bar", "9200") is not first
+    assert mock_connection.call_count == 2
+
+
 def test_delete_doc():
-    with mock.patch("aws_rag_quickstart.opensearch.get_opensearch_connection"), mock.patch(
-        "aws_rag_quickstart.opensearch.delete_documents_opensearch"
-    ), patch(
-        "os.environ",
-        {
-            "AOSS_URL": "bar",
-            "AOSS_PORT": "bar",
-            "INDEX_NAME": "foo",
-        },
-    ):
-        delete_doc({"file_path": "foo"})
+    store = Mock()
+    store.delete_files.return_value = {"task_id": "t1"}
+    with patch(
+        "aws_rag_quickstart.vector_store.get_vector_store",
+        return_value=store,
+    ), patch("aws_rag_quickstart.vector_store.release_when_deleted"):
+        assert delete_doc({"file_path": "foo", "unique_id": "u1"}) == {
+            "task_id": "t1"
+        }
+        with pytest.raises(ValueError):
+            delete_doc({"unique_id": "u1"})
+    store.delete_files.assert_called_once_with(["foo"], "u1")
 
 
 def test_get_all_indexed_files_opensearch():
-    with mock.patch("aws_rag_quickstart.opensearch.get_opensearch_connection"):
-        get_all_indexed_files_opensearch("foo")
+    with mock.patch(
+        "aws_rag_quickstart.opensearch.get_opensearch_client"
+    ) as client:
+        client.return_value.search.return_value = {
+            "aggregations": {"ids": {"buckets": []}}
+        }
+        assert get_all_indexed_files_opensearch("foo") == []
 
 
 @pytest.mark.parametrize("input_file", ["foo", "bar"])
@@ -84,7 +197,7 @@ def test_agent_main(input_file):
         "aws_rag_quickstart.LLM.ollama.embeddings",
         return_value=Mock(embed_query=Mock(return_value={})),
     ), mock.patch(
-        "aws_rag_quickstart.IngestionLambda.get_opensearch_connection"
+        "aws_rag_quickstart.IngestionLambda.get_vector_store"
     ), mock.patch(
         "os.environ", {
             "BEDROCK_ENDPOINT": "https://foo",
@@ -92,12 +205,243 @@ def test_agent_main(input_file):
             "CHAT_MODEL": "anthropic.claude-v2"
         }
     ), patch(
-        "aws_rag_quickstart.AgentLambda.list_docs_by_id",
+        "aws_rag_quickstart.AgentLambda.has_docs",
     ) as mock_os:
-        mock_os.return_value = {"num_pages": 9}
+        mock_os.return_value = True
         agent_main({"question": "bar", "unique_ids": [input_file]})
 
 
+def test_rag_chain_is_built_once(mocker):
+    mock_chat = mocker.patch("aws_rag_quickstart.LLM.ChatLLM")
+    mock_pull = mocker.patch("aws_rag_quickstart.LLM.ollama.pull")
+
+    assert rag_chain() is rag_chain()
+    assert get_chat_llm() is mock_chat.return_value.llm
+    mock_chat.assert_called_once()
+    mock_pull.assert_not_called()
+
+
+@pytest.mark.parametrize("hub_prompt", ["", "rlm/rag-prompt"])
+def test_get_rag_prompt_is_offline(mocker, hub_prompt):
+    mocker.patch("aws_rag_quickstart.prompts.RAG_PROMPT_HUB", hub_prompt)
+    mocker.patch(
+        "langchain.hub.pull", side_effect=ConnectionError("no network")
+    )
+
+    prompt = get_rag_prompt()
+
+    assert prompt.messages[0].prompt.template == RAG_PROMPT_TEMPLATE
+    assert set(prompt.input_variables) == {"context", "question"}
+
+
+def test_agent_main_serves_cached_answer(mocker, answer_cache):
+    mocker.patch.dict("os.environ", {"LOCAL": "1", "EMBED_MODEL": "m"})
+    mocker.patch(
+        "aws_rag_quickstart.LLM.ollama.embeddings",
+        return_value={"embedding": [1.0, 0.0]},
+    )
+    mock_docs = mocker.patch(
+        "aws_rag_quickstart.AgentLambda.has_docs",
+        return_value=True,
+    )
+    mock_chain = mocker.patch("aws_rag_quickstart.AgentLambda.rag_chain")
+    mock_chain.return_value.invoke.return_value = "answer"
+    event = {"question": "bar", "unique_ids": ["foo"]}
+
+    assert agent_main(event) == "answer"
+    assert agent_main(event) == "answer"
+    assert asyncio.run(agent_amain(event)) == "answer"
+
+    mock_chain.return_value.invoke.assert_called_once()
+    mock_docs.assert_called_once()
+    assert answer_cache.stats["hits"] == 2
+
+
+def test_semantic_answer_cache_threshold_and_scope():
+    cache = SemanticAnswerCache(threshold=0.9, invalidation_path="")
+    cache.store(["a", "b"], [1.0, 0.0], "first")
+
+    assert cache.lookup(["b", "a"], [0.99, 0.05]) == "first"
+    assert cache.lookup(["a", "b"], [0.5, 0.5]) is None
+    assert cache.lookup(["a"], [1.0, 0.0]) is None
+    assert cache.stats["hits"] == 1
+    assert cache.stats["misses"] == 2
+
+
+def test_semantic_answer_cache_eviction():
+    cache = SemanticAnswerCache(max_entries=2, invalidation_path="")
+    cache.store(["a"], [1.0, 0.0], "first")
+    cache.store(["a"], [0.0, 1.0], "second")
+    assert cache.lookup(["a"], [1.0, 0.0]) == "first"
+    cache.store(["b"], [1.0, 0.0], "third")
+
+    assert cache.lookup(["a"], [0.0, 1.0]) is None
+    assert cache.lookup(["a"], [1.0, 0.0]) == "first"
+    assert cache.stats["evictions"] == 1
+
+
+def test_semantic_answer_cache_invalidation(tmp_path):
+    path = str(tmp_path / "invalidations.db")
+    cache = SemanticAnswerCache(invalidation_path=path)
+    other_process = SemanticAnswerCache(invalidation_path=path)
+    cache.store(["a", "b"], [1.0, 0.0], "ab")
+    cache.store(["c"], [1.0, 0.0], "c")
+    other_process.store(["a"], [1.0, 0.0], "a")
+
+    cache.invalidate(["a"])
+
+    assert cache.lookup(["a", "b"], [1.0, 0.0]) is None
+    assert cache.lookup(["c"], [1.0, 0.0]) == "c"
+    assert other_process.lookup(["a"], [1.0, 0.0]) is None
+    cache.invalidate()
+    assert cache.lookup(["c"], [1.0, 0.0]) is None
+
+
+def test_agent_amain(mocker):
+    mocker.patch("aws_rag_quickstart.AgentLambda.Embeddings")
+    mocker.patch(
+        "aws_rag_quickstart.AgentLambda.has_docs",
+        return_value=True,
+    )
+    mock_chain = mocker.patch("aws_rag_quickstart.AgentLambda.rag_chain")
+    mock_chain.return_value.ainvoke = AsyncMock(return_value="answer")
+    event = {"question": "bar", "unique_ids": ["foo"]}
+
+    actual = asyncio.run(agent_amain(event))
+
+    assert actual == "answer"
+    mock_chain.return_value.ainvoke.assert_awaited_once_with(
+        input={"context": event, "question": "bar"}
+    )
+
+
+def test_agent_amain_no_data(mocker):
+    mocker.patch("aws_rag_quickstart.AgentLambda.Embeddings")
+    mocker.patch(
+        "aws_rag_quickstart.AgentLambda.has_docs",
+        return_value=False,
+    )
+    mock_chain = mocker.patch("aws_rag_quickstart.AgentLambda.rag_chain")
+
+    actual = asyncio.run(agent_amain({"question": "q", "unique_ids": ["x"]}))
+
+    assert actual == "There is no data for unique ids ['x'] in OpenSearch"
+    mock_chain.assert_not_called()
+
+
+def test_astream_main_streams_and_caches(mocker, answer_cache):
+    async def tokens(input):
+        for token in ["an", "sw", "er"]:
+            yield token
+
+    async def collect(event, metrics):
+        return [chunk async for chunk in astream_main(event, metrics)]
+
+    embeddings = mocker.patch("aws_rag_quickstart.AgentLambda.Embeddings")
+    embeddings.return_value.embed_query.return_value = [1.0, 0.0]
+    mocker.patch(
+        "aws_rag_quickstart.AgentLambda.has_docs",
+        return_value=True,
+    )
+    mock_chain = mocker.patch("aws_rag_quickstart.AgentLambda.rag_chain")
+    mock_chain.return_value.astream = Mock(side_effect=tokens)
+    event = {"question": "bar", "unique_ids": ["foo"]}
+    metrics = {}
+
+    assert asyncio.run(collect(event, metrics)) == ["an", "sw", "er"]
+    assert 0 <= metrics["ttft_ms"] <= metrics["total_ms"]
+    mock_chain.return_value.astream.assert_called_once_with(
+        input={"context": event, "question": "bar"}
+    )
+    assert asyncio.run(collect(event, {})) == ["answer"]
+    assert answer_cache.stats["hits"] == 1
+
+
+def test_astream_main_records_chat_span(mocker, caplog):
+    async def collect(event):
+        return [chunk async for chunk in astream_main(event)]
+
+    def checked(unique_ids):
+        with span("has_docs"):
+            return False
+
+    mocker.patch(
+        "aws_rag_quickstart.AgentLambda.embed_question", return_value=None
+    )
+    mocker.patch(
+        "aws_rag_quickstart.AgentLambda.has_docs", side_effect=checked
+    )
+    with caplog.at_level("DEBUG", logger="aws_rag_quickstart.trace"):
+        answer = asyncio.run(collect({"question": "bar", "unique_ids": ["u"]}))
+
+    assert answer[0].startswith("There is no data")
+    inner, chat = [json.loads(r.message) for r in caplog.records]
+    assert chat["name"] == "chat"
+    assert chat["parent_id"] is None
+    assert inner["parent_id"] == chat["span_id"]
+
+
+def test_span_records_stage_and_nests(caplog):
+    before = STAGE_SECONDS.count(stage="test_outer")
+    with caplog.at_level("DEBUG", logger="aws_rag_quickstart.trace"):
+        with span("test_outer", file_path="a.pdf") as attributes:
+            with span("test_inner"):
+                pass
+            attributes["pages"] = 2
+        with pytest.raises(ValueError):
+            with span("test_inner"):
+                raise ValueError("boom")
+
+    assert STAGE_SECONDS.count(stage="test_outer") == before + 1
+    inner, outer, failed = [json.loads(r.message) for r in caplog.records]
+    assert inner["parent_id"] == outer["span_id"]
+    assert inner["trace_id"] == outer["trace_id"]
+    assert outer["parent_id"] is None
+    assert outer["attributes"] == {"file_path": "a.pdf", "pages": 2}
+    assert failed["trace_id"] != outer["trace_id"]
+    assert "boom" in failed["attributes"]["error"]
+
+
+def test_metrics_render():
+    histogram = Histogram("test_seconds", "Test.", buckets=(0.1, 1.0))
+    histogram.observe(0.05, stage="a")
+    histogram.observe(0.5, stage="a")
+
+    assert histogram.render() == [
+        "# HELP test_seconds Test.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{stage="a",le="0.1"} 1',
+        'test_seconds_bucket{stage="a",le="1.0"} 2',
+        'test_seconds_bucket{stage="a",le="+Inf"} 2',
+        'test_seconds_sum{stage="a"} 0.55',
+        'test_seconds_count{stage="a"} 2',
+    ]
+    assert "# TYPE rag_stage_seconds histogram" in render()
+
+
+def test_llm_metrics_counts_tokens():
+    handler = LLMMetrics("test_generation")
+    run_id = uuid.uuid4()
+    message = AIMessage(
+        content="answer",
+        usage_metadata={
+            "input_tokens": 12,
+            "output_tokens": 3,
+            "total_tokens": 15,
+        },
+    )
+
+    handler.on_chat_model_start({}, [[]], run_id=run_id)
+    handler.on_llm_end(
+        LLMResult(generations=[[ChatGeneration(message=message)]]),
+        run_id=run_id,
+    )
+
+    assert LLM_TOKENS.value(stage="test_generation", kind="input") == 12
+    assert LLM_TOKENS.value(stage="test_generation", kind="output") == 3
+    assert STAGE_SECONDS.count(stage="test_generation") == 1
+
+
 def test_llm_chat():
     with mock.patch("aws_rag_quickstart.LLM.ollama.pull"), mock.patch(
         "aws_rag_quickstart.LLM.ChatOllama"
@@ -132,6 +476,93 @@ def test_llm_is_local(is_local):
         ChatLLM()
 
 
+def test_embed_documents_local_batches(mocker):
+    mocker.patch.dict(
+        "os.environ", {"LOCAL": "1", "EMBED_MODEL": "mxbai-embed-large"}
+    )
+    mocker.patch("aws_rag_quickstart.LLM.EMBED_BATCH_SIZE", 2)
+    mock_embed = mocker.patch(
+        "aws_rag_quickstart.LLM.ollama.embed",
+        side_effect=lambda model, input: {
+            "embeddings": [[float(len(text))] for text in input]
+        },
+    )
+
+    actual = Embeddings().embed_documents(["a", "bb", "ccc"])
+
+    assert actual == [[1.0], [2.0], [3.0]]
+    assert mock_embed.call_count == 2
+    mock_embed.assert_any_call(model="mxbai-embed-large", input=["a", "bb"])
+    mock_embed.assert_any_call(model="mxbai-embed-large", input=["ccc"])
+
+
+def test_embed_documents_bedrock_reuses_client(mocker):
+    mocker.patch.dict(
+        "os.environ", {"LOCAL": "0", "BEDROCK_ENDPOINT": "https://foo"}
+    )
+    mock_bedrock = mocker.patch("aws_rag_quickstart.LLM.BedrockEmbeddings")
+    mock_bedrock.return_value.embed_query.side_effect = lambda text: [
+        float(len(text))
+    ]
+
+    embeddings = Embeddings()
+    actual = embeddings.embed_documents(["a", "bb", "ccc", "dddd"])
+    embeddings.embed_query("eeeee")
+
+    assert actual == [[1.0], [2.0], [3.0], [4.0]]
+    mock_bedrock.assert_called_once()
+
+
+def test_embedding_cache_memory_lru():
+    cache = EmbeddingCache(path="", memory_size=2)
+    cache.put("m", "a", [1.0])
+    cache.put("m", "b", [2.0])
+    assert cache.get("m", "a") == [1.0]
+    cache.put("m", "c", [3.0])
+
+    assert cache.get("m", "b") is None
+    assert cache.get("m", "c") == [3.0]
+    assert cache.get("other-model", "a") is None
+    assert cache.stats["memory_hits"] == 2
+    assert cache.stats["misses"] == 2
+
+
+def test_embedding_cache_persists_and_evicts(tmp_path):
+    path = str(tmp_path / "embeds.db")
+    cache = EmbeddingCache(path=path, memory_size=1, max_rows=10)
+    for i in range(12):
+        cache.put("m", f"text {i}", [float(i), 0.5])
+    cache.put("m", "mock", Mock())
+
+    reopened = EmbeddingCache(path=path)
+    assert reopened.stats["disk_entries"] == 10
+    assert reopened.get("m", "text 0") is None
+    assert reopened.get("m", "text 11") == [11.0, 0.5]
+    assert reopened.get("m", "mock") is None
+    assert reopened.stats["disk_hits"] == 1
+
+
+def test_embed_query_uses_cache(mocker, embedding_cache):
+    mocker.patch.dict("os.environ", {"LOCAL": "1", "EMBED_MODEL": "mxbai"})
+    mock_embeddings = mocker.patch(
+        "aws_rag_quickstart.LLM.ollama.embeddings",
+        return_value={"embedding": [0.1, 0.2]},
+    )
+    mock_embed = mocker.patch(
+        "aws_rag_quickstart.LLM.ollama.embed",
+        return_value={"embeddings": [[0.3, 0.4]]},
+    )
+
+    assert Embeddings().embed_query("foo") == [0.1, 0.2]
+    assert Embeddings().embed_query("foo") == [0.1, 0.2]
+    actual = Embeddings().embed_documents(["foo", "bar", "bar"])
+
+    assert actual == [[0.1, 0.2], [0.3, 0.4], [0.3, 0.4]]
+    mock_embeddings.assert_called_once()
+    mock_embed.assert_called_once_with(model="mxbai", input=["bar"])
+    assert embedding_cache.stats["memory_hits"] == 2
+
+
 @pytest.mark.parametrize(
     "mock_client", [Mock(), Mock(ping=Mock(side_effect=ConnectionError()))]
 )
@@ -142,17 +573,13 @@ def test_is_opensearch_connected(mock_client):
 @pytest.mark.parametrize("input_file, exists", [("foo", 1), ("bar", 0)])
 def test_ingest_main(input_file, exists):
     with mock.patch("aws_rag_quickstart.AWSAuth.AWS4Auth"), mock.patch(
-        "aws_rag_quickstart.IngestionLambda.convert_from_bytes"
+        "aws_rag_quickstart.IngestionLambda.iter_pdf_pages"
     ), mock.patch(
         "aws_rag_quickstart.IngestionLambda.process_file",
     ), mock.patch(
-        "aws_rag_quickstart.IngestionLambda.create_index_opensearch",
-    ), mock.patch(
-        "aws_rag_quickstart.IngestionLambda.get_opensearch_connection",
-        Mock(
-            return_value=Mock(indices=Mock(exists=Mock(return_value=exists)))
-        ),
-    ), mock.patch(
+        "aws_rag_quickstart.IngestionLambda.get_vector_store",
+        Mock(return_value=Mock(exists=Mock(return_value=exists))),
+    ) as mock_store, mock.patch(
         "aws_rag_quickstart.LLM.ChatOllama"
     ), patch(
         "os.environ", {
@@ -166,6 +593,7 @@ def test_ingest_main(input_file, exists):
         "aws_rag_quickstart.LLM.ollama.pull"
     ):
         ingest_main({"question": "bar", "file_path": input_file})
+        assert mock_store.return_value.create.called != bool(exists)
 
 
 def test_augment_metadata(monkeypatch):
@@ -187,6 +615,45 @@ def test_augment_metadata(monkeypatch):
     assert result["author"] == "John Doe"
 
 
+@pytest.mark.parametrize(
+    "image_format, mime_type, magic, gray_mode",
+    [
+        ("png", "image/png", b"\x89PNG", "L"),
+        ("jpeg", "image/jpeg", b"\xff\xd8", "L"),
+        # WebP has no grayscale mode, gray pages decode as RGB
+        ("webp", "image/webp", b"RIFF", "RGB"),
+    ],
+)
+def test_encode_page_formats(image_format, mime_type, magic, gray_mode):
+    colour = Image.new("RGB", (3000, 1500), "white")
+    colour.paste((200, 30, 30), (0, 0, 300, 300))
+    text_only = Image.new("RGB", (800, 600), "white")
+    text_only.paste((40, 40, 40), (100, 100, 700, 120))
+
+    encoded = encode_page(colour, image_format, max_dimension=1000)
+    decoded = Image.open(BytesIO(base64.b64decode(encoded)))
+    assert base64.b64decode(encoded).startswith(magic)
+    assert decoded.size == (1000, 500)
+    assert decoded.mode == "RGB"
+    gray = Image.open(
+        BytesIO(base64.b64decode(encode_page(text_only, image_format)))
+    )
+    assert gray.mode == gray_mode
+    assert gray.size == (800, 600)
+
+    llm = Mock()
+    augment_metadata(llm, encoded, {}, mime_type)
+    content = llm.invoke.call_args.args[0][0].content
+    assert content[1]["image_url"]["url"].startswith(
+        f"data:{mime_type};base64,"
+    )
+
+
+def test_encode_page_rejects_unknown_format():
+    with pytest.raises(ValueError):
+        encode_page(Image.new("RGB", (10, 10)), "gif")
+
+
 def test_insert_document_success(mocker):
     mock_client = mocker.MagicMock()
     mock_embeddings = mocker.MagicMock()
@@ -229,34 +696,153 @@ def test_no_llm_generated_field(mocker):
 
 def test_delete_documents_success(mocker):
     mock_client = mocker.MagicMock()
-    index_name = "test-index"
-    file_path = "document.pdf"
-    mock_response = {"deleted": 5}
-    mock_client.delete_by_query.return_value = mock_response
+    mock_client.delete_by_query.return_value = {"task": "node:42"}
+    file_paths = ["a.pdf", "b.pdf"]
+
     result = delete_documents_opensearch(
-        client=mock_client, index_name=index_name, file_path=file_path
+        mock_client, "test-index", file_paths, unique_id="u1"
     )
-    expected_query_body = {"query": {"match": {"file_path": file_path}}}
+
     mock_client.delete_by_query.assert_called_once_with(
-        index=index_name, body=expected_query_body
+        index="test-index",
+        body={
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"terms": {"file_path.keyword": file_paths}},
+                        {"term": {"unique_id": "u1"}},
+                    ]
+                }
+            }
+        },
+        conflicts="proceed",
+        refresh=True,
+        slices="auto",
+        wait_for_completion=False,
     )
-    assert result == mock_response
+    assert result == {"task_id": "node:42"}
+    with pytest.raises(ValueError):
+        delete_documents_opensearch(mock_client, "test-index")
 
 
-def test_delete_documents_no_match(mocker):
+def test_get_delete_task(mocker):
     mock_client = mocker.MagicMock()
-    index_name = "test-index"
-    file_path = "non_existent_document.pdf"
-    mock_response = {"deleted": 0}
-    mock_client.delete_by_query.return_value = mock_response
-    result = delete_documents_opensearch(
-        client=mock_client, index_name=index_name, file_path=file_path
+    mock_client.tasks.get.return_value = {
+        "completed": True,
+        "task": {"status": {"total": 7, "deleted": 7}},
+        "response": {"total": 7, "deleted": 7, "failures": []},
+    }
+    store = OpenSearchStore(mock_client, "test-index")
+
+    assert store.delete_status("node:42") == {
+        "task_id": "node:42",
+        "completed": True,
+        "deleted": 7,
+        "total": 7,
+        "failures": [],
+    }
+    mock_client.tasks.get.assert_called_once_with(task_id="node:42")
+    mock_client.tasks.get.side_effect = NotFoundError(404, "missing", {})
+    assert store.delete_status("node:43") is None
+
+
+def test_list_files_streams_ndjson(mocker):
+    rows = [
+        {"unique_id": "u1", "file_path": "a.pdf", "pages": 2},
+        {"unique_id": "u2", "file_path": "b.pdf", "pages": 1},
+    ]
+    store = mocker.patch("aws_rag_quickstart.vector_store.get_vector_store")
+    store.return_value.iter_files.return_value = iter(rows)
+
+    client = TestClient(app)
+    response = client.get("/files?unique_id=u1&unique_id=u2&page_size=50")
+
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in response.text.splitlines()] == rows
+    store.return_value.iter_files.assert_called_once_with(["u1", "u2"], 50)
+    assert client.get("/files?page_size=0").status_code == 422
+    assert client.get("/files?page_size=100000").status_code == 422
+
+
+def test_bulk_delete_is_one_task(mocker, answer_cache):
+    store = mocker.patch("aws_rag_quickstart.vector_store.get_vector_store")
+    store.return_value.delete_files.return_value = {"task_id": "node:1"}
+    invalidate = mocker.spy(answer_cache, "invalidate")
+    mocker.patch(
+        "aws_rag_quickstart.vector_store.get_answer_cache",
+        return_value=answer_cache,
     )
-    expected_query_body = {"query": {"match": {"file_path": file_path}}}
-    mock_client.delete_by_query.assert_called_once_with(
-        index=index_name, body=expected_query_body
+    mocker.patch("aws_rag_quickstart.vector_store.release_when_deleted")
+    client = TestClient(app)
+    file_paths = [f"{i}.pdf" for i in range(100)]
+
+    response = client.request(
+        "DELETE",
+        "/bulk",
+        json={"event": {"unique_id": "u1", "file_paths": file_paths}},
     )
-    assert result == mock_response
+
+    assert response.json()["task_id"] == "node:1"
+    store.return_value.delete_files.assert_called_once_with(file_paths, "u1")
+    invalidate.assert_called_once_with(["u1"])
+    response = client.request(
+        "DELETE",
+        "/manifest",
+        files={"file": ("m.json", '[{"name": "a.pdf"}]')},
+    )
+    assert response.json() == {"unique_id": "m.json", "task_id": "node:1"}
+    store.return_value.delete_files.assert_called_with(["a.pdf"], "m.json")
+
+
+def test_delete_holds_answers_until_it_completes(mocker, tmp_path):
+    path = str(tmp_path / "invalidations.db")
+    cache = SemanticAnswerCache(invalidation_path=path)
+    other_worker = SemanticAnswerCache(invalidation_path=path)
+    store = Mock()
+    store.delete_files.return_value = {"task_id": "node:2"}
+    store.delete_status.side_effect = [
+        {"completed": False},
+        {"completed": True},
+    ]
+    mocker.patch(
+        "aws_rag_quickstart.vector_store.get_vector_store", return_value=store
+    )
+    mocker.patch(
+        "aws_rag_quickstart.vector_store.get_answer_cache", return_value=cache
+    )
+    thread = mocker.patch("aws_rag_quickstart.vector_store.threading.Thread")
+    delete_files(["a.pdf"], "u1")
+    # a chat on another worker retrieving the pages being deleted
+    started = time.time()
+    other_worker.store(["u1"], [1.0, 0.0], "stale answer")
+    assert other_worker.lookup(["u1"], [1.0, 0.0]) is None
+
+    # nobody polls delete_status, the watcher sees the delete complete
+    release_when_deleted(*thread.call_args.kwargs["args"], interval=0)
+    assert store.delete_status.call_count == 2
+    other_worker.store(["u1"], [1.0, 0.0], "late answer", created=started)
+    assert other_worker.lookup(["u1"], [1.0, 0.0]) is None
+    other_worker.store(["u1"], [1.0, 0.0], "fresh answer")
+    assert other_worker.lookup(["u1"], [1.0, 0.0]) == "fresh answer"
+    # a client polling afterwards changes nothing
+    store.delete_status.side_effect = None
+    store.delete_status.return_value = {"completed": True}
+    delete_status("node:2")
+    assert other_worker.lookup(["u1"], [1.0, 0.0]) == "fresh answer"
+
+
+def test_answer_cache_hold_expires(tmp_path):
+    cache = SemanticAnswerCache(invalidation_path=str(tmp_path / "i.db"))
+    cache.hold("t1", ["u1"], seconds=0.05)
+    started = time.time()
+    time.sleep(0.1)
+    # expired holds are folded into invalidations, keeping the table small
+    cache.hold("t2", ["u2"])
+    cache.store(["u1"], [1.0, 0.0], "late answer", created=started)
+    assert cache.lookup(["u1"], [1.0, 0.0]) is None
+    cache.store(["u1"], [1.0, 0.0], "fresh answer")
+    assert cache.lookup(["u1"], [1.0, 0.0]) == "fresh answer"
+    assert cache._db.execute("SELECT key FROM holds").fetchall() == [("t2",)]
 
 
 def test_os_similarity_search_success(mocker):
@@ -279,7 +865,7 @@ def test_os_similarity_search_success(mocker):
     mock_os_client = mock.Mock()
     mock_os_client.search.return_value = {"hits": {"total": 1, "hits": []}}
     mocker.patch(
-        "aws_rag_quickstart.AgentLambda.get_opensearch_connection",
+        "aws_rag_quickstart.opensearch.get_opensearch_client",
         return_value=mock_os_client,
     )
 
@@ -314,7 +900,7 @@ def test_os_similarity_search_invalid_json(mocker):
     }
     with patch("os.environ", {"BEDROCK_ENDPOINT": "https://foo"}), patch(
         "boto3.session"
-    ), mock.patch("aws_rag_quickstart.AgentLambda.get_opensearch_connection"), mock.patch(
+    ), mock.patch("aws_rag_quickstart.opensearch.get_opensearch_client"), mock.patch(
         "aws_rag_quickstart.LLM.BedrockEmbeddings"
     ), mock.patch(
         "aws_rag_quickstart.LLM.ChatBedrock"
@@ -323,43 +909,251 @@ def test_os_similarity_search_invalid_json(mocker):
     assert result
 
 
-def test_get_all_indexed_files_success(mocker):
-    index_name = "test-index"
+def hits(*ids):
+    return {"hits": {"hits": [{"_id": i, "_source": {}} for i in ids]}}
 
-    expected_query_body = {
-        "size": 0,
-        "aggs": {
-            "ids": {
-                "composite": {
-                    "sources": [
-                        {"ids": {"terms": {"field": "unique_id.keyword"}}}
-                    ]
-                }
-            }
-        },
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion(
+        [hits("a", "b", "c"), hits("c", "d")], [1.0, 2.0], k=1, size=3
+    )
+
+    ranked = [hit["_id"] for hit in fused["hits"]["hits"]]
+    assert ranked == ["c", "d", "a"]
+    assert fused["hits"]["hits"][0]["_score"] == 1 / 4 + 2 / 2
+    assert fused["hits"]["total"]["value"] == 4
+
+
+def test_hybrid_search_skips_failed_retriever():
+    mock_client = Mock()
+    mock_client.msearch.return_value = {
+        "responses": [hits("a", "b"), {"error": "boom"}]
     }
 
-    mock_response = {
-        "aggregations": {
-            "ids": {
-                "buckets": [
-                    {"key": "file1.pdf", "doc_count": 10},
-                    {"key": "file2.pdf", "doc_count": 8},
-                ]
-            }
+    result = hybrid_search(mock_client, "idx", "question", [0.1], ["foo"], k=5)
+
+    assert [hit["_id"] for hit in result["hits"]["hits"]] == ["a", "b"]
+    body = mock_client.msearch.call_args.kwargs["body"]
+    assert body[0] == body[2] == {"index": "idx"}
+    assert body[1]["query"]["knn"]["embedding"]["k"] == 5
+    assert body[3]["query"]["bool"]["must"] == [
+        {"match": {"llm_generated": "question"}}
+    ]
+
+
+def test_os_similarity_search_identifier_is_lexical(mocker):
+    mock_embeddings = mocker.patch("aws_rag_quickstart.AgentLambda.Embeddings")
+    mock_client = mocker.patch(
+        "aws_rag_quickstart.opensearch.get_opensearch_client"
+    ).return_value
+
+    os_similarity_search.invoke(
+        {"context": {"question": "AB-1234?", "unique_ids": ["foo"]}}
+    )
+
+    mock_embeddings.assert_not_called()
+    body = mock_client.search.call_args.kwargs["body"]
+    assert body["query"]["bool"]["must"] == [
+        {"match": {"llm_generated": "AB-1234?"}}
+    ]
+
+
+def test_agent_main_identifier_skips_embedding(mocker, answer_cache):
+    mock_embeddings = mocker.patch("aws_rag_quickstart.AgentLambda.Embeddings")
+    mocker.patch("aws_rag_quickstart.opensearch.get_opensearch_client")
+    mocker.patch("aws_rag_quickstart.AgentLambda.has_docs", return_value=True)
+    mock_chain = mocker.patch("aws_rag_quickstart.AgentLambda.rag_chain")
+    mock_chain.return_value.invoke.return_value = "answer"
+    event = {"question": "AB-1234?", "unique_ids": ["foo"]}
+
+    assert agent_main(event) == "answer"
+
+    mock_embeddings.return_value.embed_query.assert_not_called()
+    assert answer_cache.stats["misses"] == 0
+
+
+def test_os_similarity_search_vector_only_store(mocker):
+    store = Mock(spec=VectorStore)
+    store.knn_search.return_value = {"hits": {"hits": []}}
+    mocker.patch(
+        "aws_rag_quickstart.AgentLambda.get_vector_store", return_value=store
+    )
+    mocker.patch("aws_rag_quickstart.AgentLambda.Embeddings")
+
+    os_similarity_search.invoke(
+        {"context": {"question": "AB-1234?", "unique_ids": ["foo"]}}
+    )
+
+    store.knn_search.assert_called_once()
+
+
+def test_os_similarity_search_hybrid(mocker):
+    mocker.patch("aws_rag_quickstart.AgentLambda.RETRIEVAL_MODE", "hybrid")
+    mocker.patch("aws_rag_quickstart.AgentLambda.Embeddings")
+    mocker.patch("aws_rag_quickstart.opensearch.get_opensearch_client")
+    mock_hybrid = mocker.patch("aws_rag_quickstart.opensearch.hybrid_search")
+
+    result = os_similarity_search.invoke(
+        {"context": {"question": "what is shown?", "unique_ids": ["foo"]}}
+    )
+
+    assert result == mock_hybrid.return_value
+    assert mock_hybrid.call_args.args[2] == "what is shown?"
+
+
+def page_hit(text, score, embedding=None):
+    source = {"llm_generated": text, "unique_id": "foo", "page_hash": "h"}
+    if embedding is not None:
+        source["embedding"] = embedding
+    return {"_id": text, "_score": score, "_source": source}
+
+
+def test_build_context_mmr_dedup_and_budget():
+    response = {
+        "hits": {
+            "hits": [
+                page_hit("cats", 1.0, [1.0, 0.0, 0.0]),
+                page_hit("cats again", 0.9, [0.999, 0.01, 0.0]),
+                page_hit("kittens", 0.8, [0.9, 0.4, 0.0]),
+                page_hit("dogs", 0.5, [0.0, 1.0, 0.0]),
+                page_hit("cats", 0.4, [1.0, 0.0, 0.0]),
+            ]
+        }
+    }
+
+    context = build_context(response, max_tokens=100, mmr_lambda=0.5)
+
+    assert context.split("\n\n") == [
+        "llm_generated: cats",
+        "llm_generated: dogs",
+        "llm_generated: kittens",
+    ]
+    assert "unique_id" not in context
+    assert build_context(response, max_tokens=6, mmr_lambda=0.5) == (
+        "llm_generated: cats"
+    )
+
+
+def test_build_context_keeps_search_order_without_embeddings():
+    response = {"hits": {"hits": [page_hit("b", 2.0), page_hit("a", 1.0)]}}
+
+    context = build_context(response, fields=["llm_generated"])
+
+    assert context == "llm_generated: b\n\nllm_generated: a"
+
+
+def test_build_context_ranks_only_hits_with_embeddings():
+    response = {
+        "hits": {
+            "hits": [
+                page_hit("cats", 1.0, [1.0, 0.0]),
+                page_hit("cats again", 0.9, [0.999, 0.01]),
+                page_hit("dogs", 0.8),
+            ]
         }
     }
 
+    context = build_context(response, fields=["llm_generated"])
+
+    assert context == "llm_generated: cats\n\nllm_generated: dogs"
+
+
+def test_os_similarity_search_fetches_top_embeddings(mocker):
+    mocker.patch("aws_rag_quickstart.AgentLambda.Embeddings")
+    mock_client = mocker.patch(
+        "aws_rag_quickstart.opensearch.get_opensearch_client"
+    ).return_value
+    mock_client.search.return_value = {
+        "hits": {"hits": [page_hit(text, 1.0) for text in "abc"]}
+    }
+    mock_client.mget.return_value = {
+        "docs": [
+            {"_id": "a", "found": True, "_source": {"embedding": [1.0]}},
+            {"_id": "b", "found": False},
+        ]
+    }
+
+    result = os_similarity_search.invoke(
+        {"context": {"question": "what is shown?", "unique_ids": ["foo"]}}
+    )
+
+    body = mock_client.search.call_args.kwargs["body"]
+    assert body["_source"] == {"exclude": ["embedding"]}
+    docs = mock_client.mget.call_args.kwargs["body"]["docs"]
+    assert [doc["_id"] for doc in docs] == ["a", "b", "c"]
+    sources = [hit["_source"] for hit in result["hits"]["hits"]]
+    assert [source.get("embedding") for source in sources] == [
+        [1.0],
+        None,
+        None,
+    ]
+
+
+def test_get_all_indexed_files_success(mocker):
+    index_name = "test-index"
+
+    def query_body(after=None):
+        composite = {
+            "size": 2,
+            "sources": [{"ids": {"terms": {"field": "unique_id"}}}],
+        }
+        if after is not None:
+            composite["after"] = after
+        return {"size": 0, "aggs": {"ids": {"composite": composite}}}
+
+    pages = [
+        [{"key": {"ids": "u1"}, "doc_count": 10}] * 2,
+        [{"key": {"ids": "u3"}, "doc_count": 8}],
+    ]
+    bodies = []
+
+    def search(index, body):
+        bodies.append(json.loads(json.dumps(body)))
+        buckets = pages[len(bodies) - 1]
+        after_key = {"after_key": buckets[-1]["key"]}
+        return {"aggregations": {"ids": {"buckets": buckets, **after_key}}}
+
     mock_os_client = mock.Mock()
     mocker.patch(
-        "aws_rag_quickstart.opensearch.get_opensearch_connection", return_value=mock_os_client
+        "aws_rag_quickstart.opensearch.get_opensearch_client", return_value=mock_os_client
     )
-    mock_os_client.search.return_value = mock_response
-    result = get_all_indexed_files_opensearch(index_name)
-    mock_os_client.search.assert_called_once_with(
-        index=index_name, body=expected_query_body
-    )
-    assert result == mock_response["aggregations"]["ids"]["buckets"]
+    mock_os_client.search.side_effect = search
+    result = get_all_indexed_files_opensearch(index_name, page_size=2)
+    assert bodies == [query_body(), query_body(after={"ids": "u1"})]
+    assert result == pages[0] + pages[1]
+
+
+def test_iter_indexed_files_streams_pages(mocker):
+    mock_client = mocker.MagicMock()
+    mock_client.search.side_effect = [
+        {
+            "aggregations": {
+                "ids": {
+                    "buckets": [
+                        {
+                            "key": {"unique_id": "u1", "file_path": "a.pdf"},
+                            "doc_count": 3,
+                        }
+                    ],
+                    "after_key": {"unique_id": "u1", "file_path": "a.pdf"},
+                }
+            }
+        },
+        {"aggregations": {"ids": {"buckets": []}}},
+    ]
+
+    files = iter_indexed_files(mock_client, "test-index", ["u1"], 1)
+
+    assert mock_client.search.call_count == 0
+    assert list(files) == [
+        {"unique_id": "u1", "file_path": "a.pdf", "pages": 3}
+    ]
+    body = mock_client.search.call_args.kwargs["body"]
+    assert body["query"] == unique_id_filter(["u1"])
+    assert body["aggs"]["ids"]["composite"]["after"] == {
+        "unique_id": "u1",
+        "file_path": "a.pdf",
+    }
 
 
 def test_get_all_indexed_files_malformed_response(mocker):
@@ -367,33 +1161,746 @@ def test_get_all_indexed_files_malformed_response(mocker):
     mock_response = {}
     mock_os_client = mock.Mock()
     mocker.patch(
-        "aws_rag_quickstart.opensearch.get_opensearch_connection", return_value=mock_os_client
+        "aws_rag_quickstart.opensearch.get_opensearch_client", return_value=mock_os_client
     )
     mock_os_client.search.return_value = mock_response
     with pytest.raises(AttributeError):
         get_all_indexed_files_opensearch(index_name)
 
 
-def test_process_file_success(mocker):
+def page_image(content):
+    return Mock(tobytes=Mock(return_value=content))
+
+
+@pytest.fixture
+def s3_object(mocker):
+    mocker.patch.dict("os.environ", {"S3_BUCKET": "foo"})
+    s3 = Mock(
+        head_object=Mock(return_value={"ETag": '"etag-2"'}),
+        download_fileobj=Mock(
+            side_effect=lambda Bucket, Key, Fileobj, **kwargs: Fileobj.write(
+                b"%PDF"
+            )
+        ),
+    )
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.get_s3_client", return_value=s3
+    )
+    # scanned PDFs unless a test gives pages a text layer
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.pdf_page_texts",
+        side_effect=lambda pdf_path, page_count: [""] * page_count,
+    )
+    return s3
+
+
+def test_process_file_success(mocker, s3_object):
     input_dict = {
         "file_path": "test.pdf",
         "other_metadata": "example metadata",
     }
 
-    with patch("os.environ", {"S3_BUCKET": "foo"}), patch(
-        "boto3.session"
-    ), patch(
-        "aws_rag_quickstart.IngestionLambda.convert_from_bytes",
-        Mock(return_value=[Mock(), Mock()]),
+    mock_os_client = mocker.MagicMock()
+    mock_os_client.search.return_value = {"hits": {"hits": []}}
+    mock_os_client.bulk.return_value = {
+        "errors": False,
+        "items": [{"index": {"status": 201}}] * 2,
+    }
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.pdf_page_count", return_value=2
+    )
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.encode_page", return_value="page"
+    )
+    with patch(
+        "aws_rag_quickstart.IngestionLambda.iter_pdf_pages",
+        Mock(return_value=[(1, page_image(b"1")), (2, page_image(b"2"))]),
     ):
-        result = process_file(input_dict, Mock(), Mock(), Mock(), Mock())
+        result = process_file(
+            input_dict,
+            Mock(),
+            OpenSearchStore(mock_os_client, "test-index"),
+            Mock(embed_documents=lambda texts: [[0.1]] * len(texts)),
+        )
 
     assert result == 2  # We processed 2 pages
+    mock_os_client.bulk.assert_called_once()
+    assert mock_os_client.bulk.call_args.kwargs["refresh"] == "wait_for"
+    body = mock_os_client.bulk.call_args.kwargs["body"]
+    assert body[0]["index"]["_id"] == page_document_id(
+        None, "test.pdf", "page_1"
+    )
+    assert body[1]["source_etag"] == "etag-2"
+    assert body[1]["page_count"] == 2
+
+
+def test_process_file_writes_pages_off_the_rendering_thread(
+    mocker, s3_object
+):
+    added = []
+    indexer = mocker.patch("aws_rag_quickstart.IngestionLambda.BulkIndexer")
+    indexer.return_value.add.side_effect = lambda document, doc_id: (
+        added.append((document["page_number"], threading.get_ident()))
+    )
+    indexer.return_value.close.return_value = {"indexed": 3, "failures": []}
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.pdf_page_count", return_value=3
+    )
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.encode_page", return_value="page"
+    )
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.iter_pdf_pages",
+        return_value=[(n, page_image(str(n).encode())) for n in (1, 2, 3)],
+    )
+    store = Mock(indexed_pages=Mock(return_value={}))
+
+    assert process_file({"file_path": "test.pdf"}, Mock(), store, Mock()) == 3
+    assert [page for page, _ in added] == ["page_1", "page_2", "page_3"]
+    assert threading.get_ident() not in {thread for _, thread in added}
+
+
+def test_process_file_skips_unchanged_file(mocker, s3_object):
+    source = {"source_etag": "etag-2", "page_count": 2}
+    mock_os_client = mocker.MagicMock()
+    mock_os_client.search.return_value = {
+        "hits": {
+            "hits": [
+                {"_id": "a", "_source": source},
+                {"_id": "b", "_source": source},
+            ]
+        }
+    }
+    mock_pages = mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.iter_pdf_pages"
+    )
+
+    result = process_file(
+        {"file_path": "test.pdf", "unique_id": "foo"},
+        Mock(),
+        OpenSearchStore(mock_os_client, "test-index"),
+        Mock(),
+    )
+
+    assert result == 2
+    s3_object.download_fileobj.assert_not_called()
+    mock_pages.assert_not_called()
+    mock_os_client.bulk.assert_not_called()
+
+
+def test_process_file_only_describes_changed_pages(mocker, s3_object):
+    def doc_id(page):
+        return page_document_id("foo", "test.pdf", f"page_{page}")
+
+    def indexed(page, content):
+        return {
+            "_id": doc_id(page),
+            "_source": {
+                "page_hash": hashlib.sha256(content).hexdigest(),
+                "source_etag": "etag-1",
+                "page_count": 3,
+            },
+        }
+
+    mock_os_client = mocker.MagicMock()
+    mock_os_client.search.return_value = {
+        "hits": {
+            "hits": [
+                indexed(1, b"same"),
+                indexed(2, b"old"),
+                indexed(3, b"removed"),
+                {"_id": "legacy", "_source": {"page_number": "page_1"}},
+            ]
+        }
+    }
+    mock_os_client.bulk.return_value = {"errors": False, "items": []}
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.pdf_page_count", return_value=2
+    )
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.iter_pdf_pages",
+        return_value=[(1, page_image(b"same")), (2, page_image(b"new"))],
+    )
+    mock_augment = mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.augment_metadata",
+        return_value={"llm_generated": "new page"},
+    )
+    mocker.patch("aws_rag_quickstart.IngestionLambda.encode_page")
+    mock_embeddings = Mock(embed_documents=Mock(return_value=[[0.1]]))
+
+    result = process_file(
+        {"file_path": "test.pdf", "unique_id": "foo"},
+        Mock(),
+        OpenSearchStore(mock_os_client, "test-index"),
+        mock_embeddings,
+    )
+
+    assert result == 2
+    mock_augment.assert_called_once()
+    mock_embeddings.embed_documents.assert_called_once_with(["new page"])
+    body = mock_os_client.bulk.call_args.kwargs["body"]
+    source = {"source_etag": "etag-2", "page_count": 2}
+    assert body[0] == {"update": {"_id": doc_id(1), "_index": "test-index"}}
+    assert body[1] == {"doc": source}
+    assert body[2] == {"index": {"_id": doc_id(2), "_index": "test-index"}}
+    assert body[3]["page_hash"] == hashlib.sha256(b"new").hexdigest()
+    deletes = body[4:]
+    assert [next(iter(action)) for action in deletes] == ["delete"] * 2
+    assert {action["delete"]["_id"] for action in deletes} == {
+        doc_id(3),
+        "legacy",
+    }
+
+
+def test_process_file_indexes_text_layer_pages(mocker, s3_object):
+    text = "Born-digital page with plenty of embedded text. " * 10
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.pdf_page_texts",
+        return_value=[text, "   \f ", text],
+    )
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.pdf_page_count", return_value=3
+    )
+    mock_pages = mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.iter_pdf_pages",
+        return_value=[(2, page_image(b"scan"))],
+    )
+    mock_augment = mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.augment_metadata",
+        return_value={"llm_generated": "scanned page"},
+    )
+    mocker.patch("aws_rag_quickstart.IngestionLambda.encode_page")
+    mock_indexer = mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.BulkIndexer"
+    )
+    mock_indexer.return_value.close.return_value = {
+        "indexed": 3,
+        "failures": [],
+    }
+    store = Mock(indexed_pages=Mock(return_value={}))
+
+    assert process_file({"file_path": "test.pdf"}, Mock(), store, Mock()) == 3
+
+    assert mock_pages.call_args.kwargs["pages"] == [2]
+    mock_augment.assert_called_once()
+    added = [c.args[0] for c in mock_indexer.return_value.add.call_args_list]
+    assert [doc["page_number"] for doc in added] == [
+        "page_1",
+        "page_2",
+        "page_3",
+    ]
+    assert added[0]["llm_generated"] == text
+    assert added[0]["page_hash"].startswith("text:")
+    assert added[1]["llm_generated"] == "scanned page"
+
+
+def test_pdf_page_texts_falls_back_to_rendering(mocker):
+    run = mocker.patch(
+        "aws_rag_quickstart.rasterize.subprocess.run",
+        return_value=Mock(stdout="one\ftwo\f".encode()),
+    )
+    assert pdf_page_texts("test.pdf", 3) == ["one", "two", ""]
+    assert run.call_args.args[0][0] == "pdftotext"
+    assert "test.pdf" in run.call_args.args[0]
+    run.side_effect = FileNotFoundError("pdftotext")
+    assert pdf_page_texts("test.pdf", 2) == ["", ""]
+
+
+def test_process_file_rejects_skipped_page(mocker, s3_object):
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.pdf_page_count", return_value=3
+    )
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.iter_pdf_pages",
+        return_value=[(1, page_image(b"1")), (3, page_image(b"3"))],
+    )
+    mocker.patch("aws_rag_quickstart.IngestionLambda.describe_page")
+    mock_indexer = mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.BulkIndexer"
+    )
+    store = Mock(indexed_pages=Mock(return_value={}))
+
+    with pytest.raises(RuntimeError, match="Expected page 2"):
+        process_file({"file_path": "test.pdf"}, Mock(), store, Mock())
+
+    mock_indexer.return_value.close.assert_not_called()
+
+
+def test_iter_pdf_pages_rejects_short_window(mocker):
+    mocker.patch(
+        "aws_rag_quickstart.rasterize.convert_from_path",
+        return_value=[Mock(), Mock()],
+    )
+
+    with pytest.raises(RuntimeError, match="2 images for pages 1 to 3"):
+        list(iter_pdf_pages("test.pdf", window=3, pages=[1, 2, 3], threads=1))
+
+
+class FileS3:
+    """
+    S3 client serving objects from a local directory.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.configs = []
+        self.extra_args = []
+
+    def head_object(self, Bucket, Key):
+        with open(os.path.join(self.root, Bucket, Key), "rb") as f:
+            return {"ETag": f'"{hashlib.md5(f.read()).hexdigest()}"'}
+
+    def download_fileobj(self, Bucket, Key, Fileobj, ExtraArgs, Config):
+        self.configs.append(Config)
+        self.extra_args.append(ExtraArgs)
+        with open(os.path.join(self.root, Bucket, Key), "rb") as f:
+            shutil.copyfileobj(f, Fileobj)
+
+
+def test_download_object_spools_to_temp_file(mocker, tmp_path):
+    (tmp_path / "bucket").mkdir()
+    (tmp_path / "bucket" / "test.pdf").write_bytes(b"%PDF" * 1000)
+    (tmp_path / "tmp").mkdir()
+    mocker.patch("tempfile.tempdir", str(tmp_path / "tmp"))
+    s3 = FileS3(tmp_path)
+
+    with download_object(s3, "bucket", "test.pdf") as pdf_path:
+        assert pdf_path.endswith(".pdf")
+        with open(pdf_path, "rb") as f:
+            assert f.read() == b"%PDF" * 1000
+
+    assert s3.configs == [TRANSFER_CONFIG]
+    assert not os.listdir(tmp_path / "tmp")
+    with pytest.raises(FileNotFoundError):
+        with download_object(s3, "bucket", "missing.pdf"):
+            pass
+    assert not os.listdir(tmp_path / "tmp")
+
+
+def test_download_object_pins_checked_version(mocker, tmp_path):
+    (tmp_path / "bucket").mkdir()
+    (tmp_path / "bucket" / "test.pdf").write_bytes(b"%PDF-1")
+    (tmp_path / "tmp").mkdir()
+    mocker.patch("tempfile.tempdir", str(tmp_path / "tmp"))
+    s3 = FileS3(tmp_path)
+    etag = s3.head_object("bucket", "test.pdf")["ETag"].strip('"')
+
+    with download_object(s3, "bucket", "test.pdf", etag, "v1"):
+        pass
+    with download_object(s3, "bucket", "test.pdf", etag):
+        pass
+    assert s3.extra_args == [{"VersionId": "v1"}, None]
+
+    # overwritten between the ETag check and the download
+    (tmp_path / "bucket" / "test.pdf").write_bytes(b"%PDF-2")
+    with pytest.raises(RuntimeError, match="changed while downloading"):
+        with download_object(s3, "bucket", "test.pdf", etag):
+            pass
+    assert not os.listdir(tmp_path / "tmp")
+
+
+def test_get_s3_client_is_shared(mocker):
+    mock_session = mocker.patch("boto3.session.Session")
+    get_s3_client.cache_clear()
+    try:
+        assert get_s3_client() is get_s3_client()
+    finally:
+        get_s3_client.cache_clear()
+
+    mock_session.assert_called_once()
+    config = mock_session.return_value.client.call_args.kwargs["config"]
+    assert config.max_pool_connections == 32
+
+
+def test_process_file_keeps_page_order(mocker, s3_object):
+    def slow_first_pages(llm, image_string, general_metadata):
+        # earlier pages finish last
+        time.sleep(0.01 * (5 - int(image_string)))
+        return {"llm_generated": image_string}
+
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.augment_metadata",
+        side_effect=slow_first_pages,
+    )
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.encode_page",
+        side_effect=lambda image: image.tobytes().decode(),
+    )
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.iter_pdf_pages",
+        return_value=[
+            (page, page_image(str(page).encode())) for page in range(1, 5)
+        ],
+    )
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.pdf_page_count", return_value=4
+    )
+    mock_indexer = mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.BulkIndexer"
+    )
+    mock_indexer.return_value.close.return_value = {
+        "indexed": 4,
+        "failures": [],
+    }
+
+    result = process_file(
+        {"file_path": "test.pdf"},
+        Mock(),
+        Mock(indexed_pages=Mock(return_value={})),
+        Mock(),
+        4,
+    )
+
+    assert result == 4
+    added = [
+        call.args[0]["page_number"]
+        for call in mock_indexer.return_value.add.call_args_list
+    ]
+    assert added == ["page_1", "page_2", "page_3", "page_4"]
+
+
+def test_bulk_indexer_flushes_by_count(mocker):
+    mock_client = mocker.MagicMock()
+    mock_client.bulk.return_value = {
+        "errors": False,
+        "items": [{"index": {"status": 201}}] * 2,
+    }
+    mock_embeddings = mocker.MagicMock()
+    mock_embeddings.embed_documents.side_effect = lambda texts: [
+        [0.1, 0.2]
+    ] * len(texts)
+
+    indexer = BulkIndexer(
+        OpenSearchStore(mock_client, "test-index"), mock_embeddings, max_docs=2
+    )
+    for i in range(4):
+        indexer.add({"llm_generated": f"page {i}"})
+    assert mock_client.bulk.call_count == 2
+    assert mock_embeddings.embed_documents.call_count == 2
+    for call in mock_client.bulk.call_args_list:
+        assert "refresh" not in call.kwargs
+        assert call.kwargs["body"][0] == {"index": {"_index": "test-index"}}
+        assert call.kwargs["body"][1]["embedding"] == [0.1, 0.2]
+
+    result = indexer.close()
+    mock_client.indices.refresh.assert_called_once_with(index="test-index")
+    assert result == {"indexed": 4, "failures": []}
+
+
+def test_bulk_indexer_reports_item_failures(mocker):
+    mock_client = mocker.MagicMock()
+    mock_client.bulk.return_value = {
+        "errors": True,
+        "items": [
+            {"index": {"status": 201}},
+            {"index": {"status": 400, "error": {"type": "mapper_parsing"}}},
+        ],
+    }
+    documents = [
+        {"llm_generated": "ok", "page_number": "page_1"},
+        {"llm_generated": "bad", "page_number": "page_2"},
+    ]
+    mock_embeddings = mocker.MagicMock()
+    mock_embeddings.embed_documents.side_effect = lambda texts: [
+        [0.1]
+    ] * len(texts)
+    store = OpenSearchStore(mock_client, "test-index")
+    with BulkIndexer(store, mock_embeddings) as bulk:
+        for document in documents:
+            bulk.add(document)
+
+    mock_client.bulk.assert_called_once()
+    assert mock_client.bulk.call_args.kwargs["refresh"] == "wait_for"
+    mock_client.indices.refresh.assert_not_called()
+    assert bulk.indexed == 1
+    assert bulk.failures == [
+        {
+            "file_path": None,
+            "page_number": "page_2",
+            "status": 400,
+            "error": {"type": "mapper_parsing"},
+        }
+    ]
+
+
+def numpy_page(uid, path, page, embedding):
+    return {
+        "unique_id": uid,
+        "file_path": path,
+        "page_number": f"page_{page}",
+        "page_hash": f"{path}{page}",
+        "llm_generated": f"{path} page {page}",
+        "embedding": embedding,
+    }
+
+
+def test_numpy_vector_store(tmp_path):
+    store = NumpyVectorStore("idx", str(tmp_path))
+    assert not store.exists()
+    store.create(Mock(dimension=2))
+    embeddings = Mock(
+        embed_documents=lambda texts: [
+            [1.0, 0.0] if "a.pdf" in text else [0.0, 1.0] for text in texts
+        ]
+    )
+    with BulkIndexer(store, embeddings) as indexer:
+        for page in (1, 2):
+            document = numpy_page("u1", "a.pdf", page, None)
+            indexer.add(document, f"a{page}")
+        indexer.add(numpy_page("u2", "b.pdf", 1, None), "b1")
+    assert indexer.indexed == 3
+
+    response = store.knn_search([1.0, 0.1], ["u1", "u2"], k=2)
+    hits = response["hits"]["hits"]
+    assert [hit["_id"] for hit in hits] == ["a1", "a2"]
+    assert hits[0]["_score"] == pytest.approx(1.0)
+    assert "embedding" not in hits[0]["_source"]
+    only_u2 = store.knn_search([1.0, 0.0], ["u2"], include_embedding=True)
+    assert [hit["_id"] for hit in only_u2["hits"]["hits"]] == ["b1"]
+    assert only_u2["hits"]["hits"][0]["_source"]["embedding"] == [0.0, 1.0]
+    assert store.embeddings(["b1", "missing"]) == {"b1": [0.0, 1.0]}
+    assert store.knn_search([1.0, 0.0], ["u3"])["hits"]["hits"] == []
+
+    result = store.bulk(
+        [
+            {"update": {"_id": "a1"}},
+            {"doc": {"source_etag": "e1"}},
+            {"delete": {"_id": "a2"}},
+            {"index": {"_id": "bad"}},
+            {"llm_generated": "x", "embedding": [1.0]},
+        ]
+    )
+    assert result["errors"]
+    assert result["items"][2]["index"]["status"] == 400
+    assert store.indexed_pages("u1", "a.pdf") == {
+        "a1": {
+            "page_number": "page_1",
+            "page_hash": "a.pdf1",
+            "source_etag": "e1",
+        }
+    }
+    store.bulk([{"update": {"_id": "b1"}}, {"doc": {"unique_id": "u3"}}])
+    only_u3 = store.knn_search([1.0, 0.0], ["u3", "unknown"])
+    assert [hit["_id"] for hit in only_u3["hits"]["hits"]] == ["b1"]
+    store.bulk([{"update": {"_id": "b1"}}, {"doc": {"unique_id": "u2"}}])
+    assert list(store.iter_files(page_size=1)) == [
+        {"unique_id": "u1", "file_path": "a.pdf", "pages": 1},
+        {"unique_id": "u2", "file_path": "b.pdf", "pages": 1},
+    ]
+    assert [row["file_path"] for row in store.iter_files(["u2"])] == ["b.pdf"]
+
+    # a second process sees the same data
+    other = NumpyVectorStore("idx", str(tmp_path))
+    assert other.docs_by_id(["u1", "u2"]) == {
+        "num_pages": 2,
+        "num_files": 2,
+        "docs_list": ["a.pdf", "b.pdf"],
+    }
+    assert other.has_docs(["u2", "u3"])
+    assert not other.has_docs(["u3"])
+    task = other.delete_files(["b.pdf", "c.pdf"])
+    assert store.delete_status(task["task_id"])["deleted"] == 1
+    assert store.knn_search([0.0, 1.0], ["u2"])["hits"]["hits"] == []
+    assert store.delete_files(["a.pdf"], unique_id="u2") != task
+    assert store.docs_by_id(["u1"])["num_pages"] == 1
+    task = store.delete_files(unique_id="u1")
+    assert store.delete_status(task["task_id"])["deleted"] == 1
+    assert store.delete_status("unknown") is None
+
+
+def test_process_file_keeps_other_unique_ids_pages(
+    mocker, s3_object, tmp_path
+):
+    store = NumpyVectorStore("idx", str(tmp_path))
+    store.create(Mock(dimension=2))
+    embeddings = Mock(embed_documents=lambda texts: [[1.0, 0.0]] * len(texts))
+    with BulkIndexer(store, embeddings) as indexer:
+        for uid in ("u1", None):
+            doc_id = page_document_id(uid, "a.pdf", "page_1")
+            indexer.add(numpy_page(uid, "a.pdf", 1, None), doc_id)
+    assert list(store.indexed_pages(None, "a.pdf")) == [
+        page_document_id(None, "a.pdf", "page_1")
+    ]
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.pdf_page_count", return_value=2
+    )
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.iter_pdf_pages",
+        return_value=[(1, page_image(b"1")), (2, page_image(b"2"))],
+    )
+    mocker.patch(
+        "aws_rag_quickstart.IngestionLambda.augment_metadata",
+        side_effect=lambda llm, image, general_metadata, *args: {
+            **general_metadata,
+            "llm_generated": "new page",
+        },
+    )
+    mocker.patch("aws_rag_quickstart.IngestionLambda.encode_page")
+
+    assert process_file({"file_path": "a.pdf"}, Mock(), store, embeddings) == 2
+
+    assert store.docs_by_id(["u1"])["num_pages"] == 1
+    assert len(store.indexed_pages(None, "a.pdf")) == 2
+    assert len(store.indexed_pages("u1", "a.pdf")) == 1
+
+
+def test_get_indexed_pages_without_unique_id(mocker):
+    client = mocker.MagicMock()
+    client.search.return_value = {"hits": {"hits": []}}
+
+    get_indexed_pages(client, "idx", None, "a.pdf")
+    query = client.search.call_args.kwargs["body"]["query"]["bool"]
+    assert query["must_not"] == [{"exists": {"field": "unique_id"}}]
+
+    get_indexed_pages(client, "idx", "u1", "a.pdf")
+    query = client.search.call_args.kwargs["body"]["query"]["bool"]
+    assert {"term": {"unique_id": "u1"}} in query["filter"]
+    assert "must_not" not in query
+
+
+def test_numpy_vector_store_inverted_file(tmp_path):
+    rng = np.random.default_rng(1)
+    # four well separated clusters, so probing one list finds the exact
+    # neighbours
+    centers = np.eye(8, dtype=np.float32)[:4] * 10
+    vectors = centers[np.arange(400) % 4] + rng.normal(size=(400, 8))
+    vectors = vectors.astype(np.float32)
+    store = NumpyVectorStore("idx", str(tmp_path), ivf_lists=4, ivf_probes=1)
+    store.create(Mock(dimension=8))
+    body = []
+    for i, vector in enumerate(vectors):
+        body += [
+            {"index": {"_id": str(i)}},
+            {"unique_id": "u", "embedding": vector.tolist()},
+        ]
+    store.bulk(body)
+
+    hits = store.knn_search(vectors[7].tolist(), ["u"], k=5)["hits"]["hits"]
+
+    exact = np.argsort(-(vectors @ vectors[7]))[:5]
+    assert [hit["_id"] for hit in hits] == [str(i) for i in exact]
+    assert store._centroids.shape == (4, 8)
+    # only the query's list was scored
+    assert len(store._probe(np.arange(400), vectors[7])) == 100
+
+
+def test_numpy_vector_store_keeps_lists_across_writes(mocker, tmp_path):
+    rng = np.random.default_rng(2)
+    vectors = rng.normal(size=(320, 8)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    store = NumpyVectorStore("idx", str(tmp_path), ivf_lists=4, ivf_probes=2)
+    store.create(Mock(dimension=8))
+
+    def index(start, stop):
+        body = []
+        for i in range(start, stop):
+            body += [
+                {"index": {"_id": str(i)}},
+                {"unique_id": "u", "embedding": vectors[i].tolist()},
+            ]
+        store.bulk(body)
+
+    index(0, 200)
+    train = mocker.spy(store, "_train")
+    store.knn_search(vectors[0].tolist(), ["u"], k=1)
+    index(200, 210)
+    hits = store.knn_search(vectors[205].tolist(), ["u"], k=1)["hits"]["hits"]
+
+    assert hits[0]["_id"] == "205"
+    assert train.call_count == 1
+    index(210, 320)
+    store.knn_search(vectors[0].tolist(), ["u"], k=1)
+    assert train.call_count == 2
+
+
+def test_iter_pdf_pages_renders_in_windows(mocker):
+    mocker.patch(
+        "aws_rag_quickstart.rasterize.pdfinfo_from_path",
+        return_value={"Pages": 5},
+    )
+    mock_convert = mocker.patch(
+        "aws_rag_quickstart.rasterize.convert_from_path",
+        side_effect=lambda pdf, dpi, first_page, last_page: [
+            Mock(page=page) for page in range(first_page, last_page + 1)
+        ],
+    )
+
+    pages = []
+    for page_number, image in iter_pdf_pages(
+        "test.pdf", window=2, dpi=100, threads=1
+    ):
+        assert mock_convert.call_count == (page_number + 1) // 2
+        pages.append((page_number, image))
+
+    assert [page for page, _ in pages] == [1, 2, 3, 4, 5]
+    assert [image.page for _, image in pages] == [1, 2, 3, 4, 5]
+    assert [call.kwargs for call in mock_convert.call_args_list] == [
+        {"dpi": 100, "first_page": 1, "last_page": 2},
+        {"dpi": 100, "first_page": 3, "last_page": 4},
+        {"dpi": 100, "first_page": 5, "last_page": 5},
+    ]
+
+
+def test_iter_pdf_pages_parallel_keeps_order(mocker):
+    def convert(pdf, dpi, first_page, last_page):
+        # later windows finish first
+        time.sleep(0.01 * (10 - first_page))
+        return [Mock(page=page) for page in range(first_page, last_page + 1)]
+
+    mock_convert = mocker.patch(
+        "aws_rag_quickstart.rasterize.convert_from_path", side_effect=convert
+    )
+
+    pages = list(
+        iter_pdf_pages(
+            "test.pdf", window=2, pages=range(1, 10), threads=3, prefetch=3
+        )
+    )
+
+    assert [page for page, _ in pages] == list(range(1, 10))
+    assert [image.page for _, image in pages] == list(range(1, 10))
+    assert mock_convert.call_count == 5
+
+
+def test_iter_pdf_pages_bounds_prefetch(mocker):
+    mock_convert = mocker.patch(
+        "aws_rag_quickstart.rasterize.convert_from_path",
+        side_effect=lambda pdf, dpi, first_page, last_page: [
+            Mock() for _ in range(first_page, last_page + 1)
+        ],
+    )
+
+    for page_number, _ in iter_pdf_pages(
+        "test.pdf", window=2, pages=range(1, 10), threads=8, prefetch=1
+    ):
+        # the window being consumed and at most one ahead of it
+        assert mock_convert.call_count <= (page_number + 1) // 2 + 1
+
+
+def test_iter_pdf_pages_renders_on_every_thread(mocker):
+    barrier = threading.Barrier(2, timeout=5)
+
+    def convert(pdf, dpi, first_page, last_page):
+        # only returns once both threads render at the same time
+        barrier.wait()
+        return [Mock() for _ in range(first_page, last_page + 1)]
+
+    mocker.patch(
+        "aws_rag_quickstart.rasterize.convert_from_path", side_effect=convert
+    )
+
+    pages = list(
+        iter_pdf_pages(
+            "test.pdf", window=2, pages=range(1, 9), threads=2, prefetch=1
+        )
+    )
+
+    assert [page for page, _ in pages] == list(range(1, 9))
 
 
 def test_create_index_opensearch_success(mocker):
     client = mocker.MagicMock()
-    embeddings = mocker.MagicMock()
+    embeddings = mocker.MagicMock(dimension=1536)
     index_name = "test-index"
 
     expected_index_body = {
@@ -405,9 +1912,17 @@ def test_create_index_opensearch_success(mocker):
         "mappings": {
             "properties": {
                 "unique_id": {"type": "keyword"},
+                "file_path": {
+                    "type": "text",
+                    "fields": {
+                        "keyword": {"type": "keyword", "ignore_above": 1024}
+                    },
+                },
+                "page_hash": {"type": "keyword"},
+                "source_etag": {"type": "keyword"},
                 "embedding": {
                     "type": "knn_vector",
-                    "dimension": 1536,  # This is hardcoded in the implementation
+                    "dimension": 1536,
                     "method": {
                         "name": "hnsw",
                         "space_type": "innerproduct",
@@ -432,26 +1947,175 @@ def test_create_index_opensearch_success(mocker):
     assert result == mock_response
 
 
+def test_knn_vector_mapping_profiles():
+    fp16 = knn_vector_mapping(768, "fp16", m=16, ef_construction=128)
+    assert fp16["dimension"] == 768
+    assert fp16["method"]["parameters"] == {
+        "ef_construction": 128,
+        "ef_search": 256,
+        "m": 16,
+        "encoder": {"name": "sq", "parameters": {"type": "fp16"}},
+    }
+    int8 = knn_vector_mapping(768, "int8")
+    assert int8["method"]["engine"] == "lucene"
+    assert "ef_search" not in int8["method"]["parameters"]
+    on_disk = knn_vector_mapping(768, "on_disk")
+    assert on_disk["mode"] == "on_disk"
+    assert on_disk["compression_level"] == "32x"
+    with pytest.raises(ValueError):
+        knn_vector_mapping(768, "float64")
+
+
+def test_knn_query_ef_search_override():
+    default = knn_query([0.1], ["foo"], k=10)
+    tuned = knn_query([0.1], ["foo"], k=10, ef_search=64)
+
+    assert "method_parameters" not in default["query"]["knn"]["embedding"]
+    assert tuned["query"]["knn"]["embedding"]["method_parameters"] == {
+        "ef_search": 64
+    }
+
+
+def test_embeddings_dimension(mocker):
+    mocker.patch.dict("os.environ", {"LOCAL": "1"})
+    mock_embed = mocker.patch(
+        "aws_rag_quickstart.LLM.ollama.embeddings",
+        return_value={"embedding": [0.1, 0.2, 0.3]},
+    )
+
+    assert Embeddings().dimension == 3
+    mocker.patch("aws_rag_quickstart.LLM.EMBED_DIMENSION", 1024)
+    assert Embeddings().dimension == 1024
+    mock_embed.assert_called_once()
+
+
 def test_list_docs_by_id():
-    expected = {"num_pages": 1, "docs_list": ["bar"]}
+    expected = {"num_pages": 1200, "num_files": 2, "docs_list": ["a", "b"]}
+    search = Mock(
+        return_value={
+            "hits": {"total": {"value": 1200}, "hits": []},
+            "aggregations": {
+                "files": {
+                    "buckets": [
+                        {"key": "a", "doc_count": 700},
+                        {"key": "b", "doc_count": 500},
+                    ]
+                },
+                "num_files": {"value": 2},
+            },
+        }
+    )
     with patch(
-        "aws_rag_quickstart.opensearch.get_opensearch_connection",
-        Mock(
-            return_value=Mock(
-                search=Mock(
-                    return_value={
-                        "hits": {"hits": [{"_source": {"file_path": "bar"}}]}
-                    }
-                )
-            )
-        ),
+        "aws_rag_quickstart.vector_store.get_vector_store",
+        return_value=OpenSearchStore(Mock(search=search), "foo"),
     ):
-        actual = list_docs_by_id("bar")
+        actual = list_docs_by_id(["bar"])
     assert actual == expected
+    body = search.call_args.kwargs["body"]
+    assert body["size"] == 0
+    assert body["track_total_hits"] is True
+    assert body["query"]["bool"]["filter"] == [
+        {"terms": {"unique_id": ["bar"]}}
+    ]
+
+
+def test_has_docs_stops_at_first_match(mocker):
+    mock_client = mocker.MagicMock()
+    mock_client.search.return_value = {"hits": {"total": {"value": 1}}}
+    store = OpenSearchStore(mock_client, "test-index")
+
+    assert store.has_docs(["u1"])
+    body = mock_client.search.call_args.kwargs["body"]
+    assert body["size"] == 0
+    assert body["terminate_after"] == 1
+    assert not store.has_docs([])
+    assert mock_client.search.call_count == 1
 
 
 def test_summarize_documents():
-    with patch("aws_rag_quickstart.opensearch.get_opensearch_connection"), patch(
+    with patch("aws_rag_quickstart.opensearch.get_opensearch_client") as client, patch(
         "os.environ", {"BEDROCK_ENDPOINT": "https://foo"}
-    ):
-        summarize_documents({"unique_ids": ["foo"]})
+    ), patch("aws_rag_quickstart.LLM.BedrockEmbeddings"):
+        client.return_value.search.return_value = {
+            "hits": {"total": {"value": 0}}
+        }
+        answer = summarize_documents({"unique_ids": ["foo"]})
+    assert answer.startswith("There is no data")
+
+
+def test_job_queue_runs_tasks(tmp_path):
+    queue = JobQueue(path=str(tmp_path / "jobs.db"))
+    job_id = queue.submit("ingest", ["a.pdf", "b.pdf"], "manifest.json")
+    handled = []
+
+    def handler(event):
+        handled.append(event)
+        return 3
+
+    pool = JobWorkerPool(queue, {"ingest": handler}, workers=2)
+    while pool.run_once():
+        pass
+
+    assert handled == [
+        {"file_path": "a.pdf", "unique_id": "manifest.json"},
+        {"file_path": "b.pdf", "unique_id": "manifest.json"},
+    ]
+    status = JobQueue(path=str(tmp_path / "jobs.db")).status(job_id)
+    assert status["status"] == "done"
+    assert status["files"] == {
+        "pending": 0,
+        "running": 0,
+        "done": 2,
+        "failed": 0,
+    }
+    assert status["pages_indexed"] == 6
+    assert queue.status("unknown") is None
+
+
+def test_job_queue_retries_then_fails(tmp_path):
+    queue = JobQueue(
+        path=str(tmp_path / "jobs.db"), max_attempts=2, retry_delay=0
+    )
+    job_id = queue.submit("ingest", ["a.pdf"], "foo")
+    handler = Mock(side_effect=ValueError("boom"))
+    pool = JobWorkerPool(queue, {"ingest": handler})
+
+    assert pool.run_once()
+    assert queue.status(job_id)["files"]["pending"] == 1
+    assert pool.run_once()
+    assert not pool.run_once()
+
+    status = queue.status(job_id)
+    assert handler.call_count == 2
+    assert status["status"] == "failed"
+    assert status["failures"] == [
+        {"file_path": "a.pdf", "attempts": 2, "error": "ValueError('boom')"}
+    ]
+
+
+def test_job_queue_reclaims_expired_lease(tmp_path):
+    queue = JobQueue(path=str(tmp_path / "jobs.db"), lease_seconds=0)
+    queue.submit("ingest", ["a.pdf"], "foo")
+
+    first = queue.claim()
+    time.sleep(0.01)
+    second = queue.claim()
+
+    assert first["id"] == second["id"]
+    assert second["attempts"] == 2
+
+
+def test_job_worker_pool_threads(tmp_path):
+    queue = JobQueue(path=str(tmp_path / "jobs.db"))
+    job_id = queue.submit("ingest", [f"{i}.pdf" for i in range(5)], "foo")
+    pool = JobWorkerPool(
+        queue, {"ingest": lambda event: 1}, workers=3, poll_interval=0.01
+    )
+    pool.start()
+    for _ in range(500):
+        if queue.status(job_id)["status"] == "done":
+            break
+        time.sleep(0.01)
+    pool.stop()
+
+    assert queue.status(job_id)["pages_indexed"] == 5